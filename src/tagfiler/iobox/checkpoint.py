@@ -0,0 +1,73 @@
+#
+# Copyright 2010 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Keeps the progress of tree checksums in the Outbox state database.
+"""
+
+from models import Checkpoint
+
+import os
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Minimum number of seconds between saved checkpoints of a file
+CHECKPOINT_INTERVAL = 10
+
+
+class ChecksumCheckpoint(object):
+    """The checkpoint of one file, for use with files.tree_digest.
+
+    On creation, the chunk digests saved by an earlier run are loaded if the
+    file's size, mtime and inode and the chunk size are all unchanged. The
+    progress is saved at most every 'interval' seconds, and always when the
+    checksum stops early.
+    """
+
+    def __init__(self, state, filename, chunksize, interval=CHECKPOINT_INTERVAL):
+        """Initializes the checkpoint of 'filename' in OutboxStateDAO 'state'.
+
+        Raises OSError if the file cannot be stat'ed.
+        """
+        s = os.stat(filename)
+        self._state = state
+        self._interval = interval
+        self._saved = time.time()
+        self._cp = Checkpoint(filename=filename, size=s.st_size, mtime=s.st_mtime,
+                              inode=s.st_ino, chunksize=chunksize)
+        self.leaves = {}
+
+        exists = state.find_checkpoint(filename)
+        if exists and (exists.size, exists.mtime, exists.inode, exists.chunksize) == \
+                (self._cp.size, self._cp.mtime, self._cp.inode, self._cp.chunksize):
+            logger.debug("Resuming checksum of %s at %d chunks" %
+                         (filename, len(exists.leaves)))
+            self.leaves = dict([ (i, d.decode('hex')) for i, d in exists.leaves.items() ])
+
+    def save(self, leaves, final=False):
+        """Saves the binary chunk digests 'leaves', by chunk index."""
+        now = time.time()
+        if not final and now - self._saved < self._interval:
+            return
+        self._saved = now
+        self._cp.leaves = dict([ (i, d.encode('hex')) for i, d in leaves.items() ])
+        self._state.save_checkpoint(self._cp)
+
+    def clear(self):
+        """Deletes the checkpoint once the checksum is complete."""
+        self._state.delete_checkpoint(self._cp.filename)
@@ -18,11 +18,15 @@ Command-line interface for the Tagfiler Outbox.
 """
 
 import version
-from models import File, RERule, LineRule, DicomRule, NiftiRule, Outbox, create_default_name_path_rule
-from dao import OutboxStateDAO
+from models import File, RERule, LineRule, DicomRule, NiftiRule, Outbox, Listing, create_default_name_path_rule
+from dao import OutboxStateDAO, FileIndex, MergeJoin, PROFILES, COMMIT_ROWS
+from checkpoint import ChecksumCheckpoint
+from policy import ChangeDetector, POLICIES
+import policy
 from tagfiler.util.rules import TagDirector
 from tagfiler.util.http import TagfilerClient, UnresolvedAddress, NetworkError, ProtocolError, MalformedURL
-from tagfiler.util.files import tree_scan_stats, create_uri_friendly_file_path, sha256sum
+from tagfiler.util.files import tree_scan_dirs, tree_scan_sorted, listing_scan_dirs, create_uri_friendly_file_path, file_checksum, new_digest, CHECKSUM_BLOCKSIZE, CHECKSUM_PROVIDERS, DIGESTS, TREE_DIGEST
+from tagfiler.util import files
 
 import os
 import sys
@@ -45,6 +49,8 @@ __DESC = "The Tagfiler Outbox command-line utility."
 __VER  = "%(prog)s " + ("%d.%d trunk" % (version.MAJOR, version.MINOR))
 __DEFAULT_OUTBOX_NAME = "outbox"
 __BULK_OPS_MAX = 1000
+__SCAN_THREADS = 1
+__TREE_THREADS = 4
 
 # Verbosity to Loglevel dictionary
 __LOGLEVEL = {0: logging.ERROR,
@@ -55,6 +61,62 @@ __LOGLEVEL_MAX = 3
 __LOGLEVEL_DEFAULT = 0
 
 
+def _compute_checksum(f, outbox_model, state, hints=None, providers=None):
+    """Sets the checksum and digests of File 'f', see files.file_checksum.
+    
+    The progress of tree checksums is checkpointed in 'state', so that an
+    interrupted checksum is resumed by the next run. The state of a plain
+    SHA-256 cannot be saved, so it starts over. The files.IOHints 
+    'hints', if given, are applied to the reads, and the checksums stored
+    with files are taken from the files.ChecksumProviders 'providers'.
+    """
+    cp = None
+    if outbox_model.tree_chunksize and f.size > outbox_model.tree_chunksize:
+        try:
+            cp = ChecksumCheckpoint(state, f.filename, outbox_model.tree_chunksize)
+        except OSError:
+            pass
+    result = file_checksum(f.filename, f.size, outbox_model.digests,
+                           outbox_model.checksum_blocksize, 
+                           outbox_model.checksum_mmap,
+                           outbox_model.tree_chunksize,
+                           outbox_model.tree_threads, cp, None, hints,
+                           providers)
+    if result is None:
+        f.checksum = None
+    else:
+        (f.checksum, f.tree_chunksize, f.digests) = result
+        if cp is not None:
+            cp.clear()
+
+
+def _scan_dirs(outbox_model, failures=None):
+    """Generates (root, relpath, fingerprint, stats) for the roots and listings.
+    
+    See files.tree_scan_dirs and files.listing_scan_dirs. When reconciling,
+    the roots are scanned in path order by files.tree_scan_sorted. The 
+    directories of the roots that cannot be listed are appended to the 
+    'failures' list if given.
+    """
+    for root in outbox_model.roots:
+        if outbox_model.reconcile:
+            scan = tree_scan_sorted(root, outbox_model.excludes, 
+                                    outbox_model.includes, outbox_model.prune,
+                                    failures=failures)
+        else:
+            scan = tree_scan_dirs(root, outbox_model.excludes, 
+                                  outbox_model.includes, outbox_model.prune,
+                                  outbox_model.scan_threads, failures=failures)
+        for (rdpath, fingerprint, stats) in scan:
+            yield (root, rdpath, fingerprint, stats)
+    for listing in outbox_model.listings:
+        for (rdpath, fingerprint, stats) in \
+                listing_scan_dirs(listing.root, listing.filename, 
+                                  outbox_model.excludes, outbox_model.includes,
+                                  outbox_model.prune):
+            yield (listing.root, rdpath, fingerprint, stats)
+
+
 def main(args=None):
     """
     The main routine.
@@ -86,6 +148,9 @@ def main(args=None):
     parser.add_argument('-s', '--state_db', type=str, 
                         help=('local state database (default: %s)' % 
                               default_state_db))
+    parser.add_argument('--state-profile', choices=sorted(PROFILES.keys()),
+                        help='durability of the local state database' + \
+                        ' (default: safe)')
     
     # Until we know better, use gsiftp://... as default endpoint prefix
     default_endpoint = "gsiftp://%s" % socket.gethostname()
@@ -106,10 +171,63 @@ def main(args=None):
     group.add_argument('--root', metavar='DIRECTORY', 
                        type=str, nargs='+',
                        help='root directories to be traversed recursively')
+    group.add_argument('--listing', metavar=('DIRECTORY', 'LISTING'), 
+                       type=str, nargs=2, action='append',
+                       help='read the tree at DIRECTORY from the file' + \
+                       ' LISTING instead of traversing it')
     group.add_argument('--exclude', type=str, nargs='+',
                        help='exclude based on regular expression')
     group.add_argument('--include', type=str, nargs='+',
                        help='include based on regular expression')
+    group.add_argument('--prune', action='store_true',
+                       help='do not descend into excluded directories')
+    group.add_argument('--scan-threads', metavar='N', type=int,
+                       help='number of threads used to scan directories' + \
+                       ' (default: %d)' % __SCAN_THREADS)
+    group.add_argument('--preload-names', action='store_true',
+                       help='load all user and group names before scanning')
+    group.add_argument('--preload-state', action='store_true',
+                       help='load the state of all files before scanning')
+    group.add_argument('--preload-limit', metavar='MB', type=int,
+                       help='memory for the preloaded state, above which' + \
+                       ' files are looked up one at a time (default: 1024)')
+    group.add_argument('--dir-fingerprints', action='store_true',
+                       help='skip the files of unchanged directories in bulk')
+    group.add_argument('--reconcile', action='store_true',
+                       help='scan the roots in path order, merging them with' + \
+                       ' the state of their files')
+    group.add_argument('--sweep-deleted', action='store_true',
+                       help='unregister the files of the roots no longer found')
+    
+    # Checksum option group
+    group = parser.add_argument_group(title='Checksum options')
+    group.add_argument('--checksum-blocksize', metavar='BYTES', type=int,
+                       help='bytes read per block while computing checksums' + \
+                       ' (default: %d)' % CHECKSUM_BLOCKSIZE)
+    group.add_argument('--checksum-mmap', action='store_true',
+                       help='memory map large files while computing checksums')
+    group.add_argument('--drop-behind', action='store_true',
+                       help='drop hashed data from the page cache')
+    group.add_argument('--lazy-checksums', action='store_true',
+                       help='register new files first and hash them afterwards')
+    group.add_argument('--checksum-providers', metavar='NAME', type=str, nargs='+',
+                       help='reuse the checksums stored with files' + \
+                       ' (choose from: %s)' % ', '.join(CHECKSUM_PROVIDERS))
+    group.add_argument('--xattr-writeback', action='store_true',
+                       help='store computed checksums in extended attributes')
+    group.add_argument('--digests', metavar='NAME', type=str, nargs='+',
+                       help='digests to compute and register as tags' + \
+                       ' (choose from: %s)' % ', '.join(DIGESTS))
+    group.add_argument('--tree-chunksize', metavar='BYTES', type=int,
+                       help='use the %s digest, in chunks of BYTES,' % TREE_DIGEST + \
+                       ' as the checksum of larger files, resumed after an' + \
+                       ' interruption unlike a plain sha256')
+    group.add_argument('--tree-threads', metavar='N', type=int,
+                       help='number of threads hashing the chunks of a file' + \
+                       ' (default: %d)' % __TREE_THREADS)
+    group.add_argument('--change-policy', choices=sorted(POLICIES.keys()),
+                       help='how files seen before are checked for changes' + \
+                       ' (default: mtime)')
     
     # Tagfiler option group
     group = parser.add_argument_group(title='Tagfiler options')
@@ -156,6 +274,10 @@ def main(args=None):
     outbox_model.name = args.name or cfg.get('name', __DEFAULT_OUTBOX_NAME)
     outbox_model.state_db = args.state_db or \
                             cfg.get('state_db', default_state_db)
+    outbox_model.state_profile = args.state_profile or \
+                                 cfg.get('state_profile', 'safe')
+    if outbox_model.state_profile not in PROFILES:
+        parser.error("Unsupported state database profile: %s" % outbox_model.state_profile)
 
     # Tagfiler settings
     outbox_model.url = args.url or cfg.get('url')
@@ -178,12 +300,20 @@ def main(args=None):
                                 cfg.get('endpoint', default_endpoint)
 
     # Roots
-    roots = args.root or cfg.get('roots')
-    if not roots or not len(roots):
-        parser.error('At least one root directory must be given.')
+    roots = args.root or cfg.get('roots') or []
     for root in roots:
         outbox_model.roots.append(root)
     
+    # Listings, read instead of traversing their root directories
+    if args.listing:
+        for (root, filename) in args.listing:
+            outbox_model.listings.append(Listing(root=root, filename=filename))
+    else:
+        for listing in cfg.get('listings', []):
+            outbox_model.listings.append(Listing(**listing))
+    if not outbox_model.roots and not outbox_model.listings:
+        parser.error('At least one root directory or listing must be given.')
+    
     # Add include/exclusion patterns
     excludes = args.exclude or cfg.get('excludes')
     if excludes and len(excludes):
@@ -195,6 +325,61 @@ def main(args=None):
         for include in includes:
             outbox_model.includes.append(re.compile(include))
     
+    outbox_model.prune = args.prune or cfg.get('prune', False)
+    outbox_model.scan_threads = args.scan_threads or \
+                                cfg.get('scan_threads', __SCAN_THREADS)
+    outbox_model.scan_threads = int(outbox_model.scan_threads)
+    outbox_model.preload_names = args.preload_names or \
+                                 cfg.get('preload_names', False)
+    outbox_model.preload_state = args.preload_state or \
+                                 cfg.get('preload_state', False)
+    outbox_model.preload_limit = int(args.preload_limit or 
+                                     cfg.get('preload_limit', 1024))
+    outbox_model.dir_fingerprints = args.dir_fingerprints or \
+                                    cfg.get('dir_fingerprints', False)
+    outbox_model.reconcile = args.reconcile or cfg.get('reconcile', False)
+    outbox_model.sweep_deleted = args.sweep_deleted or \
+                                 cfg.get('sweep_deleted', False)
+    
+    # Checksum settings
+    outbox_model.checksum_blocksize = args.checksum_blocksize or \
+                        cfg.get('checksum_blocksize', CHECKSUM_BLOCKSIZE)
+    outbox_model.checksum_blocksize = int(outbox_model.checksum_blocksize)
+    outbox_model.checksum_mmap = args.checksum_mmap or \
+                                 cfg.get('checksum_mmap', False)
+    outbox_model.drop_behind = args.drop_behind or cfg.get('drop_behind', False)
+    outbox_model.lazy_checksums = args.lazy_checksums or \
+                                  cfg.get('lazy_checksums', False)
+    outbox_model.checksum_providers = args.checksum_providers or \
+                                      cfg.get('checksum_providers', [])
+    outbox_model.xattr_writeback = args.xattr_writeback or \
+                                   cfg.get('xattr_writeback', False)
+    try:
+        files.ChecksumProviders(outbox_model.checksum_providers)
+    except ValueError as e:
+        parser.error(str(e))
+    if 'sidecar' in outbox_model.checksum_providers:
+        # the sidecars are not data files of their own
+        outbox_model.excludes.append(re.compile(re.escape(files.SIDECAR_SUFFIX) + '$'))
+    digests = args.digests or cfg.get('digests', [])
+    for digest in digests:
+        try:
+            new_digest(digest)
+        except ValueError as e:
+            parser.error(str(e))
+        outbox_model.digests.append(digest)
+    outbox_model.tree_chunksize = args.tree_chunksize or \
+                                  cfg.get('tree_chunksize')
+    if outbox_model.tree_chunksize:
+        outbox_model.tree_chunksize = int(outbox_model.tree_chunksize)
+    outbox_model.tree_threads = args.tree_threads or \
+                                cfg.get('tree_threads', __TREE_THREADS)
+    outbox_model.tree_threads = int(outbox_model.tree_threads)
+    outbox_model.change_policy = args.change_policy or \
+                                 cfg.get('change_policy', 'mtime')
+    if outbox_model.change_policy not in POLICIES:
+        parser.error("Unsupported change policy: %s" % outbox_model.change_policy)
+    
     # Add the default 'name' tag path rule
     name_rule = create_default_name_path_rule(outbox_model.endpoint)
     outbox_model.path_rules.append(name_rule)
@@ -238,59 +423,170 @@ def main(args=None):
         print >> sys.stderr, ('ERROR: %s' % err)
         return __EXIT_FAILURE
     
-    state = OutboxStateDAO(outbox_model.state_db)
+    state = OutboxStateDAO(outbox_model.state_db, 
+                           profile=outbox_model.state_profile)
     worklist = []
     found = 0
     skipped = 0
+    moved = 0
     tagged = 0
     registered = 0
+    changes = ChangeDetector(outbox_model.change_policy)
+    hints = files.IOHints(outbox_model.drop_behind)
+    providers = None
+    if outbox_model.checksum_providers or outbox_model.xattr_writeback:
+        providers = files.ChecksumProviders(outbox_model.checksum_providers,
+                                            outbox_model.xattr_writeback)
+    # Directory fingerprints would defeat the 'paranoid' change policy
+    use_fingerprints = outbox_model.dir_fingerprints and \
+                       outbox_model.change_policy != 'paranoid'
+    
+    if outbox_model.preload_names:
+        files.preload_names()
+    
+    # A root under another one is walked as part of it
+    outbox_model.roots = files.outermost_dirs(outbox_model.roots)
+    
+    # Stamp the entries of the files found with a new generation, so that
+    # those of files no longer found can be swept
+    stamped = []
+    if outbox_model.sweep_deleted:
+        state.start_generation()
+    
+    # Look files up by merging the sorted roots with their state, or in the
+    # preloaded state of the roots, unless it is too large
+    lookup = state
+    merge = None
+    if outbox_model.reconcile:
+        merge = MergeJoin(state, [create_uri_friendly_file_path(d, '') 
+                                  for d in outbox_model.roots])
+        lookup = merge
+    elif outbox_model.preload_state:
+        dirnames = [create_uri_friendly_file_path(d, '') for d in 
+                    outbox_model.roots + [l.root for l in outbox_model.listings]]
+        index = FileIndex(state, dirnames, outbox_model.preload_limit * 1048576)
+        if index.complete:
+            lookup = index
 
-    # walk the root trees, cksum as needed, create worklist to be registered
-    for root in outbox_model.roots:
-        for (rfpath, size, mtime, user, group) in \
-                tree_scan_stats(root, outbox_model.excludes, outbox_model.includes):
+    # walk the root trees and listings, cksum as needed, create worklist to be registered
+    failures = []
+    for (root, rdpath, fingerprint, stats) in _scan_dirs(outbox_model, failures):
+        dirname = create_uri_friendly_file_path(root, rdpath)
+        if use_fingerprints and fingerprint and \
+                state.find_fingerprint(dirname) == fingerprint:
+            # Case: Directory unchanged, skip its files
+            logger.debug("Unchanged directory: %s" % dirname)
+            found += len(stats)
+            skipped += len(stats)
+            if outbox_model.sweep_deleted:
+                # only the members found, not those now excluded
+                state.stamp_filenames([create_uri_friendly_file_path(root, s[0]) 
+                                       for s in stats])
+            continue
+        
+        dir_skipped = skipped
+        for (rfpath, size, mtime, user, group, identity) in stats:
             filename = create_uri_friendly_file_path(root, rfpath)
+            (dev, inode, st_size, mtime_ns, ctime_ns) = identity
             fargs = {'filename': filename, 'mtime': mtime, 'size': size, \
-                    'username': user, 'groupname': group}
+                    'username': user, 'groupname': group, 'dev': dev, \
+                    'inode': inode, 'mtime_ns': mtime_ns, 'ctime_ns': ctime_ns}
             f = File(**fargs)
             found += 1
-            
+        
             # Check if file exists in local state db
-            exists = state.find_file(filename)
+            exists = lookup.find_file(filename)
+            if exists and outbox_model.sweep_deleted:
+                stamped.append(exists.id)
+                if len(stamped) >= COMMIT_ROWS:
+                    state.stamp_files(stamped)
+                    stamped = []
+            if exists and exists.superseded_by:
+                # The file is back under its old name
+                state.supersede_file(exists, None)
+        
+            moved_from = None
+            change = None
             if not exists:
+                moved_from = state.find_moved_file(f)
+            else:
+                change = changes.check(f, exists)
+        
+            if moved_from:
+                # Case: File moved or linked from a file seen before
+                logger.debug("Moved: %s -> %s" % (moved_from.filename, filename))
+                f.checksum = moved_from.checksum
+                f.tree_chunksize = moved_from.tree_chunksize
+                f.digests = moved_from.digests
+                state.add_files([f])
+                identity = files.path_identity(moved_from.filename)
+                if not identity or identity[:2] != (moved_from.dev, moved_from.inode):
+                    state.supersede_file(moved_from, filename)
+                worklist.append(f)
+                moved += 1
+            elif not exists and outbox_model.lazy_checksums and f.size:
+                # Case: New file, its checksum is deferred
+                logger.debug("New, checksum deferred: %s" % filename)
+                state.add_files([f])
+                worklist.append(f)
+            elif not exists:
                 # Case: New file, not seen before
                 logger.debug("New: %s" % filename)
-                f.checksum = sha256sum(filename)
-                state.add_file(f)
+                _compute_checksum(f, outbox_model, state, hints, providers)
+                state.add_files([f])
                 worklist.append(f)
-            elif f.mtime > exists.mtime:
+            elif change == policy.HASH:
                 # Case: File has changed since last seen
                 logger.debug("Modified: %s" % filename)
-                f.checksum = sha256sum(filename)
+                _compute_checksum(f, outbox_model, state, hints, providers)
                 if f.checksum != exists.checksum:
                     f.id = exists.id
-                    state.update_file(f)
+                    state.update_files([f])
                     worklist.append(f)
                 else:
-                    exists.mtime = f.mtime # update mod time
-                    state.update_file(f)
+                    # update mod time, so that it won't be cksummed next time
+                    f.id = exists.id
+                    f.rtime = exists.rtime
+                    state.update_files([f])
                     skipped += 1
-            elif f.size and not exists.checksum:
+            elif change == policy.REGISTER:
+                # Case: File has changed, its checksum is deferred
+                logger.debug("Modified, checksum deferred: %s" % filename)
+                f.id = exists.id
+                state.update_files([f])
+                worklist.append(f)
+            elif f.size and not exists.checksum and not outbox_model.lazy_checksums:
                 # Case: Missing checksum, on regular file
                 logger.debug("Missing checksum: %s" % filename)
-                f.checksum = sha256sum(filename)
+                _compute_checksum(f, outbox_model, state, hints, providers)
                 f.id = exists.id
-                state.update_file(f)
+                state.update_files([f])
                 worklist.append(f)
             elif not exists.rtime:
                 # Case: File has not been registered
                 logger.debug("Not registered: %s" % filename)
                 worklist.append(exists)
+            elif f.size and not exists.checksum:
+                # Case: Missing checksum, left to the backfill below
+                logger.debug("Checksum deferred: %s" % filename)
             else:
                 # Case: File does not meet any criteria for processing
                 logger.debug("Skipping: %s" % filename)
                 skipped += 1
-    
+                if (exists.dev, exists.inode, exists.mtime_ns, exists.ctime_ns) != \
+                        (f.dev, f.inode, f.mtime_ns, f.ctime_ns):
+                    f.id = exists.id
+                    state.update_identity(f)
+        
+        if use_fingerprints and fingerprint and skipped - dir_skipped == len(stats):
+            # All its files are up to date, record its fingerprint
+            state.save_fingerprint(dirname, fingerprint)
+    if merge:
+        # Count the files of the roots no longer found
+        merge.finish()
+    for dirpath in failures:
+        logger.warning("Cannot list %s" % dirpath)
+
     # Tag files in worklist
     tag_director = TagDirector()
     for f in worklist:
@@ -301,20 +597,101 @@ def main(args=None):
         tag_director.tag_file_contents(outbox_model.line_rules, f)
         tagged += 1
     
-    # Register files in worklist
+    # Register files in worklist, marking them registered once accepted
+    state.commit()
     if len(worklist):
-        client.add_subjects(worklist)
+        client.add_subjects(worklist, outbox_model.digests)
     for f in worklist:
         logger.debug("Registered: %s" % f)
         f.rtime = time.time()
-        state.update_file(f)
         registered += 1
+    state.update_files(worklist)
+    state.commit()
+    
+    # Backfill the checksums of files registered without one, and register
+    # them again with only their name and checksum tags. The entries of the
+    # files no longer found are left to the sweep, or deleted.
+    backfilled = 0
+    missing = 0
+    if outbox_model.lazy_checksums:
+        backlist = []
+        deferred = state.find_deferred_files(
+                        [create_uri_friendly_file_path(d, '') for d in 
+                         outbox_model.roots + [l.root for l in outbox_model.listings]])
+        for f in deferred:
+            if not os.path.isfile(f.filename):
+                logger.debug("Not found, checksum deferred: %s" % f.filename)
+                missing += 1
+                if not outbox_model.sweep_deleted:
+                    state.delete_files([f])
+                continue
+            logger.debug("Backfilling: %s" % f.filename)
+            _compute_checksum(f, outbox_model, state, hints, providers)
+            if f.checksum is None:
+                continue
+            tag_director.tag_registered_file(outbox_model.path_rules, f)
+            f.tags = f.filter_tags('name')
+            f.checksum_only = True
+            backlist.append(f)
+        state.commit()
+        if len(backlist):
+            client.add_subjects(backlist, outbox_model.digests)
+        for f in backlist:
+            f.rtime = time.time()
+            backfilled += 1
+        state.update_files(backlist)
+        state.commit()
+    
+    # Unregister the files of the roots no longer found, in bulk, and delete
+    # their entries. The files under directories that could not be listed
+    # were not looked for.
+    unregistered = 0
+    pruned = 0
+    if outbox_model.sweep_deleted:
+        state.stamp_files(stamped)
+        failed = tuple([create_uri_friendly_file_path(d, '').rstrip('/') + '/' 
+                        for d in failures])
+        for root in outbox_model.roots:
+            if not os.path.isdir(root):
+                logger.warning("Not sweeping %s, not a directory" % root)
+                continue
+            swept = [f for f in state.find_swept_files(create_uri_friendly_file_path(root, ''))
+                     if not f.filename.startswith(failed)]
+            for f in swept:
+                logger.debug("Deleted: %s" % f.filename)
+                tag_director.tag_registered_file(outbox_model.path_rules, f)
+                f.tags = f.filter_tags('name')
+            swept_registered = [f for f in swept if f.rtime]
+            state.commit()
+            bulk = max(1, outbox_model.bulk_ops_max)
+            for start in range(0, len(swept_registered), bulk):
+                client.delete_subjects(swept_registered[start:start + bulk])
+            unregistered += len(swept_registered)
+            state.delete_files(swept)
+            pruned += len(swept)
+    state.close()
     
     # Print final message unless '--quiet'
     if not args.quiet:
         # Print concluding message to stdout
-        print "Done. Found=%s Skipped=%s Tagged=%s Registered=%s" % \
-                    (found, skipped, tagged, registered)
+        print "Done. Found=%s Skipped=%s Moved=%s Tagged=%s Registered=%s" % \
+                    (found, skipped, moved, tagged, registered)
+        print changes.summary()
+        if outbox_model.lazy_checksums:
+            print "Lazy checksums: Backfilled=%d Missing=%d" % (backfilled, missing)
+        if merge:
+            print "Reconcile: Deleted=%d Fallbacks=%d" % (merge.deleted, merge.fallbacks)
+        if outbox_model.sweep_deleted:
+            print "Sweep: Unregistered=%d Pruned=%d" % (unregistered, pruned)
+        if outbox_model.drop_behind:
+            print "I/O hints: Dropped=%.1f MB" % (hints.dropped / 1048576.0)
+        if providers:
+            print "Checksum providers: %s Written=%d" % \
+                (' '.join([ '%s=%d' % (n, providers.provided[n]) for n in providers.names ]),
+                 providers.written)
+    logger.info("Name cache: users hits=%d misses=%d, groups hits=%d misses=%d" % 
+                (files.user_names.hits, files.user_names.misses, 
+                 files.group_names.hits, files.group_names.misses))
     
     try:
         client.close()
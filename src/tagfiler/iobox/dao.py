@@ -19,12 +19,45 @@ The data access object (DAO) class definitions.
 
 import sqlite3
 import logging
+import binascii
+import struct
+import json
+import time
+import sys
 import os
 import models
 
 
 logger = logging.getLogger(__name__)
 
+# Batched writes are committed once this many rows are pending...
+COMMIT_ROWS = 1000
+
+# ...or once the oldest of them has been pending this many seconds
+COMMIT_SECONDS = 1.0
+
+# Default maximum bytes of memory used by a FileIndex
+PRELOAD_LIMIT = 1024 * 1048576
+
+# Number of file entries read at a time by a MergeJoin
+MERGE_ROWS = 1000
+
+# Durability profiles of the database, by name, as the PRAGMAs set on each
+# connection. The 'safe' profile keeps SQLite's rollback journal and syncs
+# every commit. The others use a write-ahead log, which lets readers proceed
+# alongside a writer but needs a local filesystem; 'balanced' only syncs the
+# log at checkpoints, surviving crashes of the Outbox but possibly losing the
+# last commits on power loss, and 'fast' leaves syncing to the OS and uses
+# larger caches.
+PROFILES = {
+    'safe':     [('journal_mode', 'DELETE'), ('synchronous', 'FULL')],
+    'balanced': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'),
+                 ('cache_size', -16384), ('temp_store', 'MEMORY')],
+    'fast':     [('journal_mode', 'WAL'), ('synchronous', 'OFF'),
+                 ('cache_size', -65536), ('mmap_size', 268435456),
+                 ('temp_store', 'MEMORY')]
+}
+
 
 class DaoException(Exception):
     def __init__(self, value, cause=None):
@@ -41,7 +74,7 @@ class DaoException(Exception):
 
 class DataDAO(object):
    
-    def __init__(self, db_filename, sql_filename):
+    def __init__(self, db_filename, sql_filename, profile='safe'):
         """Constructs a DAO instance, creating the database schema in the 
         database file if necessary
         
@@ -49,7 +82,12 @@ class DataDAO(object):
         database).
         
         The 'sql_filename' parameter is the filename of the SQL DDL script to 
-        be used in order to create the corresponding database.
+        be used in order to create the corresponding database. The script is
+        run each time the database is opened, so that tables added to it 
+        are created in existing databases, and must use 'IF NOT EXISTS'.
+        
+        The 'profile' parameter names the PROFILES entry used for the 
+        connection. Raises ValueError if it is not one of PROFILES.
         
         May raise 'OperationalError' from sqlite3 module, for instance, if it 
         fails to open the database file.
@@ -60,6 +98,8 @@ class DataDAO(object):
                 d[col[0]] = row[idx]
             return d
     
+        if profile not in PROFILES:
+            raise ValueError("Unsupported state database profile: %s" % profile)
         self.db_filename = db_filename
         
         # Test for existence of the state db, before issuing the connect
@@ -84,29 +124,62 @@ class DataDAO(object):
         # Assign row factory
         self.db.row_factory = _dict_factory
         
-        # If db didn't exist (prior to sqlite connect), create database schema
+        try:
+            for name, value in PROFILES[profile]:
+                self.db.execute("PRAGMA %s = %s" % (name, value))
+        except sqlite3.OperationalError as err:
+            msg = "Failed to apply the %s profile" % profile
+            raise DaoException(msg, err)
+        
+        # Create database schema, or any tables missing from it
         if not db_exists:
             logger.info("Storing local state in %s." % self.db_filename)
+        
+        try:
+            import tagfiler.iobox
+            sql_source_dir = os.path.join(os.path.dirname(tagfiler.iobox.__file__), "sql/")
+            source_file = os.path.join(sql_source_dir, sql_filename)
             
-            try:
-                import tagfiler.iobox
-                sql_source_dir = os.path.join(os.path.dirname(tagfiler.iobox.__file__), "sql/")
-                source_file = os.path.join(sql_source_dir, sql_filename)
-                
-                cursor = self.db.cursor()
-                f = open(source_file, "r")
-                sql_stmts = str.split(f.read(), ";")
-                for s in sql_stmts:
-                    logger.debug("Executing statement %s" % s)
-                    s.strip()
-                    if len(s) > 0:
-                        cursor.execute(s)
-                f.close()
-                cursor.close()
-            except sqlite3.OperationalError as err:
-                msg = "Unexpected error"
-                raise DaoException(msg, err)
+            cursor = self.db.cursor()
+            f = open(source_file, "r")
+            sql_stmts = str.split(f.read(), ";")
+            for s in sql_stmts:
+                logger.debug("Executing statement %s" % s)
+                s = s.strip()
+                if len(s) > 0:
+                    cursor.execute(s)
+            f.close()
+            cursor.close()
+            self.db.commit()
+        except sqlite3.OperationalError as err:
+            msg = "Unexpected error"
+            raise DaoException(msg, err)
+
 
+    def _add_missing_columns(self, table, columns):
+        """Adds any of 'columns' missing from 'table' in the database.
+        
+        The 'columns' parameter is a list of (name, declaration) pairs. This 
+        upgrades databases created from an earlier version of the schema.
+        """
+        try:
+            cursor = self.db.cursor()
+            cursor.execute("PRAGMA table_info(%s)" % table)
+            existing = set([r["name"] for r in cursor.fetchall()])
+            for name, decl in columns:
+                if name not in existing:
+                    logger.info("Adding column %s to table %s." % (name, table))
+                    try:
+                        cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table, name, decl))
+                    except sqlite3.OperationalError as err:
+                        # another connection may have just added it
+                        if 'duplicate column' not in str(err):
+                            raise
+            cursor.close()
+            self.db.commit()
+        except sqlite3.OperationalError as err:
+            msg = "Failed to upgrade table %s" % table
+            raise DaoException(msg, err)
 
     def close(self):
         if self.db is not None:
@@ -120,38 +193,590 @@ class DataDAO(object):
 
 
 class OutboxStateDAO(DataDAO):
-    """Data Access Object for a particular outbox's state."""
+    """Data Access Object for a particular outbox's state.
     
-    def __init__(self, db_filename):
-        super(OutboxStateDAO, self).__init__(db_filename, "outbox_state.sql")
-                
+    The add_files and update_files methods write batches of files without
+    committing them at once. Their writes are committed together, by
+    commit(), once 'commit_rows' rows are pending or the oldest of them has
+    been pending 'commit_seconds' seconds, and always by the other writing
+    methods and by close(). Pending writes are visible to this object's own
+    queries, but not to other connections to the database until committed.
+    """
     
-    def add_file(self, f):
-        """Adds a new file object to the database."""
-        p = (f.filename, f.mtime, f.size, f.checksum, f.username, f.groupname)
+    # Digests other than the 'checksum', each stored in a column of the same
+    # name. The sha256 column is only used when the checksum is a tree digest.
+    DIGEST_COLUMNS = ['md5', 'sha1', 'blake2b', 'crc32', 'adler32', 'sha256']
+    
+    # File attributes stored in a column of the same name
+    ATTR_COLUMNS = [('tree_chunksize', 'INTEGER'), 
+                    ('dev', 'INTEGER'), ('inode', 'INTEGER'),
+                    ('mtime_ns', 'INTEGER'), ('ctime_ns', 'INTEGER'),
+                    ('superseded_by', 'TEXT')]
+    
+    # Columns added to the 'file' table since its original schema; the 
+    # generation of an entry is the last run that found its file
+    _FILE_UPGRADES = [(name, 'TEXT') for name in DIGEST_COLUMNS] + ATTR_COLUMNS + \
+                     [('generation', 'INTEGER')]
+    
+    # Columns following the original ones in add_file, update_file and find_file
+    _FILE_EXTRA = DIGEST_COLUMNS + [name for name, decl in ATTR_COLUMNS]
+    
+    _FILE_SELECT = "SELECT id, filename, mtime, rtime, size, checksum, username, groupname, %s FROM file" % \
+        ", ".join(_FILE_EXTRA)
+    
+    # Indexes on upgraded columns, created after the upgrade
+    _FILE_INDEXES = ["CREATE INDEX IF NOT EXISTS file_identity ON file (dev, inode)"]
+    
+    def __init__(self, db_filename, commit_rows=COMMIT_ROWS, 
+                 commit_seconds=COMMIT_SECONDS, profile='safe'):
+        super(OutboxStateDAO, self).__init__(db_filename, "outbox_state.sql",
+                                             profile)
+        self._commit_rows = commit_rows
+        self._commit_seconds = commit_seconds
+        self._pending = 0
+        self._pending_since = None
+        self.generation = None
+        self._add_missing_columns('file', OutboxStateDAO._FILE_UPGRADES)
+        try:
+            for s in OutboxStateDAO._FILE_INDEXES:
+                self.db.execute(s)
+            self.db.commit()
+        except sqlite3.OperationalError as err:
+            msg = "Failed to index table file"
+            raise DaoException(msg, err)
+    
+    def _file(self, r):
+        """Returns a File for row 'r' of a _FILE_SELECT query."""
+        digests = {}
+        for name in OutboxStateDAO.DIGEST_COLUMNS:
+            value = r.pop(name)
+            if value is not None:
+                digests[name] = value
+        return models.File(digests=digests, **r)
+    
+    def _extra_params(self, f):
+        return tuple([f.digests.get(name) for name in OutboxStateDAO.DIGEST_COLUMNS] + 
+                     [getattr(f, name) for name, decl in OutboxStateDAO.ATTR_COLUMNS])
+    
+    def _written(self, rows):
+        """Counts 'rows' written and not committed, and commits them when due."""
+        if not self._pending:
+            self._pending_since = time.time()
+        self._pending += rows
+        self.commit(False)
+    
+    def commit(self, force=True):
+        """Commits the pending writes of the methods that commit when due.
+        
+        Unless 'force' is set, they are only committed when due.
+        """
+        if force or (self._pending and 
+                     (self._pending >= self._commit_rows or 
+                      time.time() - self._pending_since >= self._commit_seconds)):
+            self.db.commit()
+            self._pending = 0
+    
+    def close(self):
+        if self.db is not None:
+            self.commit()
+        super(OutboxStateDAO, self).close()
+    
+    def add_files(self, fs):
+        """Adds new file objects to the database, setting their ids.
+        
+        The rows are stamped with the current generation, if any, and are
+        committed when due, see commit().
+        """
         cursor = self.db.cursor()
-        cursor.execute("INSERT INTO file (filename, mtime, size, checksum, username, groupname) VALUES (?, ?, ?, ?, ?, ?)", p)
-        cursor.execute("SELECT last_insert_rowid() AS id")
-        f.id = cursor.fetchone()["id"]
+        for f in fs:
+            p = (f.filename, f.mtime, f.size, f.checksum, f.username, f.groupname) + \
+                self._extra_params(f) + (self.generation,)
+            cursor.execute("INSERT INTO file (filename, mtime, size, checksum, username, groupname, %s, generation) VALUES (?, ?, ?, ?, ?, ?, %s, ?)" % 
+                           (", ".join(OutboxStateDAO._FILE_EXTRA), 
+                            ", ".join(["?"] * len(OutboxStateDAO._FILE_EXTRA))), p)
+            f.id = cursor.lastrowid
         cursor.close()
-        self.db.commit()
+        self._written(len(fs))
+    
+    def update_files(self, fs):
+        """Updates file entries in the database.
+        
+        The rows are committed when due, see commit().
+        """
+        ps = [(f.filename, f.mtime, f.rtime, f.size, f.checksum, f.username, f.groupname) + \
+              self._extra_params(f) + (f.id,) for f in fs]
+        cursor = self.db.cursor()
+        cursor.executemany("UPDATE file SET filename = ?, mtime = ?, rtime = ?, size = ?, checksum = ?, username = ?, groupname = ?, %s WHERE id = ?" % 
+                           ", ".join(["%s = ?" % name for name in OutboxStateDAO._FILE_EXTRA]), ps)
+        cursor.close()
+        self._written(len(fs))
+    
+    def add_file(self, f):
+        """Adds a new file object to the database."""
+        self.add_files([f])
+        self.commit()
 
     def update_file(self, f):
         """Updates a file entry in the database."""
-        p = (f.filename, f.mtime, f.rtime, f.size, f.checksum, f.username, f.groupname, f.id)
-        cursor = self.db.cursor()
-        cursor.execute("UPDATE file SET filename = ?, mtime = ?, rtime = ?, size = ?, checksum = ?, username = ?, groupname = ? WHERE id = ?", p)
-        cursor.close()
-        self.db.commit()
+        self.update_files([f])
+        self.commit()
     
     def find_file(self, filename):
         """Retrieves a file object from the database matching the filename."""
         f = None
         cursor = self.db.cursor()
         p = (filename,)
-        cursor.execute("SELECT id, filename, mtime, rtime, size, checksum, username, groupname FROM file WHERE filename=?", p)
+        cursor.execute(OutboxStateDAO._FILE_SELECT + " WHERE filename=?", p)
         r = cursor.fetchone()
         cursor.close()
         if r is not None:
-            f = models.File(**r)
+            f = self._file(r)
         return f
+    
+    # Columns of the rows yielded by iter_files_under
+    _INDEX_SELECT = "SELECT id, filename, mtime, rtime, size, checksum, tree_chunksize, dev, inode, mtime_ns, ctime_ns, superseded_by IS NOT NULL OR %s AS partial FROM file" % \
+        " OR ".join(["%s IS NOT NULL" % name for name in DIGEST_COLUMNS])
+    
+    def _under(self, dirname):
+        """Returns the bounds of the filenames under 'dirname'."""
+        dirname = dirname.rstrip('/')
+        return (dirname + '/', dirname + '0')
+    
+    def count_files_under(self, dirname):
+        """Returns the number of file entries under 'dirname' and the total
+        length of their names."""
+        cursor = self.db.cursor()
+        cursor.execute("SELECT count(*) AS n, total(length(filename)) AS length FROM file WHERE filename >= ? AND filename < ?", 
+                       self._under(dirname))
+        r = cursor.fetchone()
+        cursor.close()
+        return (r["n"], int(r["length"]))
+    
+    def iter_files_under(self, dirname):
+        """Yields the file entries under 'dirname' as tuples, in filename order.
+        
+        The tuples hold the id, filename, mtime, rtime, size, checksum,
+        tree_chunksize, dev, inode, mtime_ns and ctime_ns of a file, and 
+        whether it also has digests or is superseded. Rows are read as the
+        tuples are consumed.
+        """
+        cursor = self.db.cursor()
+        cursor.row_factory = None
+        cursor.execute(OutboxStateDAO._INDEX_SELECT + " WHERE filename >= ? AND filename < ? ORDER BY filename", 
+                       self._under(dirname))
+        try:
+            for r in cursor:
+                yield r
+        finally:
+            cursor.close()
+    
+    def max_file_id(self):
+        """Returns the largest id of the file entries, or 0."""
+        cursor = self.db.cursor()
+        cursor.execute("SELECT max(id) AS id FROM file")
+        r = cursor.fetchone()
+        cursor.close()
+        return r["id"] or 0
+    
+    def list_files_under(self, dirname, after=None, limit=MERGE_ROWS):
+        """Retrieves up to 'limit' file entries under 'dirname' in filename 
+        order, starting after the filename 'after' if given. Returns a list
+        of file objects."""
+        (lower, upper) = self._under(dirname)
+        cursor = self.db.cursor()
+        if after is None:
+            cursor.execute(OutboxStateDAO._FILE_SELECT + " WHERE filename >= ? AND filename < ? ORDER BY filename LIMIT ?", 
+                           (lower, upper, limit))
+        else:
+            cursor.execute(OutboxStateDAO._FILE_SELECT + " WHERE filename > ? AND filename < ? ORDER BY filename LIMIT ?", 
+                           (after, upper, limit))
+        found = [self._file(r) for r in cursor.fetchall()]
+        cursor.close()
+        return found
+    
+    def start_generation(self):
+        """Starts a new generation of the file entries and returns its number.
+        
+        File entries added from then on are stamped with it, and existing
+        ones are stamped by stamp_files and stamp_filenames.
+        """
+        cursor = self.db.cursor()
+        cursor.execute("SELECT max(generation) AS generation FROM file")
+        r = cursor.fetchone()
+        cursor.close()
+        self.generation = (r["generation"] or 0) + 1
+        return self.generation
+    
+    def stamp_files(self, ids):
+        """Stamps the file entries of 'ids' with the current generation.
+        
+        The rows are committed when due, see commit().
+        """
+        cursor = self.db.cursor()
+        cursor.executemany("UPDATE file SET generation = ? WHERE id = ?", 
+                           [(self.generation, fid) for fid in ids])
+        cursor.close()
+        self._written(len(ids))
+    
+    def stamp_filenames(self, filenames):
+        """Stamps the file entries of 'filenames' with the current generation.
+        
+        The rows are committed when due, see commit().
+        """
+        cursor = self.db.cursor()
+        cursor.executemany("UPDATE file SET generation = ? WHERE filename = ?", 
+                           [(self.generation, filename) for filename in filenames])
+        cursor.close()
+        self._written(len(filenames))
+    
+    def find_swept_files(self, dirname):
+        """Retrieves the file entries under 'dirname' of an earlier generation.
+        
+        These are the files not found since the current generation started,
+        including entries never stamped. Returns a list of file objects in 
+        filename order.
+        """
+        cursor = self.db.cursor()
+        cursor.execute(OutboxStateDAO._FILE_SELECT + " WHERE filename >= ? AND filename < ? AND (generation IS NULL OR generation < ?) ORDER BY filename", 
+                       self._under(dirname) + (self.generation,))
+        found = [self._file(r) for r in cursor.fetchall()]
+        cursor.close()
+        return found
+    
+    def delete_files(self, fs):
+        """Deletes file entries, and the checkpoints of their files.
+        
+        The rows are committed when due, see commit().
+        """
+        cursor = self.db.cursor()
+        cursor.executemany("DELETE FROM file WHERE id = ?", [(f.id,) for f in fs])
+        cursor.executemany("DELETE FROM checkpoint WHERE filename = ?", 
+                           [(f.filename,) for f in fs])
+        cursor.close()
+        self._written(len(fs))
+    
+    def find_moved_file(self, f):
+        """Retrieves a checksummed file object with the same identity as 'f'.
+        
+        The identity is the device, inode, size, mtime_ns and ctime_ns of 
+        the file, as recorded by files.stat_identity. The ctime tells a 
+        reused inode from the same file, even when a copy restored the size
+        and mtime. Renaming a directory keeps the ctimes of its files, but
+        renaming a file changes its own on most Linux filesystems, so such a
+        file is hashed again. Files already superseded and files named like
+        'f' are ignored. Returns None if 'f' has no identity or no such file
+        is found.
+        """
+        if f.inode is None or f.size is None or f.mtime_ns is None or f.ctime_ns is None:
+            return None
+        found = None
+        cursor = self.db.cursor()
+        p = (f.dev, f.inode, f.size, f.mtime_ns, f.ctime_ns, f.filename)
+        cursor.execute(OutboxStateDAO._FILE_SELECT + " WHERE dev=? AND inode=? AND size=? AND mtime_ns=? AND ctime_ns=? AND filename!=? AND superseded_by IS NULL AND checksum IS NOT NULL", p)
+        r = cursor.fetchone()
+        cursor.close()
+        if r is not None:
+            found = self._file(r)
+        return found
+    
+    def update_identity(self, f):
+        """Updates the dev, inode, mtime_ns and ctime_ns of a file entry.
+        
+        The row is committed when due, see commit().
+        """
+        p = (f.dev, f.inode, f.mtime_ns, f.ctime_ns, f.id)
+        cursor = self.db.cursor()
+        cursor.execute("UPDATE file SET dev = ?, inode = ?, mtime_ns = ?, ctime_ns = ? WHERE id = ?", p)
+        cursor.close()
+        self._written(1)
+    
+    def supersede_file(self, f, filename):
+        """Marks file object 'f' as superseded by 'filename', or clears the 
+        mark if 'filename' is None.
+        
+        The row is committed when due, see commit().
+        """
+        f.superseded_by = filename
+        cursor = self.db.cursor()
+        cursor.execute("UPDATE file SET superseded_by = ? WHERE id = ?", (filename, f.id))
+        cursor.close()
+        self._written(1)
+    
+    def find_deferred_files(self, dirnames):
+        """Retrieves the files under 'dirnames' registered without a checksum.
+        
+        These are the regular files, not empty and not superseded, whose
+        checksum was deferred to after their registration. Returns a list 
+        of file objects in filename order, each file once even if 'dirnames'
+        are nested.
+        """
+        found = []
+        cursor = self.db.cursor()
+        for dirname in _outermost(dirnames):
+            cursor.execute(OutboxStateDAO._FILE_SELECT + " WHERE filename >= ? AND filename < ? AND rtime IS NOT NULL AND checksum IS NULL AND size > 0 AND superseded_by IS NULL ORDER BY filename",
+                           self._under(dirname))
+            found.extend([self._file(r) for r in cursor.fetchall()])
+        cursor.close()
+        return found
+    
+    def find_fingerprint(self, dirname):
+        """Retrieves the recorded fingerprint of a directory, or None."""
+        cursor = self.db.cursor()
+        cursor.execute("SELECT fingerprint FROM directory WHERE dirname=?", (dirname,))
+        r = cursor.fetchone()
+        cursor.close()
+        if r is not None:
+            return r["fingerprint"]
+        return None
+    
+    def save_fingerprint(self, dirname, fingerprint):
+        """Records the fingerprint of a directory whose files are all up to date.
+        
+        The row is committed when due, see commit().
+        """
+        cursor = self.db.cursor()
+        cursor.execute("INSERT OR REPLACE INTO directory (dirname, fingerprint) VALUES (?, ?)", 
+                       (dirname, fingerprint))
+        cursor.close()
+        self._written(1)
+    
+    def find_checkpoint(self, filename):
+        """Retrieves the checksum checkpoint of a file, or None."""
+        cp = None
+        cursor = self.db.cursor()
+        cursor.execute("SELECT filename, size, mtime, inode, chunksize, leaves FROM checkpoint WHERE filename=?", 
+                       (filename,))
+        r = cursor.fetchone()
+        cursor.close()
+        if r is not None:
+            leaves = json.loads(r.pop("leaves") or "{}")
+            cp = models.Checkpoint(leaves=dict([(int(i), d) for i, d in leaves.items()]), **r)
+        return cp
+    
+    def save_checkpoint(self, cp):
+        """Adds or replaces the checksum checkpoint of a file.
+        
+        The row is committed when due, see commit().
+        """
+        p = (cp.filename, cp.size, cp.mtime, cp.inode, cp.chunksize, json.dumps(cp.leaves))
+        cursor = self.db.cursor()
+        cursor.execute("INSERT OR REPLACE INTO checkpoint (filename, size, mtime, inode, chunksize, leaves) VALUES (?, ?, ?, ?, ?, ?)", p)
+        cursor.close()
+        self._written(1)
+    
+    def delete_checkpoint(self, filename):
+        """Deletes the checksum checkpoint of a file, if any.
+        
+        The row is committed when due, see commit().
+        """
+        cursor = self.db.cursor()
+        cursor.execute("DELETE FROM checkpoint WHERE filename=?", (filename,))
+        cursor.close()
+        self._written(1)
+
+
+
+def _outermost(dirnames):
+    """Returns the distinct 'dirnames', in sorted order and without a 
+    trailing '/', leaving out those under another of them."""
+    found = []
+    for d in sorted(set([d.rstrip('/') for d in dirnames])):
+        if not [o for o in found if d.startswith(o + '/')]:
+            found.append(d)
+    return found
+
+class FileIndex(object):
+    """An in-memory index of the file entries under some directories.
+    
+    The entries of OutboxStateDAO 'state' under the directories 'dirnames'
+    are read once, into records of a few dozen bytes each. The find_file 
+    method then answers like OutboxStateDAO.find_file without a query for 
+    the files under these directories, except for entries with digests, 
+    superseded entries and checksums other than SHA-256 hex digests, which
+    are looked up in the state database. The index does not follow later
+    changes to the state database.
+    
+    Before reading the entries, the memory the index needs is estimated. If
+    it exceeds 'limit' bytes, nothing is read and 'complete' is False; the
+    caller should look up files in the state database instead.
+    """
+    
+    # id, mtime, rtime, size, tree_chunksize, dev, inode, mtime_ns, ctime_ns,
+    # the bit mask of the fields that are None, and the binary checksum
+    _RECORD = struct.Struct('<qddqqqqqqH32s')
+    
+    # Estimated bytes of an entry besides its filename: the filename and
+    # record string objects, and the dictionary slots of the entry
+    ENTRY_BYTES = 2 * sys.getsizeof('') + _RECORD.size + 72
+    
+    def __init__(self, state, dirnames, limit=PRELOAD_LIMIT):
+        self._state = state
+        self._entries = {}
+        self.fallbacks = 0
+        
+        dirnames = _outermost(dirnames)
+        count = 0
+        length = 0
+        for dirname in dirnames:
+            (n, l) = state.count_files_under(dirname)
+            count += n
+            length += l
+        self.bytes = count * FileIndex.ENTRY_BYTES + length
+        self.complete = self.bytes <= limit
+        if not self.complete:
+            logger.info("State index of %d files needs about %d MB, over the limit of %d MB." % 
+                        (count, self.bytes / 1048576, limit / 1048576))
+            return
+        for dirname in dirnames:
+            for r in state.iter_files_under(dirname):
+                self._entries[FileIndex._key(r[1])] = FileIndex._pack(r)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    @staticmethod
+    def _key(filename):
+        if isinstance(filename, unicode):
+            return filename.encode('utf-8')
+        return filename
+    
+    @staticmethod
+    def _pack(r):
+        """Returns the record of row 'r', or None if it must be looked up."""
+        (fid, filename, checksum, partial) = (r[0], r[1], r[5], r[11])
+        if partial or (checksum is not None and len(checksum) != 64):
+            return None
+        values = [r[2], r[3], r[4], r[6], r[7], r[8], r[9], r[10], checksum]
+        nulls = 0
+        for i, value in enumerate(values):
+            if value is None:
+                nulls |= 1 << i
+        try:
+            digest = binascii.unhexlify(checksum) if checksum is not None else ''
+        except TypeError:
+            return None
+        return FileIndex._RECORD.pack(fid, r[2] or 0.0, r[3] or 0.0, 
+                                      *([v or 0 for v in values[2:8]] + [nulls, digest]))
+    
+    def find_file(self, filename):
+        """Returns the file object of 'filename' or None, as its entry was
+        when the index was read."""
+        record = self._entries.get(FileIndex._key(filename), False)
+        if record is False:
+            return None
+        if record is None:
+            self.fallbacks += 1
+            return self._state.find_file(filename)
+        fields = FileIndex._RECORD.unpack(record)
+        nulls = fields[9]
+        values = [None if nulls & (1 << i) else value 
+                  for i, value in enumerate(fields[1:9] + (binascii.hexlify(fields[10]),))]
+        return models.File(id=fields[0], filename=filename, mtime=values[0], 
+                           rtime=values[1], size=values[2], tree_chunksize=values[3],
+                           dev=values[4], inode=values[5], mtime_ns=values[6],
+                           ctime_ns=values[7], checksum=values[8])
+
+class MergeJoin(object):
+    """Looks up files in path order by merging them with the file entries.
+    
+    For the files under the directories 'dirnames', the find_file method 
+    answers like OutboxStateDAO.find_file, provided the files of each 
+    directory are looked up in the byte order of their filenames, as 
+    generated by files.tree_scan_sorted. Instead of a query for each file,
+    the entries of the directory are read in filename order, 'rows' at a 
+    time, alongside the lookups in one linear pass. Files under other 
+    directories or out of order are looked up in OutboxStateDAO 'state', 
+    and counted in 'fallbacks'.
+    
+    Entries passed over without a lookup are those of files no longer 
+    found, counted in 'deleted' unless they are superseded. Entries added 
+    after the merge started are not counted. Call finish() after the last
+    lookup to pass over the entries left. A directory under another of the
+    'dirnames' is merged as part of the outer one only, so that a nested 
+    root, walked again after its parent, is looked up in 'state' rather
+    than passed over.
+    """
+    
+    def __init__(self, state, dirnames, rows=MERGE_ROWS):
+        self._state = state
+        self._limit = rows
+        self._dirnames = _outermost(dirnames)
+        self._done = set()
+        self._dirname = None
+        self._rows = []
+        self._last = None
+        self._max_id = state.max_file_id()
+        self.deleted = 0
+        self.fallbacks = 0
+    
+    _key = staticmethod(FileIndex._key)
+    
+    def _dirname_of(self, key):
+        for dirname in self._dirnames:
+            if key.startswith(MergeJoin._key(dirname) + '/'):
+                return dirname
+        return None
+    
+    def _next(self):
+        """Returns the next entry of the current directory, or None."""
+        if not self._rows and not self._exhausted:
+            rows = self._state.list_files_under(self._dirname, self._after, 
+                                                self._limit)
+            self._exhausted = len(rows) < self._limit
+            if rows:
+                self._after = rows[-1].filename
+            rows.reverse()
+            self._rows = rows
+        if self._rows:
+            return self._rows[-1]
+        return None
+    
+    def _pass(self, key=None):
+        """Passes over the entries before 'key', or all that are left."""
+        while True:
+            f = self._next()
+            if f is None or (key is not None and MergeJoin._key(f.filename) >= key):
+                return f
+            self._rows.pop()
+            if f.id <= self._max_id and f.superseded_by is None:
+                self.deleted += 1
+    
+    def _start(self, dirname):
+        """Starts reading the entries of 'dirname'."""
+        self._done.add(dirname)
+        self._dirname = dirname
+        self._rows = []
+        self._after = None
+        self._exhausted = False
+        self._last = None
+    
+    def find_file(self, filename):
+        """Returns the file object of 'filename' or None."""
+        key = MergeJoin._key(filename)
+        dirname = self._dirname_of(key)
+        if dirname != self._dirname:
+            if dirname is None or dirname in self._done:
+                self.fallbacks += 1
+                return self._state.find_file(filename)
+            if self._dirname is not None:
+                self._pass()
+            self._start(dirname)
+        if self._last is not None and key <= self._last:
+            self.fallbacks += 1
+            return self._state.find_file(filename)
+        self._last = key
+        f = self._pass(key)
+        if f is not None and MergeJoin._key(f.filename) == key:
+            self._rows.pop()
+            return f
+        return None
+    
+    def finish(self):
+        """Passes over the entries left under all directories."""
+        if self._dirname is not None:
+            self._pass()
+        for dirname in self._dirnames:
+            if dirname not in self._done:
+                self._start(dirname)
+                self._pass()
+        self._dirname = None
@@ -23,6 +23,7 @@ class Outbox(object):
     def __init__(self, **kwargs):
         self.name = kwargs.get("name")
         self.state_db = kwargs.get("state_db")
+        self.state_profile = kwargs.get("state_profile", "safe")
         self.bulk_ops_max = kwargs.get("bulk_ops_max")
         self.endpoint_name = kwargs.get("endpoint_name")
         self.url = kwargs.get("url")
@@ -30,8 +31,32 @@ class Outbox(object):
         self.password = kwargs.get("password")
         self.goauthtoken = kwargs.get("goauthtoken")
         self.roots = kwargs.get("roots", [])
+        self.listings = kwargs.get("listings", [])
         self.includes = kwargs.get("includes", [])
         self.excludes = kwargs.get("excludes", [])
+        self.prune = kwargs.get("prune", False)
+        self.scan_threads = kwargs.get("scan_threads", 1)
+        self.preload_names = kwargs.get("preload_names", False)
+        self.preload_state = kwargs.get("preload_state", False)
+        self.preload_limit = kwargs.get("preload_limit", 1024)
+        self.checksum_blocksize = kwargs.get("checksum_blocksize")
+        self.checksum_mmap = kwargs.get("checksum_mmap", False)
+        self.prefetch_files = kwargs.get("prefetch_files", 0)
+        self.drop_behind = kwargs.get("drop_behind", False)
+        self.lazy_checksums = kwargs.get("lazy_checksums", False)
+        self.checksum_providers = kwargs.get("checksum_providers", [])
+        self.xattr_writeback = kwargs.get("xattr_writeback", False)
+        self.digests = kwargs.get("digests", [])
+        self.checksum_workers = kwargs.get("checksum_workers", 1)
+        self.device_workers = kwargs.get("device_workers", {})
+        self.schedule_window = kwargs.get("schedule_window", 0)
+        self.schedule_order = kwargs.get("schedule_order", "inode")
+        self.tree_chunksize = kwargs.get("tree_chunksize")
+        self.tree_threads = kwargs.get("tree_threads", 4)
+        self.change_policy = kwargs.get("change_policy", "mtime")
+        self.dir_fingerprints = kwargs.get("dir_fingerprints", False)
+        self.reconcile = kwargs.get("reconcile", False)
+        self.sweep_deleted = kwargs.get("sweep_deleted", False)
         self.path_rules = kwargs.get("path_rules", [])
         self.line_rules = kwargs.get("line_rules", [])
         self.dicom_rules = kwargs.get("dicom_rules", [])
@@ -110,6 +135,8 @@ class File(object):
     COMPUTE     = 0
     COMPARE     = 1
     REGISTER    = 2
+    BACKFILL    = 3     # registered earlier, its deferred checksum is computed
+    DELETE      = 4     # no longer found, unregistered and its entry deleted
     
     def __init__(self, **kwargs):
         self.id = kwargs.get("id")
@@ -118,11 +145,20 @@ class File(object):
         self.rtime = kwargs.get("rtime")
         self.size = kwargs.get("size")
         self.checksum = kwargs.get("checksum")
+        self.tree_chunksize = kwargs.get("tree_chunksize")
+        self.dev = kwargs.get("dev")
+        self.inode = kwargs.get("inode")
+        self.mtime_ns = kwargs.get("mtime_ns")
+        self.ctime_ns = kwargs.get("ctime_ns")
+        self.superseded_by = kwargs.get("superseded_by")
+        self.digests = kwargs.get("digests", {})
         self.username = kwargs.get("username")
         self.groupname = kwargs.get("groupname")
         self.tags = kwargs.get("tags", [])
         self.content_tags = kwargs.get("content_tags", [])
         self.status = kwargs.get("status")
+        # Registers only the name and checksum tags of an earlier registration
+        self.checksum_only = kwargs.get("checksum_only", False)
         
     def filter_tags(self, name):
         return [tag for tag in self.tags if tag.name == name]
@@ -138,6 +174,54 @@ class File(object):
         return s
 
 
+class Listing(object):
+    """Represents a pre-generated listing of the tree at 'root'.
+    
+    The 'filename' is the listing file, see files.listing_scan_dirs.
+    """
+    
+    def __init__(self, **kwargs):
+        self.root = kwargs.get("root")
+        self.filename = kwargs.get("filename")
+
+
+class Directory(object):
+    """Represents a scanned directory.
+    
+    The 'fingerprint' summarizes the stats of its 'count' members, see 
+    files.dir_fingerprint, or is None for members read from a listing. 
+    When 'skipped' is true, the fingerprint matched
+    the one recorded in the state database and its members were skipped;
+    their 'filenames' are then given instead. When 'failed' is true, the
+    directory could not be listed, or not whole.
+    """
+    
+    def __init__(self, **kwargs):
+        self.dirname = kwargs.get("dirname")
+        self.fingerprint = kwargs.get("fingerprint")
+        self.count = kwargs.get("count", 0)
+        self.skipped = kwargs.get("skipped", False)
+        self.filenames = kwargs.get("filenames", [])
+        self.failed = kwargs.get("failed", False)
+
+
+class Checkpoint(object):
+    """Represents the progress of a file's tree checksum.
+    
+    The 'leaves' are the hex digests of the chunks hashed so far, by chunk 
+    index. They are only valid while the file's size, mtime and inode are
+    unchanged.
+    """
+    
+    def __init__(self, **kwargs):
+        self.filename = kwargs.get("filename")
+        self.size = kwargs.get("size")
+        self.mtime = kwargs.get("mtime")
+        self.inode = kwargs.get("inode")
+        self.chunksize = kwargs.get("chunksize")
+        self.leaves = kwargs.get("leaves", {})
+
+
 class Tag(object):
     """Represents a Tag."""
     
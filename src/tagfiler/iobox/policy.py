@@ -0,0 +1,149 @@
+#
+# Copyright 2010 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Change-detection policies, deciding whether a file seen before has changed.
+"""
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of ChangePolicy.check
+UNCHANGED = 0   # the file is unchanged
+HASH = 1        # the file may have changed, compare its checksum
+REGISTER = 2    # the file has changed, register it and defer its checksum
+
+
+def _check_mtime(f, exists):
+    if f.mtime > exists.mtime:
+        return HASH
+    return UNCHANGED
+
+
+class ChangePolicy(object):
+    """Base class of the change-detection policies.
+
+    The check(f, exists) method compares File 'f' from the scan with the
+    File 'exists' from the state database and returns one of UNCHANGED,
+    HASH or REGISTER.
+    """
+
+    name = None
+
+    def check(self, f, exists):
+        raise NotImplementedError()
+
+
+class MtimePolicy(ChangePolicy):
+    """Hashes files with a later modification time (the default)."""
+
+    name = 'mtime'
+
+    def check(self, f, exists):
+        return _check_mtime(f, exists)
+
+
+class ParanoidPolicy(ChangePolicy):
+    """Always hashes files, and directories with a later modification time."""
+
+    name = 'paranoid'
+
+    def check(self, f, exists):
+        if f.size is None:
+            return _check_mtime(f, exists)
+        return HASH
+
+
+class StatPolicy(ChangePolicy):
+    """Hashes files with a different size, mtime_ns, ctime_ns or inode.
+
+    Files recorded before their identity was stored fall back to the mtime
+    policy.
+    """
+
+    name = 'stat'
+
+    def check(self, f, exists):
+        if exists.mtime_ns is None:
+            return _check_mtime(f, exists)
+        if (f.size, f.mtime_ns, f.ctime_ns, f.dev, f.inode) != \
+                (exists.size, exists.mtime_ns, exists.ctime_ns, exists.dev, exists.inode):
+            return HASH
+        return UNCHANGED
+
+
+class TrustSizePolicy(ChangePolicy):
+    """Registers files with a different size, deferring their checksum.
+
+    Files of the same size are taken to be unchanged.
+    """
+
+    name = 'trust-size'
+
+    def check(self, f, exists):
+        if f.size != exists.size:
+            return REGISTER
+        return UNCHANGED
+
+
+# Change-detection policies by name
+POLICIES = dict([ (p.name, p) for p in
+                  [MtimePolicy, ParanoidPolicy, StatPolicy, TrustSizePolicy] ])
+
+
+class ChangeDetector(object):
+    """Applies a change-detection policy and counts the hashes it avoids.
+
+    Every file is checked against all policies, so that the hashes each of
+    them would have avoided, compared to always hashing, can be reported
+    after a run. Only UNCHANGED outcomes avoid a hash; a REGISTER outcome 
+    only defers it to the backfill pass.
+    """
+
+    def __init__(self, name='mtime'):
+        """Initializes the detector with the policy 'name'.
+
+        Raises ValueError if 'name' is not one of POLICIES.
+        """
+        if name not in POLICIES:
+            raise ValueError("Unsupported change policy: %s" % name)
+        self.name = name
+        self._policies = dict([ (n, p()) for n, p in POLICIES.items() ])
+        self.checked = 0
+        self.hashes = dict([ (n, 0) for n in POLICIES ])
+
+    def check(self, f, exists):
+        """Returns the outcome of the policy for 'f' and its state 'exists'."""
+        self.checked += 1
+        outcome = None
+        for n, p in self._policies.items():
+            result = p.check(f, exists)
+            if result != UNCHANGED:
+                self.hashes[n] += 1
+            if n == self.name:
+                outcome = result
+        return outcome
+
+    def avoided(self):
+        """Returns a dictionary of the hashes avoided, by policy name."""
+        return dict([ (n, self.checked - h) for n, h in self.hashes.items() ])
+
+    def summary(self):
+        """Returns a one-line summary of the hashes avoided."""
+        avoided = self.avoided()
+        return "Change policy=%s: hashes avoided %s" % \
+            (self.name, ' '.join([ '%s=%d' % (n, avoided[n]) for n in sorted(avoided) ]))
@@ -5,7 +5,34 @@ CREATE TABLE IF NOT EXISTS file (
     rtime FLOAT8,
     size INTEGER,
     checksum TEXT,
+    tree_chunksize INTEGER,
+    sha256 TEXT,
+    md5 TEXT,
+    sha1 TEXT,
+    blake2b TEXT,
+    crc32 TEXT,
+    adler32 TEXT,
     username TEXT,
     groupname TEXT,
+    dev INTEGER,
+    inode INTEGER,
+    mtime_ns INTEGER,
+    ctime_ns INTEGER,
+    superseded_by TEXT,
+    generation INTEGER,
     must_tag BOOLEAN NOT NULL DEFAULT true
+);
+
+CREATE TABLE IF NOT EXISTS checkpoint (
+    filename TEXT NOT NULL PRIMARY KEY,
+    size INTEGER,
+    mtime FLOAT8,
+    inode INTEGER,
+    chunksize INTEGER,
+    leaves TEXT
+);
+
+CREATE TABLE IF NOT EXISTS directory (
+    dirname TEXT NOT NULL PRIMARY KEY,
+    fingerprint TEXT
 );
\ No newline at end of file
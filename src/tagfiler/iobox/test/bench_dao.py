@@ -0,0 +1,160 @@
+#
+# Copyright 2010 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks for the dao module.
+
+Run as 'python -m tagfiler.iobox.test.bench_dao [ROWS [PROFILE ...]]'. A
+synthetic state database of ROWS files, 10 million by default, is built once
+in a temporary directory and copied for each durability profile, all of them
+by default. Set TMPDIR to benchmark another filesystem, such as a network
+home directory. Lookups through a preloaded FileIndex are compared last.
+"""
+
+from tagfiler.iobox.dao import OutboxStateDAO, FileIndex, PROFILES
+from tagfiler.iobox.models import File
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Number of files in the synthetic state database
+ROWS = 10000000
+
+
+def synthetic_file(i):
+    """Returns the synthetic File number 'i', 1000 of them per directory."""
+    return File(filename='/data/d%05d/f%09d.dat' % (i / 1000, i),
+                mtime=1300000000.0 + i, size=i % 65536 + 1,
+                checksum='%064x' % i, username='user', groupname='group',
+                dev=2049, inode=i + 100, mtime_ns=(1300000000 + i) * 1000000000,
+                ctime_ns=(1300000000 + i) * 1000000000)
+
+
+def build_state_db(path, rows, batch=100000):
+    """Creates a state database at 'path' holding 'rows' synthetic files."""
+    state = OutboxStateDAO(path, commit_rows=batch, profile='fast')
+    for start in range(0, rows, batch):
+        state.add_files([synthetic_file(i) for i in range(start, min(start + batch, rows))])
+    state.close()
+    # leave a database without a write-ahead log for copying
+    OutboxStateDAO(path).close()
+
+
+def _rate(count, func):
+    start = time.time()
+    func()
+    return count / max(time.time() - start, 1e-6)
+
+
+def bench_profile(path, profile, rows, single=2000, count=100000):
+    """Reports the rows per second of writes and lookups under 'profile'.
+
+    Files are added one commit at a time with add_file and in group commits
+    with add_files, looked up by name in random order with find_file, and
+    registered in group commits with update_files.
+    """
+    state = OutboxStateDAO(path, profile=profile)
+    added = [synthetic_file(i) for i in range(rows, rows + single)]
+    def add_single():
+        for f in added:
+            state.add_file(f)
+    batched = [synthetic_file(i) for i in range(rows + single, rows + single + count)]
+    def add_batched():
+        for start in range(0, count, 1000):
+            state.add_files(batched[start:start + 1000])
+        state.commit()
+    random.seed(0)
+    names = [synthetic_file(random.randrange(rows)).filename for i in range(count)]
+    def find():
+        for name in names:
+            state.find_file(name)
+    def update_batched():
+        for f in batched:
+            f.rtime = time.time()
+        for start in range(0, count, 1000):
+            state.update_files(batched[start:start + 1000])
+        state.commit()
+    results = [('add_file', _rate(single, add_single)),
+               ('add_files', _rate(count, add_batched)),
+               ('find_file', _rate(count, find)),
+               ('update_files', _rate(count, update_batched))]
+    state.close()
+    print "  %-8s %s" % (profile, ' '.join(['%s=%.0f/s' % r for r in results]))
+
+
+def _rss():
+    """Returns the resident memory of this process in bytes, or 0."""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def bench_index(path, rows, count=100000):
+    """Reports the preload time and memory of a FileIndex of all files, and 
+    the lookups per second through it and through the state database."""
+    state = OutboxStateDAO(path)
+    rss = _rss()
+    start = time.time()
+    index = FileIndex(state, ['/data'], limit=sys.maxint)
+    elapsed = time.time() - start
+    rss = _rss() - rss
+    random.seed(0)
+    names = [synthetic_file(random.randrange(rows)).filename for i in range(count)]
+    def find(lookup):
+        for name in names:
+            lookup.find_file(name)
+    print "File index of %d files: preload=%.1fs estimated=%.0f MB rss=%.0f MB" % \
+        (len(index), elapsed, index.bytes / 1048576.0, rss / 1048576.0)
+    print "  find_file state=%.0f/s index=%.0f/s" % \
+        (_rate(count, lambda: find(state)), _rate(count, lambda: find(index)))
+    state.close()
+
+
+def main(argv):
+    rows = int(argv[0]) if argv else ROWS
+    profiles = argv[1:] or ['safe', 'balanced', 'fast']
+    tmpdir = tempfile.mkdtemp()
+    try:
+        template = os.path.join(tmpdir, 'template.db')
+        start = time.time()
+        build_state_db(template, rows)
+        print "State database of %d files (built in %.0fs, %.0f MB, in %s)" % \
+            (rows, time.time() - start, os.path.getsize(template) / 1048576.0, tmpdir)
+        for profile in profiles:
+            assert profile in PROFILES
+            path = os.path.join(tmpdir, '%s.db' % profile)
+            shutil.copy(template, path)
+            bench_profile(path, profile, rows)
+            os.remove(path)
+        bench_index(template, rows)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    main(sys.argv[1:])
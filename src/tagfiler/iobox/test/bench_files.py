@@ -0,0 +1,347 @@
+#
+# Copyright 2010 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Benchmarks for the files module.
+
+Run as 'python -m tagfiler.iobox.test.bench_files [benchmark ...]'. With no
+arguments all benchmarks are run against a temporary directory tree.
+"""
+
+from tagfiler.util import files
+import base
+
+import os
+import sys
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyscallCounter(object):
+    """Counts directory listing and stat calls made through the os module.
+
+    Calls made by directory entries returned from scandir are counted by
+    wrapping the scandir function used by the files module.
+    """
+
+    _NAMES = ['stat', 'lstat', 'listdir']
+
+    def __init__(self):
+        self.counts = dict([(name, 0) for name in SyscallCounter._NAMES])
+        self.counts['scandir'] = 0
+        self._saved = {}
+
+    def _wrap(self, name, func):
+        def counted(*args, **kwargs):
+            self.counts[name] += 1
+            return func(*args, **kwargs)
+        return counted
+
+    def install(self):
+        for name in SyscallCounter._NAMES:
+            self._saved[name] = getattr(os, name)
+            setattr(os, name, self._wrap(name, self._saved[name]))
+        self._saved['scandir'] = files._scandir
+        if files._scandir is not None:
+            counter = self
+            class CountedEntry(object):
+                def __init__(self, entry):
+                    self._entry = entry
+                    self.name = entry.name
+                    self.path = entry.path
+                    self._stats = {}
+                def is_dir(self, follow_symlinks=True):
+                    return self._entry.is_dir(follow_symlinks=follow_symlinks)
+                def stat(self, follow_symlinks=True):
+                    # scandir caches stat results, so count only the first
+                    # call for each variant (lstat is free for non-links)
+                    if follow_symlinks not in self._stats:
+                        self._stats[follow_symlinks] = True
+                        counter.counts['stat' if follow_symlinks else 'lstat'] += 1
+                    return self._entry.stat(follow_symlinks=follow_symlinks)
+            def counted_scandir(path):
+                counter.counts['scandir'] += 1
+                for entry in self._saved['scandir'](path):
+                    yield CountedEntry(entry)
+            files._scandir = counted_scandir
+
+    def uninstall(self):
+        for name in SyscallCounter._NAMES:
+            setattr(os, name, self._saved[name])
+        files._scandir = self._saved['scandir']
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def legacy_exclude_name(name, relpath, excludes, includes):
+    """The per-pattern filter of the os.walk based scanner."""
+    drop = False
+    for p in excludes:
+        if p.search(name) or p.search('%s%s%s' % (relpath, os.path.sep, name)):
+            drop = True
+    for p in includes:
+        if p.search(name) or p.search('%s%s%s' % (relpath, os.path.sep, name)):
+            drop = False
+    return drop
+
+
+def legacy_tree_scan_stats(top, excludes=[], includes=[]):
+    """The os.walk based scanner, kept as the reference for benchmarks."""
+
+    def stats(dirpath, relpath, name):
+        path = '%s%s%s' % (dirpath, os.path.sep, name)
+        rpath = '%s%s%s' % (relpath, os.path.sep, name)
+        try:
+            s = os.stat(path)
+            size = None if os.path.isdir(path) else s.st_size
+        except OSError:
+            s = os.lstat(path)
+            size = None
+        return (rpath, size, s.st_mtime, files.uid2uname(s.st_uid),
+                files.gid2gname(s.st_gid))
+
+    for dirpath, dirnames, filenames in os.walk(top, topdown=False):
+        relpath = dirpath[len(top):]
+        for name in filenames + dirnames:
+            if not legacy_exclude_name(name, relpath, excludes, includes):
+                yield stats(dirpath, relpath, name)
+
+
+def bench_scan_syscalls(rootdir):
+    """Reports syscalls per tree member for the legacy and current scanner."""
+    print "Scan syscalls per member (scandir: %s)" % (files._scandir is not None)
+    for label, scan in [('os.walk', legacy_tree_scan_stats),
+                        ('tree_scan_stats', files.tree_scan_stats)]:
+        counter = SyscallCounter()
+        counter.install()
+        try:
+            start = time.time()
+            members = len(list(scan(rootdir)))
+            elapsed = time.time() - start
+        finally:
+            counter.uninstall()
+        print "  %-16s members=%d calls=%d per-member=%.2f %s (%.3fs)" % \
+            (label, members, counter.total(),
+             float(counter.total()) / max(members, 1), counter.counts, elapsed)
+
+
+# A pattern list in the style of a large outbox.conf
+MATCHER_EXCLUDES = ['~$', '^\\.svn', '^\\.git$', '^CVS$', '\\.snapshot', '^/scratch',
+                    '^/tmp', '\\.swp$', '\\.tmp$', '\\.bak$', '\\.pyc$', '^\\.DS_Store$',
+                    '^Thumbs\\.db$', '^core\\.[0-9]+$', '\\.lock$', '^#.*#$', '\\.part$',
+                    '^/archive/old', '\\.o$', '\\.so$', '^\\.nfs', '/cache/', '\\.log$',
+                    '^/incoming/partial', '\\.crdownload$', '^~\\$', '\\.orig$', '\\.rej$',
+                    '^/proc', '^/sys', '\\.trash', '^\\.Trash-[0-9]+$', '\\.DAV$',
+                    '^lost\\+found$', '\\.idx\\.tmp$', '^/work/[^/]+/scratch',
+                    '_(?:copy|backup)\\.[a-z]+$', '^\\.~lock\\.', '\\.pid$', '\\.sock$']
+MATCHER_INCLUDES = ['^keep\\.', '\\.dcm$', 'README']
+
+
+def bench_matcher(rootdir, count=20000):
+    """Reports exclusion filter throughput for legacy_exclude_name and PathMatcher."""
+    import re
+    excludes = [ re.compile(p) for p in MATCHER_EXCLUDES ]
+    includes = [ re.compile(p) for p in MATCHER_INCLUDES ]
+    names = [ ('/study%d/session%d' % (i % 7, i % 13),
+               ['scan%d.dcm', 'scan%d.nii.gz', 'notes%d.txt~', '.svn%d',
+                'core.%d', 'data%d.tmp', 'keep.%d.tmp', 'image%d.raw'][i % 8] % i)
+              for i in range(count) ]
+    matcher = files.PathMatcher(excludes, includes)
+    
+    start = time.time()
+    legacy = [ legacy_exclude_name(name, relpath, excludes, includes)
+               for relpath, name in names ]
+    legacy_elapsed = time.time() - start
+    
+    start = time.time()
+    compiled = [ matcher.excluded(name, relpath) for relpath, name in names ]
+    compiled_elapsed = time.time() - start
+    
+    assert legacy == compiled
+    print "Exclusion filter with %d excludes, %d includes, %d names (%d excluded)" % \
+        (len(excludes), len(includes), count, compiled.count(True))
+    for label, elapsed in [('exclude_name', legacy_elapsed),
+                           ('PathMatcher', compiled_elapsed)]:
+        print "  %-16s %.3fs %.1f us/name" % (label, elapsed, elapsed * 1e6 / count)
+
+
+def legacy_sha256sum(fpath):
+    """The 4096 byte read loop of the original sha256sum."""
+    import hashlib
+    h = hashlib.sha256()
+    f = open(fpath, 'rb')
+    try:
+        b = f.read(4096)
+        while b:
+            h.update(b)
+            b = f.read(4096)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
+def bench_hash(rootdir, sizes_mb=[1, 16, 128]):
+    """Reports sha256sum throughput in MB/s for several file sizes.
+    
+    Files are hashed once before timing so that all variants read from the
+    page cache and the figures reflect the hashing path itself.
+    """
+    print "sha256sum throughput (MB/s, warm cache)"
+    variants = [('read(4096)', legacy_sha256sum),
+                ('readinto 1MB', lambda p: files.sha256sum(p, 1024 * 1024)),
+                ('readinto 4MB', lambda p: files.sha256sum(p)),
+                ('readinto 8MB', lambda p: files.sha256sum(p, 8 * 1024 * 1024)),
+                ('mmap 4MB', lambda p: files.sha256sum(p, use_mmap=True))]
+    block = os.urandom(1024 * 1024)
+    for size_mb in sizes_mb:
+        fpath = os.path.join(rootdir, 'hash-%dMB' % size_mb)
+        f = open(fpath, 'wb')
+        for i in range(size_mb):
+            f.write(block)
+        f.close()
+        expected = legacy_sha256sum(fpath)
+        results = []
+        for label, func in variants:
+            start = time.time()
+            assert func(fpath) == expected
+            elapsed = time.time() - start
+            results.append('%s=%.0f' % (label, size_mb / max(elapsed, 1e-6)))
+        print "  %4dMB: %s" % (size_mb, ', '.join(results))
+        os.remove(fpath)
+
+
+def bench_tree_hash(rootdir, size_mb=512, chunk_mb=16):
+    """Reports sha256sum and tree_digest throughput in MB/s for one file."""
+    fpath = os.path.join(rootdir, 'tree-%dMB' % size_mb)
+    block = os.urandom(1024 * 1024)
+    f = open(fpath, 'wb')
+    for i in range(size_mb):
+        f.write(block)
+    f.close()
+    try:
+        files.sha256sum(fpath)
+        print "Tree digest throughput, %dMB file, %dMB chunks (MB/s, warm cache)" % \
+            (size_mb, chunk_mb)
+        variants = [('sha256sum', lambda: files.sha256sum(fpath))] + \
+                   [('tree %d threads' % n, 
+                     lambda n=n: files.tree_digest(fpath, chunk_mb * 1024 * 1024, n))
+                    for n in [1, 2, 4, 8]]
+        for label, func in variants:
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            print "  %-16s %.0f" % (label, size_mb / max(elapsed, 1e-6))
+    finally:
+        os.remove(fpath)
+
+
+def bench_flat_dir(rootdir, count=200000):
+    """Reports the time to the first and all members of one flat directory."""
+    flat = os.path.join(rootdir, 'flat')
+    os.mkdir(flat)
+    for i in range(count):
+        open(os.path.join(flat, 'f%07d' % i), 'w').close()
+    print "Flat directory of %d files (scandir: %s, batch: %d)" % \
+        (count, files._scandir is not None, files.SCAN_BATCH)
+    for threads in [1, 4]:
+        start = time.time()
+        first = None
+        parts = 0
+        largest = 0
+        for relpath, fingerprint, stats in files.tree_scan_dirs(flat, threads=threads):
+            if first is None:
+                first = time.time() - start
+            parts += 1
+            largest = max(largest, len(stats))
+        elapsed = time.time() - start
+        print "  %d threads: first=%.3fs total=%.3fs parts=%d largest=%d" % \
+            (threads, first, elapsed, parts, largest)
+
+
+def drop_caches():
+    """Drops the page cache, returning False where that is not permitted."""
+    try:
+        os.system('sync')
+        f = open('/proc/sys/vm/drop_caches', 'w')
+        f.write('3\n')
+        f.close()
+        return True
+    except IOError:
+        return False
+
+
+def bench_read_order(rootdir, count=400, size_kb=1024):
+    """Reports sha256sum throughput in MB/s for files read in several orders.
+    
+    The files are read in the order they are found, in (dev, inode) order 
+    and in the order of their first physical extent, as scheduled by the 
+    Outbox with the 'inode' and 'extent' schedule orders.
+    """
+    block = os.urandom(size_kb * 1024)
+    for i in range(count):
+        d = os.path.join(rootdir, 'order%d' % (i % 16))
+        if not os.path.isdir(d):
+            os.mkdir(d)
+        f = open(os.path.join(d, 'f%d' % (i * 7919 % count)), 'wb')
+        f.write(block)
+        f.close()
+    found = [ rootdir + t[0] for t in files.tree_scan_stats(rootdir) 
+              if t[1] == size_kb * 1024 ]
+    def identity(fpath):
+        s = os.stat(fpath)
+        return (s.st_dev, s.st_ino)
+    def extent(fpath):
+        e = files.first_extent(fpath)
+        return (identity(fpath)[0], e is None, e, identity(fpath)[1])
+    orders = [('found', found),
+              ('inode', sorted(found, key=identity)),
+              ('extent', sorted(found, key=extent))]
+    cold = drop_caches()
+    print "Read order throughput, %d files of %dKB (MB/s, %s cache)" % \
+        (len(found), size_kb, 'cold' if cold else 'warm')
+    for label, ordered in orders:
+        drop_caches()
+        start = time.time()
+        for fpath in ordered:
+            files.sha256sum(fpath)
+        elapsed = time.time() - start
+        print "  %-8s %.0f" % (label, len(ordered) * size_kb / 1024.0 / max(elapsed, 1e-6))
+
+
+BENCHMARKS = {'scan_syscalls': bench_scan_syscalls,
+              'flat_dir': bench_flat_dir,
+              'matcher': bench_matcher,
+              'hash': bench_hash,
+              'tree_hash': bench_tree_hash,
+              'read_order': bench_read_order}
+
+
+def main(argv):
+    names = argv or sorted(BENCHMARKS.keys())
+    rootdirs = base.create_temp_dirtree(1, 20, 100)
+    try:
+        for name in names:
+            BENCHMARKS[name](rootdirs[0])
+    finally:
+        base.remove_temp_dirtree(rootdirs)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    main(sys.argv[1:])
@@ -18,7 +18,8 @@ All unit tests coverage.
 """
 
 import test_worker, test_rules, test_files, test_http
-import test_find, test_tag, test_register
+import test_find, test_tag, test_register, test_dao, test_policy, test_schedule, test_device
+import test_dispatcher, test_cksum
 
 import unittest
 import logging
@@ -37,6 +38,12 @@ def all_tests():
     suite.addTest(test_files.all_tests())
     suite.addTest(test_http.all_tests())
     suite.addTest(test_register.all_tests())
+    suite.addTest(test_dao.all_tests())
+    suite.addTest(test_policy.all_tests())
+    suite.addTest(test_schedule.all_tests())
+    suite.addTest(test_device.all_tests())
+    suite.addTest(test_dispatcher.all_tests())
+    suite.addTest(test_cksum.all_tests())
     # New test suites should be added here...
     return suite
 
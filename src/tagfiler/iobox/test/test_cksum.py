@@ -0,0 +1,102 @@
+#
+# Copyright 2010 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Unit tests for the cksum module.
+"""
+
+from tagfiler.iobox.threaded import worker, outbox
+from tagfiler.iobox.threaded.cksum import Checksum
+from tagfiler.iobox.models import File
+from tagfiler.util import files
+
+import unittest
+import logging
+import tempfile
+import shutil
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def all_tests():
+    """Returns a TestSuite that includes all test cases in this module."""
+    suite = unittest.TestSuite()
+    suite.addTest(ChecksumPoolTest())
+    return suite
+
+
+class SlowChecksum(Checksum):
+    """A Checksum worker taking longer over each file."""
+
+    def do_work(self, task, work_done):
+        if isinstance(task, File):
+            time.sleep(0.05)
+        super(SlowChecksum, self).do_work(task, work_done)
+
+
+class ChecksumPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filenames = []
+        for i in range(12):
+            filename = os.path.join(self.tempdir, 'f%d' % i)
+            f = open(filename, 'w')
+            f.write('f%d' % i)
+            f.close()
+            self.filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def runTest(self):
+        """The SUM_DONE marker follows the results of all workers sharing a queue."""
+        tasks = worker.WorkQueue()
+        results = worker.WorkQueue()
+        sums = [SlowChecksum(tasks, results) for i in range(4)]
+        for w in sums:
+            w.start()
+        for filename in self.filenames:
+            tasks.put(File(filename=filename, size=os.path.getsize(filename),
+                           status=File.COMPUTE))
+        tasks.put(outbox.Outbox._SUM_DONE)
+
+        received = [results.get(timeout=5) for i in range(len(self.filenames) + 1)]
+        time.sleep(0.2)
+        self.assertTrue(results.empty())
+        self.assertTrue(received[-1] is outbox.Outbox._SUM_DONE)
+        self.assertEqual([r for r in received if r is outbox.Outbox._SUM_DONE],
+                         [outbox.Outbox._SUM_DONE])
+        self.assertEqual(sorted([f.filename for f in received[:-1]]),
+                         sorted(self.filenames))
+        for f in received[:-1]:
+            self.assertEqual(f.checksum, files.sha256sum(f.filename))
+
+        # the files were shared out among the workers
+        self.assertEqual(sum([w.files for w in sums]), len(self.filenames))
+        self.assertTrue(len([w for w in sums if w.files]) > 1)
+
+        for w in sums:
+            w.terminate()
+        for w in sums:
+            w.join()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
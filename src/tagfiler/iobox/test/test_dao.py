@@ -0,0 +1,417 @@
+# 
+# Copyright 2010 University of Southern California
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Unit tests for the dao module.
+"""
+
+from tagfiler.iobox.dao import OutboxStateDAO, FileIndex, MergeJoin, PROFILES
+from tagfiler.iobox.models import File, Checkpoint
+from tagfiler.iobox.checkpoint import ChecksumCheckpoint
+
+import unittest
+import logging
+import tempfile
+import shutil
+import sqlite3
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def all_tests():
+    """Returns a TestSuite that includes all test cases in this module."""
+    suite = unittest.TestSuite()
+    suite.addTest(FileStateTest())
+    suite.addTest(BatchedWriteTest())
+    suite.addTest(ProfileTest())
+    suite.addTest(SchemaUpgradeTest())
+    suite.addTest(FreshSchemaTest())
+    suite.addTest(CheckpointTest())
+    suite.addTest(MovedFileTest())
+    suite.addTest(DeferredFileTest())
+    suite.addTest(FileIndexTest())
+    suite.addTest(MergeJoinTest())
+    suite.addTest(GenerationSweepTest())
+    suite.addTest(DirectoryFingerprintTest())
+    return suite
+
+
+class StateDBTestCase(unittest.TestCase):
+    """Base class for test cases using a temporary state database."""
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.state_db = os.path.join(self.tempdir, 'state.db')
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+class FileStateTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Round trip of a file entry through the state database."""
+        state = OutboxStateDAO(self.state_db)
+        f = File(filename='/data/a.txt', mtime=1.5, size=5, checksum='abc',
+                 username='demo', groupname='demo', digests={'md5': 'def'})
+        state.add_file(f)
+        self.assertTrue(f.id)
+        
+        found = state.find_file('/data/a.txt')
+        self.assertEqual((found.id, found.mtime, found.size, found.checksum),
+                         (f.id, 1.5, 5, 'abc'))
+        self.assertEqual(found.digests, {'md5': 'def'})
+        
+        found.rtime = 2.5
+        found.digests['crc32'] = '01234567'
+        state.update_file(found)
+        found = state.find_file('/data/a.txt')
+        self.assertEqual(found.rtime, 2.5)
+        self.assertEqual(found.digests, {'md5': 'def', 'crc32': '01234567'})
+        self.assertEqual(found.tree_chunksize, None)
+        
+        found.checksum = 'fed'
+        found.tree_chunksize = 4096
+        found.digests['sha256'] = 'abc'
+        state.update_file(found)
+        found = state.find_file('/data/a.txt')
+        self.assertEqual((found.checksum, found.tree_chunksize, found.digests['sha256']),
+                         ('fed', 4096, 'abc'))
+        
+        self.assertEqual(state.find_file('/data/missing.txt'), None)
+        state.close()
+
+
+class BatchedWriteTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Batched writes are committed by row count, by age and on close."""
+        state = OutboxStateDAO(self.state_db, commit_rows=3, commit_seconds=3600)
+        other = OutboxStateDAO(self.state_db)
+        fs = [File(filename='/data/%d.txt' % i, mtime=1.5, size=i) for i in range(3)]
+        state.add_files(fs[:2])
+        self.assertEqual([f.id is not None for f in fs[:2]], [True, True])
+        self.assertEqual(state.find_file('/data/1.txt').size, 1)
+        self.assertEqual(other.find_file('/data/1.txt'), None)
+        state.add_files(fs[2:])
+        self.assertEqual(other.find_file('/data/2.txt').id, fs[2].id)
+        
+        for f in fs:
+            f.rtime = 2.0
+        state.update_files(fs[:1])
+        self.assertEqual(other.find_file('/data/0.txt').rtime, None)
+        state.commit(False)
+        self.assertEqual(other.find_file('/data/0.txt').rtime, None)
+        state.update_files(fs[1:2])
+        state.close()
+        self.assertEqual([other.find_file(f.filename).rtime for f in fs], [2.0, 2.0, None])
+        
+        # writes older than 'commit_seconds' are committed with the next one
+        state = OutboxStateDAO(self.state_db, commit_rows=1000, commit_seconds=0)
+        state.update_files(fs[2:])
+        self.assertEqual(other.find_file('/data/2.txt').rtime, 2.0)
+        state.close()
+        other.close()
+
+
+class ProfileTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Each durability profile sets its journal mode on the database."""
+        self.assertRaises(ValueError, OutboxStateDAO, self.state_db, profile='unsafe')
+        for name in ['fast', 'balanced', 'safe']:
+            state = OutboxStateDAO(self.state_db, profile=name)
+            expected = dict(PROFILES[name])['journal_mode'].lower()
+            self.assertEqual(state.db.execute("PRAGMA journal_mode").fetchone()['journal_mode'], 
+                             expected)
+            state.add_file(File(filename='/data/%s.txt' % name, mtime=1.5))
+            state.close()
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.find_file('/data/fast.txt').mtime, 1.5)
+        state.close()
+
+
+class SchemaUpgradeTest(StateDBTestCase):
+    
+    def runTest(self):
+        """A state database from the original schema gains the new columns."""
+        db = sqlite3.connect(self.state_db)
+        db.execute("CREATE TABLE file (id INTEGER NOT NULL PRIMARY KEY, "
+                   "filename TEXT NOT NULL UNIQUE, mtime FLOAT8, rtime FLOAT8, "
+                   "size INTEGER, checksum TEXT, username TEXT, groupname TEXT, "
+                   "must_tag BOOLEAN NOT NULL DEFAULT true)")
+        db.execute("INSERT INTO file (filename, mtime, size, checksum) "
+                   "VALUES ('/data/old.txt', 1.0, 3, 'abc')")
+        db.commit()
+        db.close()
+        
+        state = OutboxStateDAO(self.state_db)
+        found = state.find_file('/data/old.txt')
+        self.assertEqual((found.checksum, found.digests), ('abc', {}))
+        found.digests = {'md5': 'def'}
+        state.update_file(found)
+        self.assertEqual(state.find_file('/data/old.txt').digests, {'md5': 'def'})
+        self.assertEqual(state.find_checkpoint('/data/old.txt'), None)
+        state.close()
+
+
+class SchemaCheckingStateDAO(OutboxStateDAO):
+    """A state database recording the columns it would add, without adding them."""
+    
+    def _add_missing_columns(self, table, columns):
+        cursor = self.db.cursor()
+        cursor.execute("PRAGMA table_info(%s)" % table)
+        existing = set([r["name"] for r in cursor.fetchall()])
+        self.missing = [name for name, decl in columns if name not in existing]
+
+
+class FreshSchemaTest(StateDBTestCase):
+    
+    def runTest(self):
+        """A new state database has all of the columns without upgrading."""
+        state = SchemaCheckingStateDAO(self.state_db)
+        self.assertEqual(state.missing, [])
+        state.close()
+
+
+class CheckpointTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Checksum checkpoints are resumed only for an unchanged file."""
+        fpath = os.path.join(self.tempdir, 'big.dat')
+        f = open(fpath, 'wb')
+        f.write('abcdefghij')
+        f.close()
+        state = OutboxStateDAO(self.state_db)
+        
+        cp = ChecksumCheckpoint(state, fpath, 4)
+        self.assertEqual(cp.leaves, {})
+        cp.save({0: '\x01\x02'})
+        self.assertEqual(state.find_checkpoint(fpath), None)
+        cp.save({0: '\x01\x02', 2: '\x03'}, True)
+        self.assertEqual(state.find_checkpoint(fpath).leaves, {0: '0102', 2: '03'})
+        
+        self.assertEqual(ChecksumCheckpoint(state, fpath, 4).leaves, 
+                         {0: '\x01\x02', 2: '\x03'})
+        self.assertEqual(ChecksumCheckpoint(state, fpath, 8).leaves, {})
+        os.utime(fpath, (1.0, 1.0))
+        self.assertEqual(ChecksumCheckpoint(state, fpath, 4).leaves, {})
+        
+        cp.clear()
+        self.assertEqual(state.find_checkpoint(fpath), None)
+        state.close()
+
+
+class MovedFileTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Files are found by identity under another name until superseded."""
+        state = OutboxStateDAO(self.state_db)
+        identity = {'dev': 1, 'inode': 42, 'size': 5, 'mtime_ns': 1500000000}
+        f = File(filename='/data/a.txt', mtime=1.5, checksum='abc', 
+                 digests={'md5': 'def'}, ctime_ns=1, **identity)
+        state.add_file(f)
+        
+        moved = File(filename='/data/b.txt', ctime_ns=1, **identity)
+        found = state.find_moved_file(moved)
+        self.assertEqual((found.filename, found.checksum, found.digests), 
+                         ('/data/a.txt', 'abc', {'md5': 'def'}))
+        self.assertEqual(state.find_moved_file(f), None)
+        self.assertEqual(state.find_moved_file(File(filename='/data/c.txt', 
+                                                    dev=1, inode=42, size=6, 
+                                                    mtime_ns=1500000000)), None)
+        self.assertEqual(state.find_moved_file(File(filename='/data/c.txt')), None)
+        # a new file on the reused inode, with the size and mtime restored
+        self.assertEqual(state.find_moved_file(File(filename='/data/c.txt', ctime_ns=2,
+                                                    **identity)), None)
+        
+        state.supersede_file(found, '/data/b.txt')
+        self.assertEqual(state.find_file('/data/a.txt').superseded_by, '/data/b.txt')
+        self.assertEqual(state.find_moved_file(moved), None)
+        state.supersede_file(found, None)
+        self.assertEqual(state.find_moved_file(moved).filename, '/data/a.txt')
+        
+        found.inode = 43
+        state.update_identity(found)
+        self.assertEqual(state.find_moved_file(moved), None)
+        state.close()
+
+
+class DeferredFileTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Only registered files still lacking a checksum are deferred."""
+        state = OutboxStateDAO(self.state_db)
+        for (name, rtime, size, checksum) in [('/data/b.txt', 2.0, 5, None),
+                                              ('/data/a.txt', 2.0, 5, None),
+                                              ('/data/sub/d.txt', 2.0, 5, None),
+                                              ('/data/new.txt', None, 5, None),
+                                              ('/data/empty.txt', 2.0, 0, None),
+                                              ('/data/dir', 2.0, None, None),
+                                              ('/data/done.txt', 2.0, 5, 'abc'),
+                                              ('/database/c.txt', 2.0, 5, None)]:
+            f = File(filename=name, mtime=1.5, size=size, checksum=checksum)
+            state.add_file(f)
+            f.rtime = rtime
+            state.update_file(f)
+        # nested directories are searched once
+        self.assertEqual([f.filename for f in state.find_deferred_files(['/data/sub', '/data/'])],
+                         ['/data/a.txt', '/data/b.txt', '/data/sub/d.txt'])
+        
+        f = state.find_file('/data/a.txt')
+        state.supersede_file(f, '/data/c.txt')
+        f = state.find_file('/data/b.txt')
+        f.checksum = 'def'
+        state.update_file(f)
+        f = state.find_file('/data/sub/d.txt')
+        f.checksum = 'ghi'
+        state.update_file(f)
+        self.assertEqual(state.find_deferred_files(['/data']), [])
+        state.close()
+
+
+class FileIndexTest(StateDBTestCase):
+    
+    # Attributes compared between the index and the state database
+    ATTRS = ['id', 'filename', 'mtime', 'rtime', 'size', 'checksum', 'tree_chunksize',
+             'dev', 'inode', 'mtime_ns', 'ctime_ns', 'digests', 'superseded_by']
+    
+    def runTest(self):
+        """The index answers like the state database for the files it holds."""
+        state = OutboxStateDAO(self.state_db)
+        fs = [File(filename='/data/a.txt', mtime=1.5, size=5, checksum='ab' * 32,
+                   dev=1, inode=42, mtime_ns=1500000000, ctime_ns=1600000000),
+              File(filename='/data/sub', mtime=2.5),
+              File(filename=u'/data/\xe9t\xe9.txt', mtime=3.5, size=0, checksum='cd' * 32,
+                   tree_chunksize=4096),
+              File(filename='/data/md5.txt', mtime=4.5, size=1, checksum='ef' * 32, 
+                   digests={'md5': 'abc'}),
+              File(filename='/data/short.txt', mtime=5.5, size=1, checksum='abc'),
+              File(filename='/data/old.txt', mtime=6.5, size=1),
+              File(filename='/database/b.txt', mtime=7.5, size=1)]
+        state.add_files(fs)
+        fs[0].rtime = 8.5
+        state.update_file(fs[0])
+        state.supersede_file(fs[5], '/data/new.txt')
+        
+        index = FileIndex(state, ['/data/', '/other'])
+        self.assertEqual((index.complete, len(index)), (True, 6))
+        for f in fs[:6]:
+            expected = state.find_file(f.filename)
+            found = index.find_file(f.filename)
+            self.assertEqual([getattr(found, a) for a in self.ATTRS],
+                             [getattr(expected, a) for a in self.ATTRS])
+        self.assertEqual(index.fallbacks, 3)
+        self.assertEqual(index.find_file('/database/b.txt'), None)
+        self.assertEqual(index.find_file('/data/missing.txt'), None)
+        
+        index = FileIndex(state, ['/data'], limit=index.bytes - 1)
+        self.assertEqual((index.complete, len(index)), (False, 0))
+        state.close()
+
+
+class MergeJoinTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Sorted lookups are merged with the entries, passing over the deleted."""
+        state = OutboxStateDAO(self.state_db)
+        names = ['/data/a.txt', '/data/b.txt', '/data/c.txt', '/data/d.txt', 
+                 '/data/sub', '/data/sub/e.txt', '/data/sub.txt', '/data/z.txt',
+                 '/database/f.txt', '/other/g.txt']
+        state.add_files([File(filename=n, mtime=1.5, size=1) for n in names])
+        state.supersede_file(state.find_file('/data/d.txt'), '/data/new.txt')
+        
+        merge = MergeJoin(state, ['/data/', '/other'], rows=2)
+        self.assertEqual(merge.find_file('/data/a.txt').filename, '/data/a.txt')
+        # a file added after the merge started is neither found nor deleted
+        state.add_file(File(filename='/data/b0.txt', mtime=1.5, size=1))
+        self.assertEqual(merge.find_file('/data/c.txt').filename, '/data/c.txt')
+        self.assertEqual(merge.find_file('/data/new.txt'), None)
+        self.assertEqual(merge.find_file('/data/sub').filename, '/data/sub')
+        # '/data/sub.txt' sorts before the members of '/data/sub'
+        self.assertEqual(merge.find_file('/data/sub/e.txt').filename, '/data/sub/e.txt')
+        self.assertEqual((merge.deleted, merge.fallbacks), (2, 0))
+        # out of order, or outside the directories
+        self.assertEqual(merge.find_file('/data/b.txt').filename, '/data/b.txt')
+        self.assertEqual(merge.find_file('/database/f.txt').filename, '/database/f.txt')
+        self.assertEqual(merge.fallbacks, 2)
+        merge.finish()
+        self.assertEqual((merge.deleted, merge.fallbacks), (4, 2))
+        
+        # a nested directory is merged as part of the outer one, and found 
+        # again when walked as a root of its own
+        merge = MergeJoin(state, ['/data/sub', '/data'])
+        for n in ['/data/a.txt', '/data/b.txt', '/data/b0.txt', '/data/c.txt', '/data/sub',
+                  '/data/sub.txt', '/data/sub/e.txt', '/data/z.txt', '/data/sub/e.txt']:
+            self.assertEqual(merge.find_file(n).filename, n)
+        merge.finish()
+        self.assertEqual((merge.deleted, merge.fallbacks), (0, 1))
+        state.close()
+
+
+class GenerationSweepTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Entries not stamped with the current generation are swept."""
+        state = OutboxStateDAO(self.state_db)
+        names = ['/data/a.txt', '/data/b.txt', '/data/sub/c.txt', '/data/sub/deep/d.txt',
+                 '/other/e.txt']
+        fs = [File(filename=n, mtime=1.5, size=1) for n in names]
+        state.add_files(fs)
+        self.assertEqual(state.start_generation(), 1)
+        state.add_file(File(filename='/data/new.txt', mtime=1.5, size=1))
+        state.stamp_files([fs[0].id])
+        state.stamp_filenames(['/data/sub/c.txt', '/data/sub/missing.txt'])
+        state.save_checkpoint(Checkpoint(filename='/data/b.txt', size=1, mtime=1.5,
+                                         inode=1, chunksize=4, leaves={0: '01'}))
+        
+        swept = state.find_swept_files('/data')
+        self.assertEqual([f.filename for f in swept], ['/data/b.txt', '/data/sub/deep/d.txt'])
+        state.delete_files(swept)
+        self.assertEqual(state.find_file('/data/b.txt'), None)
+        self.assertEqual(state.find_checkpoint('/data/b.txt'), None)
+        self.assertEqual(state.find_swept_files('/data'), [])
+        state.close()
+        
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.start_generation(), 2)
+        self.assertEqual(len(state.find_swept_files('/')), 4)
+        state.close()
+
+
+class DirectoryFingerprintTest(StateDBTestCase):
+    
+    def runTest(self):
+        """Directory fingerprints are replaced and survive a reopen."""
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.find_fingerprint('/data'), None)
+        state.save_fingerprint('/data', 'abc')
+        state.save_fingerprint('/data', 'def')
+        state.close()
+        
+        # reopening runs the schema script again alongside an open connection
+        other = OutboxStateDAO(self.state_db)
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.find_fingerprint('/data'), 'def')
+        self.assertEqual(other.find_fingerprint('/other'), None)
+        other.close()
+        state.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
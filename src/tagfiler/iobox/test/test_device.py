@@ -0,0 +1,144 @@
+# 
+# Copyright 2010 University of Southern California
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Unit tests for the device module.
+"""
+
+from tagfiler.iobox.threaded import worker, outbox
+from tagfiler.iobox.threaded.device import Router, device_label
+from tagfiler.iobox.threaded.schedule import Schedule
+from tagfiler.iobox.models import File
+
+import unittest
+import logging
+import tempfile
+import threading
+import shutil
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def all_tests():
+    """Returns a TestSuite that includes all test cases in this module."""
+    suite = unittest.TestSuite()
+    suite.addTest(RouterTest())
+    suite.addTest(RouterScheduleTest())
+    return suite
+
+
+class SlowChecksum(worker.Worker):
+    """Stands in for a Checksum worker, taking longer on a slow device."""
+    
+    def __init__(self, tasks, results, slow_dev):
+        super(SlowChecksum, self).__init__(tasks, results)
+        self._slow_dev = slow_dev
+        self.files = 0
+        self.bytes = 0
+        self.started = None
+        self.finished = None
+    
+    def do_work(self, task, work_done):
+        self.started = self.started or time.time()
+        if task.dev == self._slow_dev:
+            time.sleep(0.05)
+        self.files += 1
+        self.bytes += task.size
+        self.finished = time.time()
+        work_done(task)
+
+
+class RouterTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+    
+    def runTest(self):
+        """Files are hashed on per-device workers, fast devices first."""
+        slow = os.stat(self.tempdir).st_dev
+        fast = slow + 1
+        tasks = worker.WorkQueue()
+        results = worker.WorkQueue()
+        r = Router(tasks, results, lambda q: SlowChecksum(q, results, slow),
+                   {self.tempdir: 1, os.path.join(self.tempdir, 'missing'): 5}, 
+                   default_workers=3)
+        done = []
+        for i in range(4):
+            r.do_work(File(filename='/slow%d' % i, dev=slow, size=10), done.append)
+            r.do_work(File(filename='/fast%d' % i, dev=fast, size=20), done.append)
+        r.do_work(outbox.Outbox._SUM_DONE, done.append)
+        self.assertEqual(done, [outbox.Outbox._SUM_DONE])
+        
+        order = [ results.get_nowait().filename for i in range(8) ]
+        self.assertEqual(sorted(order[:4]), ['/fast0', '/fast1', '/fast2', '/fast3'])
+        self.assertEqual(order[4:], ['/slow0', '/slow1', '/slow2', '/slow3'])
+        
+        stats = dict([ (s[0], s[1:4]) for s in r.device_stats() ])
+        self.assertEqual(stats[self.tempdir], (1, 4, 40))
+        self.assertEqual(stats[device_label(fast)], (3, 4, 80))
+        for w in r.workers():
+            w.terminate()
+
+
+class BlockedChecksum(worker.Worker):
+    """Stands in for a Checksum worker, holding each file until released."""
+    
+    def __init__(self, tasks, results, release):
+        super(BlockedChecksum, self).__init__(tasks, results)
+        self._release = release
+    
+    def do_work(self, task, work_done):
+        self._release.wait()
+        work_done(task)
+
+
+class RouterScheduleTest(unittest.TestCase):
+    
+    def runTest(self):
+        """Files are held while the device queues are busy, though the router's queue is empty."""
+        tasks = worker.WorkQueue()
+        sum_q = worker.WorkQueue()
+        results = worker.WorkQueue()
+        release = threading.Event()
+        r = Router(sum_q, results, lambda q: BlockedChecksum(q, results, release))
+        s = Schedule(tasks, sum_q, window=4, backlog=r.backlog)
+        # the router has drained its own queue into a busy device queue
+        for i in range(3):
+            r.do_work(File(filename='/busy%d' % i, dev=1, inode=i), None)
+        self.assertTrue(sum_q.empty())
+        self.assertTrue(r.backlog() > 0)
+        
+        done = []
+        for inode in range(10, 0, -1):
+            s.do_work(File(filename='/f%d' % inode, dev=1, inode=inode), done.append)
+        self.assertEqual(s.batches, 2)
+        self.assertEqual([ f.inode for f in done ], [7, 8, 9, 10, 3, 4, 5, 6])
+        
+        release.set()
+        r.do_work(outbox.Outbox._SUM_DONE, lambda task: None)
+        self.assertEqual(r.backlog(), 0)
+        for w in r.workers():
+            w.terminate()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
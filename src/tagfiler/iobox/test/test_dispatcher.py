@@ -0,0 +1,302 @@
+#
+# Copyright 2010 University of Southern California
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Unit tests for the dispatcher module, driving the threaded Outbox.
+"""
+
+from tagfiler.iobox.threaded import outbox, dispatcher, worker
+from tagfiler.iobox.models import Outbox, File, create_default_name_path_rule
+from tagfiler.iobox.dao import OutboxStateDAO
+from tagfiler.util.http import TagfilerClient
+from tagfiler.util import files
+
+import unittest
+import logging
+import tempfile
+import shutil
+import json
+import errno
+import urllib
+import time
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def all_tests():
+    """Returns a TestSuite that includes all test cases in this module."""
+    suite = unittest.TestSuite()
+    suite.addTest(LazyBackfillTest())
+    suite.addTest(BackfillResumeTest())
+    suite.addTest(ModifiedResumeTest())
+    suite.addTest(GroupCommitTest())
+    suite.addTest(SweepGuardTest())
+    return suite
+
+
+class RecordingClient(TagfilerClient):
+    """A client that records its requests instead of sending them."""
+
+    def __init__(self):
+        super(RecordingClient, self).__init__('https://localhost/tagfiler')
+        self.registered = []
+        self.deleted = []
+
+    def _send_request(self, method, url, body='', headers={}):
+        if method == 'PUT':
+            self.registered.extend(json.loads(body))
+        elif method == 'DELETE':
+            self.deleted.append(url)
+
+
+class OutboxTestCase(unittest.TestCase):
+    """Base class for test cases running the threaded Outbox on a temporary tree."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tempdir, 'root')
+        self.state_db = os.path.join(self.tempdir, 'state.db')
+        for d in ['a', 'b']:
+            os.makedirs(os.path.join(self.root, d))
+            for i in range(5):
+                f = open(os.path.join(self.root, d, 'f%d' % i), 'w')
+                f.write('%s%d' % (d, i))
+                f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def run_outbox(self, client, **kwargs):
+        """Runs the threaded Outbox over the root to completion."""
+        kwargs.setdefault('roots', [self.root])
+        model = Outbox(state_db=self.state_db, **kwargs)
+        model.path_rules.append(create_default_name_path_rule('file://host'))
+        o = outbox.Outbox(model, client)
+        o.start()
+        o.done()
+        o.wait_done(30)
+        o.terminate()
+        self.assertTrue(o.is_done())
+        # is_alive is true once all of the workers have terminated
+        while not o.is_alive():
+            time.sleep(0.01)
+        return o
+
+
+class LazyBackfillTest(OutboxTestCase):
+
+    def runTest(self):
+        """Deferred checksums of the roots are registered with their checksum tag."""
+        state = OutboxStateDAO(self.state_db)
+        gone = os.path.join(self.root, 'gone')
+        for name in [gone, '/elsewhere/f']:
+            f = File(filename=name, mtime=1.0, size=5)
+            state.add_file(f)
+            f.rtime = 2.0
+            state.update_file(f)
+        state.close()
+
+        client = RecordingClient()
+        o = self.run_outbox(client, lazy_checksums=True)
+        self.assertEqual(o.errors, [])
+        self.assertEqual((o.deferred, o.backfilled, o.missing), (10, 10, 1))
+        registered = [ r for r in client.registered if 'sha256' not in r ]
+        backfilled = [ r for r in client.registered if 'sha256' in r ]
+        # the two directories are registered as well
+        self.assertEqual(len(registered), 12)
+        self.assertEqual(len(backfilled), 10)
+        for r in backfilled:
+            self.assertEqual(sorted(r.keys()), ['name', 'sha256'])
+            path = r['name'][0][len('file://host'):]
+            self.assertEqual(r['sha256'], [files.sha256sum(path)])
+
+        # the missing file's entry is deleted, the file outside the roots kept
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.find_file(gone), None)
+        self.assertEqual([ f.filename for f in state.find_deferred_files(['/']) ],
+                         ['/elsewhere/f'])
+        state.close()
+
+
+class FailingBackfillClient(RecordingClient):
+    """A client whose registrations of checksum tags are refused."""
+
+    def _send_request(self, method, url, body='', headers={}):
+        if method == 'PUT' and 'sha256' in body:
+            raise IOError("refused")
+        return super(FailingBackfillClient, self)._send_request(method, url, body, headers)
+
+
+class BackfillResumeTest(OutboxTestCase):
+
+    def runTest(self):
+        """Checksums refused by the server stay deferred for the next run."""
+        o = self.run_outbox(FailingBackfillClient(), lazy_checksums=True)
+        self.assertNotEqual(o.errors, [])
+        self.assertEqual((o.deferred, o.backfilled), (10, 0))
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(len(state.find_deferred_files([self.root])), 10)
+        state.close()
+
+        client = RecordingClient()
+        o = self.run_outbox(client, lazy_checksums=True)
+        self.assertEqual(o.errors, [])
+        self.assertEqual((o.deferred, o.backfilled), (10, 10))
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.find_deferred_files([self.root]), [])
+        state.close()
+
+
+class FailingClient(RecordingClient):
+    """A client whose registrations are refused."""
+
+    def _send_request(self, method, url, body='', headers={}):
+        if method == 'PUT':
+            raise IOError("refused")
+        return super(FailingClient, self)._send_request(method, url, body, headers)
+
+
+class ModifiedResumeTest(OutboxTestCase):
+
+    def runTest(self):
+        """Modified files refused by the server are registered by the next run."""
+        self.run_outbox(RecordingClient())
+        modified = os.path.join(self.root, 'a', 'f0')
+        f = open(modified, 'w')
+        f.write('changed')
+        f.close()
+        os.utime(modified, (time.time() + 10, time.time() + 10))
+
+        o = self.run_outbox(FailingClient())
+        self.assertNotEqual(o.errors, [])
+        state = OutboxStateDAO(self.state_db)
+        self.assertEqual(state.find_file(modified).rtime, None)
+        state.close()
+
+        client = RecordingClient()
+        o = self.run_outbox(client, digests=['sha256'])
+        self.assertEqual((o.errors, o.registered), ([], 1))
+        self.assertEqual(client.registered[0]['name'], ['file://host' + modified])
+        self.assertEqual(client.registered[0]['sha256'], [files.sha256sum(modified)])
+
+
+class CountingStateDAO(OutboxStateDAO):
+    """A state database that counts the commits of pending writes."""
+    
+    commits = 0
+    
+    def commit(self, force=True):
+        pending = self._pending
+        super(CountingStateDAO, self).commit(force)
+        if pending and not self._pending:
+            CountingStateDAO.commits += 1
+
+
+class GroupCommitTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.state_db = os.path.join(self.tempdir, 'state.db')
+        self.state_dao = dispatcher.OutboxStateDAO
+        dispatcher.OutboxStateDAO = CountingStateDAO
+        CountingStateDAO.commits = 0
+    
+    def tearDown(self):
+        dispatcher.OutboxStateDAO = self.state_dao
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+    
+    def committed(self):
+        """Returns the number of file entries committed so far."""
+        state = OutboxStateDAO(self.state_db)
+        r = state.db.execute("SELECT count(*) AS n FROM file").fetchone()
+        state.close()
+        return r["n"]
+    
+    def runTest(self):
+        """The Dispatcher commits in groups, not whenever its queue runs empty."""
+        tasks = worker.WorkQueue()
+        sumq = worker.WorkQueue()
+        tagq = worker.WorkQueue()
+        d = dispatcher.Dispatcher(self.state_db, tasks, sumq, tagq, worker.WorkQueue())
+        d.start()
+        # hashed files trickle in, leaving the queue empty after each one
+        for i in range(200):
+            tasks.put(File(filename='/data/f%d' % i, mtime=1.0, size=1, 
+                           checksum='ab' * 32, status=File.COMPUTE))
+            time.sleep(0.001)
+        tasks.join()
+        self.assertEqual(tagq.qsize(), 200)
+        self.assertTrue(CountingStateDAO.commits <= 2, CountingStateDAO.commits)
+        
+        # the writes still pending are committed once the Dispatcher is idle
+        time.sleep(d.idle_timeout + 0.5)
+        self.assertEqual(self.committed(), 200)
+        commits = CountingStateDAO.commits
+        self.assertTrue(commits <= 3, commits)
+        
+        # and at the latest at the FIND_DONE marker
+        tasks.put(File(filename='/data/g', mtime=1.0, size=1, checksum='cd' * 32,
+                       status=File.COMPUTE))
+        tasks.put(outbox.Outbox._FIND_DONE)
+        self.assertTrue(sumq.get(timeout=5) is outbox.Outbox._SUM_DONE)
+        self.assertEqual(self.committed(), 201)
+        self.assertEqual(CountingStateDAO.commits, commits + 1)
+        d.terminate()
+        d.join()
+
+
+class SweepGuardTest(OutboxTestCase):
+    
+    def runTest(self):
+        """Files under directories not listed, or of missing roots, are not swept."""
+        other = os.path.join(self.tempdir, 'other')
+        os.makedirs(other)
+        open(os.path.join(other, 'f'), 'w').close()
+        roots = [self.root, other]
+        client = RecordingClient()
+        o = self.run_outbox(client, roots=roots, sweep_deleted=True)
+        self.assertEqual((o.errors, o.registered), ([], 13))
+        
+        # 'a' cannot be listed, 'other' is gone, and a file of 'b' is deleted
+        shutil.rmtree(other)
+        os.remove(os.path.join(self.root, 'b', 'f0'))
+        unreadable = os.path.join(self.root, 'a')
+        list_dir = files._list_dir
+        def _list_dir(dirpath):
+            if dirpath == unreadable:
+                raise OSError(errno.EACCES, os.strerror(errno.EACCES), dirpath)
+            return list_dir(dirpath)
+        files._list_dir = _list_dir
+        try:
+            client = RecordingClient()
+            o = self.run_outbox(client, roots=roots, sweep_deleted=True)
+        finally:
+            files._list_dir = list_dir
+        self.assertEqual(o.errors, [])
+        self.assertEqual((o.unregistered, o.pruned), (1, 1))
+        self.assertEqual(len(client.deleted), 1)
+        self.assertTrue(client.deleted[0].endswith(urllib.quote('/b/f0', '')))
+        
+        state = OutboxStateDAO(self.state_db)
+        self.assertNotEqual(state.find_file(os.path.join(unreadable, 'f0')), None)
+        self.assertNotEqual(state.find_file(os.path.join(other, 'f')), None)
+        state.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -4,13 +4,38 @@ Created on Sep 26, 2012
 @author: smithd
 '''
 import unittest
+from tagfiler.util import files
 from tagfiler.util.files import create_uri_friendly_file_path
+from tagfiler.iobox.test import base
 import logging
+import tempfile
+import re
+import shutil
+import hashlib
+import json
+import time
+import os
 
 def all_tests():
     """Returns a TestSuite that includes all test cases in this module."""
     suite = unittest.TestSuite()
     suite.addTest(TestCreateUriFriendlyFilePath())
+    suite.addTest(TestTreeScanStats())
+    suite.addTest(TestTreeScanPrune())
+    suite.addTest(TestParallelWalk())
+    suite.addTest(TestTreeScanDirs())
+    suite.addTest(TestTreeScanSorted())
+    suite.addTest(TestScanFailures())
+    suite.addTest(TestListingScanDirs())
+    suite.addTest(TestOutermostDirs())
+    suite.addTest(TestPathMatcher())
+    suite.addTest(TestNameCache())
+    suite.addTest(TestSha256sum())
+    suite.addTest(TestFileDigests())
+    suite.addTest(TestIOHints())
+    suite.addTest(TestChecksumProviders())
+    suite.addTest(TestTreeDigest())
+    suite.addTest(TestTreeDigestCheckpoint())
     return suite
 
 class TestCreateUriFriendlyFilePath(unittest.TestCase):
@@ -26,6 +51,537 @@ class TestCreateUriFriendlyFilePath(unittest.TestCase):
         unix_path_converted = "/opt/data/studies/myfile.txt"
         assert create_uri_friendly_file_path(unix_path_orig_path, unix_path_orig_name) == unix_path_converted
         
+class TestTreeScanStats(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.top, 'a', 'b'))
+        f = open(os.path.join(self.top, 'a', 'f.txt'), 'w')
+        f.write('hello')
+        f.close()
+        os.symlink(os.path.join(self.top, 'missing'), os.path.join(self.top, 'dangling'))
+        os.symlink(os.path.join(self.top, 'a'), os.path.join(self.top, 'linked'))
+
+    def tearDown(self):
+        shutil.rmtree(self.top, ignore_errors=True)
+
+    def runTest(self):
+        stats = dict([ (t[0], t) for t in files.tree_scan_stats(self.top) ])
+        assert sorted(stats.keys()) == ['/a', '/a/b', '/a/f.txt', '/dangling', '/linked']
+        assert stats['/a/f.txt'][1] == 5
+        assert stats['/a'][1] is None
+        assert stats['/dangling'][1] is None
+        # symlinked dirs are reported but not descended
+        assert stats['/linked'][1] is None
+        
+        # callbacks and the sha256 variant see the same members
+        assert sorted(files.tree_scan(self.top)) == sorted(stats.keys())
+        for t in files.tree_scan_stats_sha256(self.top):
+            assert t[:5] == stats[t[0]]
+            if t[0] == '/a/f.txt':
+                assert t[5] == files.sha256sum(os.path.join(self.top, 'a', 'f.txt'))
+            else:
+                assert t[5] is None
+        
+        # the identity variant follows links like the stats
+        for t in files.tree_scan_stats_identity(self.top):
+            assert t[:5] == stats[t[0]]
+            assert t[5] == files.path_identity(self.top + t[0])
+        s = os.stat(os.path.join(self.top, 'a', 'f.txt'))
+        (dev, inode, size, mtime_ns, ctime_ns) = files.stat_identity(s)
+        assert (dev, inode, size) == (s.st_dev, s.st_ino, 5)
+        assert abs(mtime_ns - s.st_mtime * 1e9) < 1e3
+        assert files.path_identity(os.path.join(self.top, 'missing')) is None
+
+class TestTreeScanPrune(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        for d in [('data',), ('.snapshot', 'hourly'), ('.snapshot-keep',)]:
+            os.makedirs(os.path.join(self.top, *d))
+            open(os.path.join(self.top, *(d + ('f',))), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.top, ignore_errors=True)
+
+    def runTest(self):
+        excludes = [re.compile('^\\.snapshot')]
+        includes = [re.compile('keep$')]
+        walked = sorted(files.tree_scan(self.top, excludes=excludes, includes=includes))
+        assert walked == ['/.snapshot-keep', '/.snapshot-keep/f', '/.snapshot/hourly',
+                          '/.snapshot/hourly/f', '/data', '/data/f']
+        pruned = sorted(files.tree_scan(self.top, excludes=excludes, includes=includes, prune=True))
+        assert pruned == ['/.snapshot-keep', '/.snapshot-keep/f', '/data', '/data/f']
+
+class TestParallelWalk(unittest.TestCase):
+    def setUp(self):
+        self.rootdirs = base.create_temp_dirtree(1, 8, 20)
+        os.makedirs(os.path.join(self.rootdirs[0], 'deep', 'er', 'est'))
+
+    def tearDown(self):
+        base.remove_temp_dirtree(self.rootdirs)
+
+    def runTest(self):
+        top = self.rootdirs[0]
+        serial = sorted(files.tree_scan_stats(top))
+        assert len(serial) == 8 + 8 * 20 + 3
+        assert sorted(files.tree_scan_stats(top, threads=4)) == serial
+        
+        excludes = [re.compile('^er$')]
+        pruned = sorted(files.tree_scan_stats(top, excludes=excludes, prune=True, threads=4))
+        assert pruned == sorted(files.tree_scan_stats(top, excludes=excludes, prune=True))
+        assert len(pruned) == len(serial) - 2
+        
+        # abandoning the walk early must not leave threads blocked
+        walk = files.tree_scan_stats(top, threads=4)
+        walk.next()
+        walk.close()
+
+class TestTreeScanDirs(unittest.TestCase):
+    def setUp(self):
+        self.rootdirs = base.create_temp_dirtree(1, 4, 10)
+
+    def tearDown(self):
+        base.remove_temp_dirtree(self.rootdirs)
+
+    def runTest(self):
+        top = self.rootdirs[0]
+        dirs = dict([ (d[0], d) for d in files.tree_scan_dirs(top) ])
+        assert len(dirs) == 5 and '' in dirs
+        members = sorted([ t for d in dirs.values() for t in d[2] ])
+        assert members == sorted(files.tree_scan_stats_identity(top))
+        threaded = dict([ (d[0], d) for d in files.tree_scan_dirs(top, threads=4) ])
+        assert sorted([ (r, d[1]) for r, d in threaded.items() ]) == \
+            sorted([ (r, d[1]) for r, d in dirs.items() ])
+        
+        # fingerprints are stable until a member of that directory changes
+        again = dict([ (d[0], d[1]) for d in files.tree_scan_dirs(top) ])
+        assert again == dict([ (r, d[1]) for r, d in dirs.items() ])
+        relpath = sorted([ r for r in dirs if r ])[0]
+        fpath = top + dirs[relpath][2][0][0]
+        s = os.stat(fpath)
+        os.utime(fpath, (s.st_atime, s.st_mtime + 10))
+        touched = dict([ (d[0], d[1]) for d in files.tree_scan_dirs(top) ])
+        assert touched[relpath] != again[relpath]
+        assert touched[''] == again['']
+        open(top + relpath + os.path.sep + 'new.txt', 'w').close()
+        added = dict([ (d[0], d[1]) for d in files.tree_scan_dirs(top) ])
+        assert added[relpath] != touched[relpath]
+        
+        # directories larger than a batch are generated in parts
+        for threads in [1, 4]:
+            parts = list(files.tree_scan_dirs(top, batch=4, threads=threads))
+            assert max([ len(d[2]) for d in parts ]) == 4
+            assert set([ d[1] for d in parts if d[0] == relpath ]) == set([None])
+            assert len([ d for d in parts if d[0] == relpath ]) == 3
+            assert sorted([ t for d in parts for t in d[2] ]) == \
+                sorted(files.tree_scan_stats_identity(top))
+
+class TestTreeScanSorted(unittest.TestCase):
+    def setUp(self):
+        self.rootdirs = base.create_temp_dirtree(1, 4, 10)
+        top = self.rootdirs[0]
+        # siblings sorting between a directory's name and its members
+        os.mkdir(top + os.path.sep + 'sub')
+        for name in ['sub.txt', 'sub-a', 'sub0', 'sub' + os.path.sep + 'x']:
+            open(top + os.path.sep + name, 'w').close()
+
+    def tearDown(self):
+        base.remove_temp_dirtree(self.rootdirs)
+
+    def runTest(self):
+        top = self.rootdirs[0]
+        parts = list(files.tree_scan_sorted(top, batch=7))
+        assert set([ (d[0], d[1]) for d in parts ]) == set([ ('', None) ])
+        assert max([ len(d[2]) for d in parts ]) == 7
+        members = [ t for d in parts for t in d[2] ]
+        assert sorted(members) == sorted(files.tree_scan_stats_identity(top))
+        paths = [ create_uri_friendly_file_path(top, t[0]) for t in members ]
+        assert paths == sorted(paths)
+        
+        # excluded directories are pruned as by tree_scan_dirs
+        excludes = [re.compile('sub$')]
+        pruned = [ t[0] for d in files.tree_scan_sorted(top, excludes, prune=True) 
+                   for t in d[2] ]
+        assert os.path.sep + 'sub.txt' in pruned
+        assert os.path.sep + 'sub' + os.path.sep + 'x' not in pruned
+
+class TestScanFailures(unittest.TestCase):
+    def setUp(self):
+        self.rootdirs = base.create_temp_dirtree(1, 3, 2)
+        top = self.rootdirs[0]
+        self.unreadable = os.path.join(top, sorted(os.listdir(top))[0])
+        self.list_dir = files._list_dir
+        files._list_dir = self._list_dir
+
+    def tearDown(self):
+        files._list_dir = self.list_dir
+        base.remove_temp_dirtree(self.rootdirs)
+
+    def _list_dir(self, dirpath):
+        if dirpath == self.unreadable:
+            raise OSError(13, 'Permission denied', dirpath)
+        return self.list_dir(dirpath)
+
+    def runTest(self):
+        top = self.rootdirs[0]
+        for scan in [lambda failures: files.tree_scan_dirs(top, failures=failures),
+                     lambda failures: files.tree_scan_dirs(top, threads=3, failures=failures),
+                     lambda failures: files.tree_scan_sorted(top, failures=failures)]:
+            failures = []
+            members = [ t[0] for d in scan(failures) for t in d[2] ]
+            assert failures == [self.unreadable]
+            # the three directories and the files of the other two
+            assert len(members) == 7
+        missing = os.path.join(top, 'missing')
+        for scan in [files.tree_scan_dirs, files.tree_scan_sorted]:
+            failures = []
+            assert list(scan(missing, failures=failures)) == []
+            assert failures == [missing]
+
+class RecordFilter(logging.Filter):
+    """Records the messages of a logger, see logging.Logger.addFilter."""
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.messages = []
+
+    def filter(self, record):
+        self.messages.append(record.getMessage())
+        return False
+
+class TestListingScanDirs(unittest.TestCase):
+    def setUp(self):
+        self.rootdirs = base.create_temp_dirtree(1, 3, 5)
+        os.makedirs(os.path.join(self.rootdirs[0], 'skip', 'deep'))
+        open(os.path.join(self.rootdirs[0], 'skip', 'deep', 'f'), 'w').close()
+        self.listing = tempfile.mktemp()
+        # the warnings are recorded whatever the level of the root logger
+        self.level = files.logger.level
+        files.logger.setLevel(logging.WARNING)
+
+    def tearDown(self):
+        files.logger.setLevel(self.level)
+        base.remove_temp_dirtree(self.rootdirs)
+        os.remove(self.listing)
+
+    def runTest(self):
+        top = self.rootdirs[0]
+        walked = sorted(files.tree_scan_stats(top))
+        f = open(self.listing, 'w')
+        for i, (rpath, size, mtime, user, group) in enumerate(walked):
+            s = os.stat(top + rpath)
+            if i % 2:
+                # absolute paths in TSV
+                f.write('%s\t%s\t%r\t%d\t%d\n' % (top + rpath, '-' if size is None else size,
+                                                   s.st_mtime, s.st_uid, s.st_gid))
+            else:
+                # relative paths in NDJSON
+                f.write(json.dumps({'path': rpath[1:], 'size': size, 'mtime': s.st_mtime,
+                                    'uid': s.st_uid, 'gid': s.st_gid, 'ino': s.st_ino}) + '\n')
+        f.write('malformed\n/elsewhere/f\t1\t1.0\t0\t0\n')
+        f.write('%s/\t-\t1.0\t0\t0\n.\t-\t1.0\t0\t0\n' % top)
+        f.close()
+        
+        # the root's own records are neither warned about nor generated
+        record = RecordFilter()
+        files.logger.addFilter(record)
+        try:
+            dirs = list(files.listing_scan_dirs(top, self.listing, batch=2))
+        finally:
+            files.logger.removeFilter(record)
+        assert len(record.messages) == 2, record.messages
+        assert max([ len(d[2]) for d in dirs ]) == 2
+        assert set([ d[1] for d in dirs ]) == set([None])
+        listed = sorted([ t for d in dirs for t in d[2] ])
+        assert [ t[:5] for t in listed ] == walked
+        identities = dict([ (t[0], t[5]) for t in listed ])
+        for i, t in enumerate(walked):
+            inode = None if i % 2 else os.stat(top + t[0]).st_ino
+            assert identities[t[0]][1] == inode
+        
+        excludes = [re.compile('^skip$')]
+        for prune in [False, True]:
+            listed = sorted([ t[0] for d in files.listing_scan_dirs(top, self.listing, excludes,
+                                                                    prune=prune) for t in d[2] ])
+            assert listed == sorted([ t[0] for t in files.tree_scan_stats(top, excludes, 
+                                                                          prune=prune) ])
+
+class TestOutermostDirs(unittest.TestCase):
+    def runTest(self):
+        dirnames = ['/data/sub', '/data/', '/other', '/data', '/data.x/y', '/other/../data/z']
+        self.assertEqual(files.outermost_dirs(dirnames), ['/data/', '/other', '/data.x/y'])
+        self.assertEqual(files.outermost_dirs(['/', '/data']), ['/'])
+
+class TestPathMatcher(unittest.TestCase):
+    
+    def excluded(self, name, relpath, excludes, includes):
+        """Reference implementation of the tree_scan filtering logic."""
+        qualified = '%s/%s' % (relpath, name)
+        drop = [ p for p in excludes if p.search(name) or p.search(qualified) ]
+        keep = [ p for p in includes if p.search(name) or p.search(qualified) ]
+        return bool(drop) and not keep
+    
+    def runTest(self):
+        excludes = [ re.compile(p) for p in 
+                     ['~$', '^\\.svn', '^CVS$', '^/tmp', '\\.snapshot', '^core\\.[0-9]+$',
+                      '(a)\\1$', '^\\$', 'x\\\\$', '(?i)^readme$', '/cache/'] ]
+        excludes.append(re.compile('\\.BAK$', re.IGNORECASE))
+        includes = [ re.compile(p) for p in ['^keep', 'important$'] ]
+        matcher = files.PathMatcher(excludes, includes)
+        cases = [ ('', 'notes.txt~'), ('/a', '.svnignore'), ('', 'tmp'), ('', 'tmpfile'),
+                  ('/tmp', 'x'), ('/a', 'CVS'), ('/a', 'CVSROOT'), ('/b/.snapshot', 'f'),
+                  ('', 'core.123'), ('', 'core.x'), ('', 'baa'), ('', '$'), ('', 'x\\'),
+                  ('/doc', 'README'), ('/doc', 'file.bak'), ('/x/cache', 'y'),
+                  ('/keep', 'f~'), ('', 'keep~'), ('', 'CVS.important'), ('', 'plain') ]
+        for relpath, name in cases:
+            assert matcher.excluded(name, relpath) == \
+                self.excluded(name, relpath, excludes, includes), (relpath, name)
+        assert not files.PathMatcher([], includes).excluded('anything', '')
+
+class TestNameCache(unittest.TestCase):
+    
+    def lookup(self, id):
+        self.lookups += 1
+        return {0: 'root', 1: 'daemon'}[id]
+    
+    def runTest(self):
+        self.lookups = 0
+        cache = files.NameCache(self.lookup, lambda: [(0, 'root'), (1, 'daemon'), (0, 'toor')])
+        assert cache.lookup(0) == 'root'
+        assert cache.lookup(0) == 'root'
+        assert cache.lookup(99) == 99
+        assert cache.lookup(99) == 99
+        assert self.lookups == 2
+        assert (cache.hits, cache.misses) == (2, 2)
+        
+        # preload fills the cache in one pass, keeping the first name per ID
+        cache.clear()
+        assert cache.preload() == 2
+        assert cache.lookup(0) == 'root' and cache.lookup(1) == 'daemon'
+        assert self.lookups == 2
+        
+        # bounded size evicts the oldest entries
+        cache = files.NameCache(self.lookup, maxsize=1)
+        cache.lookup(0)
+        cache.lookup(1)
+        cache.lookup(0)
+        assert self.lookups == 5
+        
+        # expired entries are looked up again
+        cache = files.NameCache(self.lookup, ttl=-1)
+        cache.lookup(0)
+        cache.lookup(0)
+        assert self.lookups == 7 and cache.hits == 0
+
+class TestSha256sum(unittest.TestCase):
+    def setUp(self):
+        fd, self.fpath = tempfile.mkstemp()
+        os.write(fd, 'x' * 10000)
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fpath)
+
+    def runTest(self):
+        import hashlib
+        expected = hashlib.sha256('x' * 10000).hexdigest()
+        assert files.sha256sum(self.fpath) == expected
+        assert files.sha256sum(self.fpath, blocksize=4096) == expected
+        assert files.sha256sum(self.fpath, blocksize=4096, use_mmap=True) == expected
+        assert files.sha256sum(self.fpath + '.missing') is None
+
+class TestFileDigests(unittest.TestCase):
+    def setUp(self):
+        fd, self.fpath = tempfile.mkstemp()
+        os.write(fd, 'hello')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fpath)
+
+    def runTest(self):
+        digests = files.file_digests(self.fpath, ['sha256', 'md5', 'sha1', 'crc32', 'adler32'],
+                                     blocksize=2)
+        assert digests['sha256'] == files.sha256sum(self.fpath)
+        assert digests['md5'] == '5d41402abc4b2a76b9719d911017c592'
+        assert digests['sha1'] == 'aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d'
+        assert digests['crc32'] == '3610a686'
+        assert digests['adler32'] == '062c0215'
+        assert files.file_digests(self.fpath + '.missing', ['md5']) is None
+        self.assertRaises(ValueError, files.new_digest, 'sha3')
+
+class TestIOHints(unittest.TestCase):
+    def setUp(self):
+        fd, self.fpath = tempfile.mkstemp()
+        os.write(fd, os.urandom(10000))
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fpath)
+
+    def runTest(self):
+        hints = files.IOHints(drop_behind=True)
+        expected = files.sha256sum(self.fpath)
+        hints.prefetch(self.fpath)
+        hints.prefetch(self.fpath)
+        hints.prefetch(self.fpath + '.missing')
+        assert files.file_checksum(self.fpath, 10000, [], 4096, hints=hints)[0] == expected
+        assert files.file_checksum(self.fpath, 10000, [], 4096, tree_chunksize=4096,
+                                   tree_threads=2, hints=hints)[1] == 4096
+        if files._fadvise is None:
+            assert (hints.prefetched, hints.dropped) == (0, 0)
+        else:
+            # each file is prefetched once, and every hashed byte dropped
+            assert (hints.prefetched, hints.dropped) == (1, 20000)
+        
+        # without drop_behind nothing is dropped
+        hints = files.IOHints()
+        files.file_digests(self.fpath, ['md5'], 4096, hints=hints)
+        assert hints.dropped == 0
+
+class TestChecksumProviders(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.fpath = os.path.join(self.dirpath, 'data')
+        f = open(self.fpath, 'wb')
+        f.write('abcdefghij')
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def runTest(self):
+        expected = files.sha256sum(self.fpath)
+        sidecar = self.fpath + files.SIDECAR_SUFFIX
+        f = open(sidecar, 'w')
+        f.write('%s  data\n' % ('0' * 64))
+        f.close()
+        s = os.stat(self.fpath)
+        
+        # the sidecar is used, unless other digests are asked for
+        providers = files.ChecksumProviders(['sidecar'])
+        assert files.file_checksum(self.fpath, 10, [], providers=providers)[0] == '0' * 64
+        assert files.file_checksum(self.fpath, 10, ['md5'], providers=providers)[0] == expected
+        assert providers.provided == {'sidecar': 1}
+        
+        # a sidecar older than the file is stale
+        os.utime(sidecar, (s.st_mtime - 10, s.st_mtime - 10))
+        assert providers.checksum(self.fpath, s) is None
+        
+        # and so is a sidecar of a file changed since, even with its old mtime
+        os.utime(sidecar, None)
+        assert providers.checksum(self.fpath, os.stat(self.fpath)) == '0' * 64
+        time.sleep(0.01)
+        f = open(self.fpath, 'ab')
+        f.write('k')
+        f.close()
+        os.utime(self.fpath, (s.st_mtime, s.st_mtime))
+        assert providers.checksum(self.fpath, os.stat(self.fpath)) is None
+        f = open(self.fpath, 'wb')
+        f.write('abcdefghij')
+        f.close()
+        
+        self.assertRaises(ValueError, files.ChecksumProviders, ['md5'])
+        
+        # computed checksums are written back, and reused while the file
+        # keeps its size and mtime
+        providers = files.ChecksumProviders(['xattr'], writeback=True)
+        assert files.file_checksum(self.fpath, 10, [], providers=providers)[0] == expected
+        if not providers.written:
+            return  # no user extended attributes on this filesystem
+        assert files.file_checksum(self.fpath, 10, [], providers=providers)[0] == expected
+        assert providers.provided == {'xattr': 1}
+        f = open(self.fpath, 'ab')
+        f.write('k')
+        f.close()
+        os.utime(self.fpath, (s.st_mtime + 10, s.st_mtime + 10))
+        assert providers.checksum(self.fpath, os.stat(self.fpath)) is None
+        
+        # a checksum set without a stamp by another tool is valid until 
+        # the file is written again
+        providers = files.ChecksumProviders(['xattr'])
+        fpath = os.path.join(self.dirpath, 'acquired')
+        f = open(fpath, 'wb')
+        f.write('abcdefghij')
+        f.close()
+        time.sleep(0.01)
+        files._setxattr(fpath, files.XATTR_SHA256, expected)
+        assert providers.checksum(fpath, os.stat(fpath)) == expected
+        time.sleep(0.01)
+        f = open(fpath, 'ab')
+        f.write('k')
+        f.close()
+        assert providers.checksum(fpath, os.stat(fpath)) is None
+
+class TestTreeDigest(unittest.TestCase):
+    def setUp(self):
+        fd, self.fpath = tempfile.mkstemp()
+        os.write(fd, 'abcdefghij')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.fpath)
+
+    def runTest(self):
+        chunks = ['abcd', 'efgh', 'ij']
+        expected = hashlib.sha256(''.join([ hashlib.sha256(c).digest() for c in chunks ])).hexdigest()
+        assert files.tree_digest(self.fpath, 4) == expected
+        assert files.tree_digest(self.fpath, 4, threads=3, blocksize=3) == expected
+        assert files.tree_digest(self.fpath, 4, threads=8) == expected
+        
+        # only files larger than one chunk get a tree checksum
+        checksum, chunksize, digests = files.file_checksum(self.fpath, 10, ['sha256', 'md5'],
+                                                           tree_chunksize=4, tree_threads=2)
+        assert (checksum, chunksize) == (expected, 4)
+        assert digests['sha256'] == files.sha256sum(self.fpath)
+        assert digests['md5'] == 'a925576942e94b2ef57a066101b48876'
+        
+        # the tree and the other digests share one read of the file
+        class Hints(object):
+            hashed_bytes = 0
+            def hashed(self, fd, offset, n):
+                self.hashed_bytes += n
+        hints = Hints()
+        assert files.file_checksum(self.fpath, 10, ['md5'], blocksize=3, tree_chunksize=4,
+                                   tree_threads=2, hints=hints)[2] == {'md5': digests['md5']}
+        assert hints.hashed_bytes == 10
+        
+        checksum, chunksize, digests = files.file_checksum(self.fpath, 10, ['sha256', 'md5'],
+                                                           tree_chunksize=16)
+        assert (checksum, chunksize) == (files.sha256sum(self.fpath), None)
+        assert digests.keys() == ['md5']
+        assert files.file_checksum(self.fpath + '.missing', 10, tree_chunksize=4) is None
+
+class TestTreeDigestCheckpoint(TestTreeDigest):
+    class Checkpoint(object):
+        def __init__(self, leaves):
+            self.leaves = leaves
+            self.saved = []
+        def save(self, leaves, final):
+            self.saved.append((sorted(leaves.keys()), final))
+
+    def runTest(self):
+        # chunks in the checkpoint are not hashed again
+        cp = self.Checkpoint({1: hashlib.sha256('efgh').digest()})
+        expected = files.tree_digest(self.fpath, 4)
+        assert files.tree_digest(self.fpath, 4, checkpoint=cp) == expected
+        assert cp.saved == [([0, 1], False), ([0, 1, 2], False)]
+        cp = self.Checkpoint({1: hashlib.sha256('wxyz').digest()})
+        assert files.tree_digest(self.fpath, 4, checkpoint=cp) != expected
+        # unless other digests need the whole file
+        cp = self.Checkpoint({1: hashlib.sha256('wxyz').digest()})
+        assert files.tree_digest(self.fpath, 4, checkpoint=cp, also=hashlib.md5()) == expected
+        
+        # an interrupted digest saves its progress
+        calls = []
+        def interrupted():
+            calls.append(True)
+            return len(calls) > 2
+        cp = self.Checkpoint({})
+        self.assertRaises(files.Interrupted, files.tree_digest, self.fpath, 4, 
+                          blocksize=2, checkpoint=cp, interrupted=interrupted)
+        assert cp.saved == [([0], False), ([0], True)]
+        self.assertRaises(files.Interrupted, files.file_checksum, self.fpath, 10, 
+                          interrupted=lambda: True)
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+# 
+# Copyright 2010 University of Southern California
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Unit tests for the policy module.
+"""
+
+from tagfiler.iobox import policy
+from tagfiler.iobox.models import File
+
+import unittest
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+def all_tests():
+    """Returns a TestSuite that includes all test cases in this module."""
+    suite = unittest.TestSuite()
+    suite.addTest(ChangePolicyTest())
+    suite.addTest(ChangeDetectorTest())
+    return suite
+
+
+def _file(**kwargs):
+    args = {'filename': '/data/a.txt', 'size': 5, 'mtime': 1.5, 'dev': 1, 
+            'inode': 42, 'mtime_ns': 1500000000, 'ctime_ns': 1500000000}
+    args.update(kwargs)
+    return File(**args)
+
+
+class ChangePolicyTest(unittest.TestCase):
+    
+    def check(self, name, f, exists=None):
+        return policy.POLICIES[name]().check(f, exists or _file())
+    
+    def runTest(self):
+        """Outcomes of each policy for unchanged and changed files."""
+        unchanged = _file()
+        touched = _file(mtime=2.5, mtime_ns=2500000000)
+        replaced = _file(inode=43, ctime_ns=2500000000)
+        resized = _file(size=6)
+        
+        self.assertEqual([self.check('mtime', f) for f in [unchanged, touched, replaced, resized]],
+                         [policy.UNCHANGED, policy.HASH, policy.UNCHANGED, policy.UNCHANGED])
+        self.assertEqual([self.check('paranoid', f) for f in [unchanged, touched, replaced, resized]],
+                         [policy.HASH, policy.HASH, policy.HASH, policy.HASH])
+        self.assertEqual([self.check('stat', f) for f in [unchanged, touched, replaced, resized]],
+                         [policy.UNCHANGED, policy.HASH, policy.HASH, policy.HASH])
+        self.assertEqual([self.check('trust-size', f) for f in [unchanged, touched, replaced, resized]],
+                         [policy.UNCHANGED, policy.UNCHANGED, policy.UNCHANGED, policy.REGISTER])
+        
+        # without a recorded identity the stat policy falls back to mtime
+        self.assertEqual(self.check('stat', replaced, _file(mtime_ns=None)), policy.UNCHANGED)
+        self.assertEqual(self.check('stat', touched, _file(mtime_ns=None)), policy.HASH)
+        # directories are only hashed, to no effect, on a later mtime
+        self.assertEqual(self.check('paranoid', _file(size=None), _file(size=None)), 
+                         policy.UNCHANGED)
+
+
+class ChangeDetectorTest(unittest.TestCase):
+    
+    def runTest(self):
+        """The detector applies one policy and counts hashes avoided by all."""
+        changes = policy.ChangeDetector('stat')
+        self.assertEqual(changes.check(_file(), _file()), policy.UNCHANGED)
+        self.assertEqual(changes.check(_file(size=6), _file()), policy.HASH)
+        self.assertEqual(changes.check(_file(ctime_ns=1), _file()), policy.HASH)
+        # the deferred hash of a file of another size is not avoided
+        self.assertEqual(changes.avoided(), 
+                         {'mtime': 3, 'paranoid': 0, 'stat': 1, 'trust-size': 2})
+        self.assertEqual(changes.summary(), 
+                         "Change policy=stat: hashes avoided mtime=3 paranoid=0 stat=1 trust-size=2")
+        self.assertRaises(ValueError, policy.ChangeDetector, 'never')
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
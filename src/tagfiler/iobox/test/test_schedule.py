@@ -0,0 +1,108 @@
+# 
+# Copyright 2010 University of Southern California
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Unit tests for the schedule module.
+"""
+
+from tagfiler.iobox.threaded import worker, outbox
+from tagfiler.iobox.threaded.schedule import Schedule
+from tagfiler.iobox.models import File
+from tagfiler.util import files
+
+import unittest
+import logging
+import tempfile
+import shutil
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+def all_tests():
+    """Returns a TestSuite that includes all test cases in this module."""
+    suite = unittest.TestSuite()
+    suite.addTest(ScheduleWindowTest())
+    suite.addTest(ScheduleExtentTest())
+    return suite
+
+
+class ScheduleWindowTest(unittest.TestCase):
+    
+    def runTest(self):
+        """Files are held until the window is full, then passed on in inode order."""
+        tasks = worker.WorkQueue()
+        results = worker.WorkQueue()
+        # a busy checksum stage lets files be held
+        results.put('busy')
+        done = []
+        s = Schedule(tasks, results, window=3)
+        for inode in [9, 3, 7, 5, 1]:
+            s.do_work(File(filename='/f%d' % inode, dev=1, inode=inode), done.append)
+        self.assertEqual([ f.inode for f in done ], [3, 7, 9])
+        
+        s.do_work(outbox.Outbox._SUM_DONE, done.append)
+        self.assertEqual([ f.inode for f in done[3:5] ], [1, 5])
+        self.assertTrue(done[5] is outbox.Outbox._SUM_DONE)
+        
+        # an idle checksum stage gets files right away
+        results.get()
+        s.do_work(File(filename='/f2', dev=1, inode=2), done.append)
+        self.assertEqual(done[6].inode, 2)
+        self.assertRaises(ValueError, Schedule, tasks, results, 3, 'random')
+
+
+class ScheduleExtentTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+    
+    def runTest(self):
+        """Files are ordered by first extent, where it is known."""
+        tasks = worker.WorkQueue()
+        results = worker.WorkQueue()
+        results.put('busy')
+        tasks_in = []
+        for i in range(5):
+            fpath = os.path.join(self.tempdir, 'f%d' % i)
+            f = open(fpath, 'wb')
+            f.write(os.urandom(8192))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            s = os.stat(fpath)
+            tasks_in.append(File(filename=fpath, dev=s.st_dev, inode=s.st_ino))
+        tasks_in.append(File(filename=os.path.join(self.tempdir, 'missing'), 
+                             dev=tasks_in[0].dev, inode=0))
+        
+        done = []
+        s = Schedule(tasks, results, window=len(tasks_in), order='extent')
+        for f in reversed(tasks_in):
+            s.do_work(f, done.append)
+        extents = [ files.first_extent(f.filename) for f in done ]
+        # files without a known extent follow the others
+        known = [ e for e in extents if e is not None ]
+        self.assertEqual(extents, known + [None] * (len(extents) - len(known)))
+        self.assertEqual(known, sorted(known))
+        self.assertEqual(len(done), len(tasks_in))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
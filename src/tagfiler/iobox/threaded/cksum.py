@@ -19,29 +19,161 @@ Implements the checksum stage of the Outbox.
 
 from worker import Worker
 from tagfiler.iobox.models import File
+from tagfiler.iobox.dao import OutboxStateDAO
+from tagfiler.iobox.checkpoint import ChecksumCheckpoint
 from tagfiler.util import files
 import outbox
 
 import logging
+import time
+import itertools
 
 
 logger = logging.getLogger(__name__)
 
 
 class Checksum(Worker):
-    """The checksum pipeline worker."""
+    """The checksum pipeline worker.
+    
+    Several Checksum workers may share one task queue. The worker that takes
+    the SUM_DONE marker waits until the tasks taken by the other workers are
+    done before passing the marker on, so that it follows all of their 
+    results.
+    """
+    
+    def __init__(self, tasks, results, blocksize=None, use_mmap=False, 
+                 digests=[], tree_chunksize=None, tree_threads=1, state_db=None,
+                 prefetch_files=0, hints=None, providers=None, state_profile='safe'):
+        """Initializes the Checksum worker.
+        
+        The 'blocksize' and 'use_mmap' parameters are passed to 
+        files.file_checksum. By default, files.CHECKSUM_BLOCKSIZE bytes are 
+        read at a time.
+        
+        The 'digests' parameter names digests to compute, from the same read
+        of each file, in addition to the checksum.
+        
+        When 'tree_chunksize' is set, the checksum of files larger than one
+        chunk is their files.tree_digest, computed by 'tree_threads' threads.
+        Their progress is checkpointed in the 'state_db' state database, if
+        given, and resumed from there after the Outbox is restarted. It is
+        opened with the dao.PROFILES entry 'state_profile'. Other checksums
+        are plain SHA-256, whose state cannot be saved: when interrupted, 
+        they start over from the first byte.
+        
+        Before hashing a file, the start of the next 'prefetch_files' files 
+        waiting in the queue is read ahead, and the reads are given the 
+        page cache hints of the files.IOHints 'hints', which workers 
+        sharing a queue should share too.
+        
+        The files.ChecksumProviders 'providers', if given, supply checksums
+        stored with the files instead of reading them.
+        """
+        super(Checksum, self).__init__(tasks, results)
+        self._blocksize = blocksize or files.CHECKSUM_BLOCKSIZE
+        self._use_mmap = use_mmap
+        self._digests = digests
+        self._tree_chunksize = tree_chunksize
+        self._tree_threads = tree_threads
+        self._state_db = state_db
+        self._state_profile = state_profile
+        self._state = None
+        self._prefetch_files = prefetch_files
+        self.hints = hints or files.IOHints()
+        self.providers = providers
+        self.files = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        self.started = None
+        self.finished = None
+    
+    def on_start(self):
+        # sqlite connections may only be used by the thread that opened them.
+        # Checkpoints are saved seldom and committed at once, so that this
+        # connection does not keep the Dispatcher's from writing.
+        if self._tree_chunksize and self._state_db:
+            try:
+                self._state = OutboxStateDAO(self._state_db, commit_rows=1,
+                                             profile=self._state_profile)
+            except Exception as e:
+                return e
+    
+    def on_terminate(self, work_done):
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+    
+    def _interrupted(self):
+        return self._terminate
+    
+    def _checkpoint(self, task):
+        """Returns a ChecksumCheckpoint for 'task', if it gets a tree checksum."""
+        if self._state is None or not task.size or task.size <= self._tree_chunksize:
+            return None
+        try:
+            return ChecksumCheckpoint(self._state, task.filename, self._tree_chunksize)
+        except OSError:
+            return None
+    
+    def _prefetch(self):
+        """Reads ahead the next files in the queue."""
+        q = self._tasks
+        q.mutex.acquire()
+        try:
+            upcoming = list(itertools.islice(q.queue, self._prefetch_files))
+        finally:
+            q.mutex.release()
+        for task in upcoming:
+            if isinstance(task, File) and task.size:
+                self.hints.prefetch(task.filename)
+    
+    def _wait_drained(self):
+        """Waits until the only unfinished task in the queue is our own."""
+        q = self._tasks
+        q.all_tasks_done.acquire()
+        try:
+            while q.unfinished_tasks > 1 and not self._terminate:
+                # all_tasks_done is only notified when no tasks remain
+                q.all_tasks_done.wait(0.1)
+        finally:
+            q.all_tasks_done.release()
 
     def do_work(self, task, work_done):
         logger.debug('Checksum:do_work: %s' % task)
         
         if task is outbox.Outbox._SUM_DONE:
+            self._wait_drained()
             work_done(task)
             return
         
         try:
             assert isinstance(task, File)
-            checksum = files.sha256sum(task.filename) #TODO: this needs to be interuptable
-            if task.status == File.COMPUTE:
+            start = time.time()
+            if self.started is None:
+                self.started = start
+            if self._prefetch_files:
+                self._prefetch()
+            cp = self._checkpoint(task)
+            try:
+                result = files.file_checksum(task.filename, task.size, self._digests,
+                                             self._blocksize, self._use_mmap,
+                                             self._tree_chunksize, 
+                                             self._tree_threads, cp, 
+                                             self._interrupted, self.hints,
+                                             self.providers)
+            except files.Interrupted:
+                logger.debug('Checksum:interrupted: %s' % task.filename)
+                return
+            if result is not None and cp is not None:
+                cp.clear()
+            self.finished = time.time()
+            self.elapsed += self.finished - start
+            self.files += 1
+            self.bytes += task.size or 0
+            checksum = None
+            if result is not None:
+                (checksum, task.tree_chunksize, task.digests) = result
+            if task.status in (File.COMPUTE, File.BACKFILL):
                 task.checksum = checksum
             else:
                 task.compare = checksum
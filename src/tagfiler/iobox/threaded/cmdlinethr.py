@@ -19,8 +19,13 @@ Command-line interface for the Tagfiler Outbox.
 
 import outbox
 from tagfiler.iobox import version
-from tagfiler.iobox.models import RERule, Outbox, create_default_name_path_rule
+from tagfiler.iobox.models import RERule, Outbox, Listing, create_default_name_path_rule
+from tagfiler.iobox.policy import POLICIES
+from tagfiler.iobox.dao import PROFILES
+from tagfiler.iobox.threaded.schedule import ORDERS
 from tagfiler.util.http import TagfilerClient, UnresolvedAddress, NetworkError, ProtocolError, MalformedURL
+from tagfiler.util import files
+from tagfiler.util.files import CHECKSUM_BLOCKSIZE, CHECKSUM_PROVIDERS, DIGESTS, TREE_DIGEST, new_digest
 
 import os
 import sys
@@ -44,6 +49,10 @@ __DESC = "The Tagfiler Outbox command-line utility."
 __VER  = "%(prog)s " + ("%d.%d trunk" % (version.MAJOR, version.MINOR))
 __DEFAULT_OUTBOX_NAME = "outbox"
 __BULK_OPS_MAX = 1000
+__SCAN_THREADS = 1
+__CHECKSUM_WORKERS = 1
+__SCHEDULE_WINDOW = 1000
+__TREE_THREADS = 4
 
 # Verbosity to Loglevel dictionary
 __LOGLEVEL = {0: logging.ERROR,
@@ -85,6 +94,9 @@ def main(args=None):
     parser.add_argument('-s', '--state_db', type=str, 
                         help=('local state database (default: %s)' % 
                               default_state_db))
+    parser.add_argument('--state-profile', choices=sorted(PROFILES.keys()),
+                        help='durability of the local state database' + \
+                        ' (default: safe)')
     
     # Use username#hostname as default endpoint
     default_endpoint = "gsiftp://%s" % socket.gethostname()
@@ -105,10 +117,77 @@ def main(args=None):
     group.add_argument('--root', metavar='DIRECTORY', 
                        type=str, nargs='+',
                        help='root directories to be traversed recursively')
+    group.add_argument('--listing', metavar=('DIRECTORY', 'LISTING'), 
+                       type=str, nargs=2, action='append',
+                       help='read the tree at DIRECTORY from the file' + \
+                       ' LISTING instead of traversing it')
     group.add_argument('--exclude', type=str, nargs='+',
                        help='exclude based on regular expression')
     group.add_argument('--include', type=str, nargs='+',
                        help='include based on regular expression')
+    group.add_argument('--prune', action='store_true',
+                       help='do not descend into excluded directories')
+    group.add_argument('--scan-threads', metavar='N', type=int,
+                       help='number of threads used to scan directories' + \
+                       ' (default: %d)' % __SCAN_THREADS)
+    group.add_argument('--preload-names', action='store_true',
+                       help='load all user and group names before scanning')
+    group.add_argument('--preload-state', action='store_true',
+                       help='load the state of all files before scanning')
+    group.add_argument('--preload-limit', metavar='MB', type=int,
+                       help='memory for the preloaded state, above which' + \
+                       ' files are looked up one at a time (default: 1024)')
+    group.add_argument('--dir-fingerprints', action='store_true',
+                       help='skip the files of unchanged directories in bulk')
+    group.add_argument('--reconcile', action='store_true',
+                       help='scan the roots in path order, merging them with' + \
+                       ' the state of their files')
+    group.add_argument('--sweep-deleted', action='store_true',
+                       help='unregister the files of the roots no longer found')
+    
+    # Checksum option group
+    group = parser.add_argument_group(title='Checksum options')
+    group.add_argument('--checksum-blocksize', metavar='BYTES', type=int,
+                       help='bytes read per block while computing checksums' + \
+                       ' (default: %d)' % CHECKSUM_BLOCKSIZE)
+    group.add_argument('--checksum-mmap', action='store_true',
+                       help='memory map large files while computing checksums')
+    group.add_argument('--prefetch-files', metavar='N', type=int,
+                       help='read ahead the next N files waiting to be hashed')
+    group.add_argument('--drop-behind', action='store_true',
+                       help='drop hashed data from the page cache')
+    group.add_argument('--lazy-checksums', action='store_true',
+                       help='register new files first and hash them afterwards')
+    group.add_argument('--checksum-providers', metavar='NAME', type=str, nargs='+',
+                       help='reuse the checksums stored with files' + \
+                       ' (choose from: %s)' % ', '.join(CHECKSUM_PROVIDERS))
+    group.add_argument('--xattr-writeback', action='store_true',
+                       help='store computed checksums in extended attributes')
+    group.add_argument('--checksum-workers', metavar='N', type=int,
+                       help='number of threads computing checksums' + \
+                       ' (default: %d)' % __CHECKSUM_WORKERS)
+    group.add_argument('--device-workers', metavar='PATH=N', type=str, nargs='+',
+                       help='hash files on each device on their own workers,' + \
+                       ' N for the device holding PATH and the number of' + \
+                       ' checksum workers for any other')
+    group.add_argument('--schedule-order', choices=ORDERS,
+                       help='read files in on-disk order, by inode or by' + \
+                       ' physical extent where the filesystem reports it')
+    group.add_argument('--schedule-window', metavar='N', type=int,
+                       help='number of files reordered at a time' + \
+                       ' (default: %d)' % __SCHEDULE_WINDOW)
+    group.add_argument('--digests', metavar='NAME', type=str, nargs='+',
+                       help='digests to compute and register as tags' + \
+                       ' (choose from: %s)' % ', '.join(DIGESTS))
+    group.add_argument('--tree-chunksize', metavar='BYTES', type=int,
+                       help='use the %s digest, in chunks of BYTES,' % TREE_DIGEST + \
+                       ' as the checksum of larger files')
+    group.add_argument('--tree-threads', metavar='N', type=int,
+                       help='number of threads hashing the chunks of a file' + \
+                       ' (default: %d)' % __TREE_THREADS)
+    group.add_argument('--change-policy', choices=sorted(POLICIES.keys()),
+                       help='how files seen before are checked for changes' + \
+                       ' (default: mtime)')
     
     # Tagfiler option group
     group = parser.add_argument_group(title='Tagfiler options')
@@ -153,6 +232,10 @@ def main(args=None):
     outbox_model.name = args.name or cfg.get('name', __DEFAULT_OUTBOX_NAME)
     outbox_model.state_db = args.state_db or \
                             cfg.get('state_db', default_state_db)
+    outbox_model.state_profile = args.state_profile or \
+                                 cfg.get('state_profile', 'safe')
+    if outbox_model.state_profile not in PROFILES:
+        parser.error("Unsupported state database profile: %s" % outbox_model.state_profile)
 
     # Tagfiler settings
     outbox_model.url = args.url or cfg.get('url')
@@ -176,12 +259,20 @@ def main(args=None):
                                 cfg.get('endpoint', default_endpoint)
 
     # Roots
-    roots = args.root or cfg.get('roots')
-    if not roots or not len(roots):
-        parser.error('At least one root directory must be given.')
+    roots = args.root or cfg.get('roots') or []
     for root in roots:
         outbox_model.roots.append(root)
     
+    # Listings, read instead of traversing their root directories
+    if args.listing:
+        for (root, filename) in args.listing:
+            outbox_model.listings.append(Listing(root=root, filename=filename))
+    else:
+        for listing in cfg.get('listings', []):
+            outbox_model.listings.append(Listing(**listing))
+    if not outbox_model.roots and not outbox_model.listings:
+        parser.error('At least one root directory or listing must be given.')
+    
     # Add include/exclusion patterns
     excludes = args.exclude or cfg.get('excludes')
     if excludes and len(excludes):
@@ -193,6 +284,78 @@ def main(args=None):
         for include in includes:
             outbox_model.includes.append(re.compile(include))
     
+    outbox_model.prune = args.prune or cfg.get('prune', False)
+    outbox_model.scan_threads = args.scan_threads or \
+                                cfg.get('scan_threads', __SCAN_THREADS)
+    outbox_model.scan_threads = int(outbox_model.scan_threads)
+    outbox_model.preload_names = args.preload_names or \
+                                 cfg.get('preload_names', False)
+    outbox_model.preload_state = args.preload_state or \
+                                 cfg.get('preload_state', False)
+    outbox_model.preload_limit = int(args.preload_limit or 
+                                     cfg.get('preload_limit', 1024))
+    outbox_model.dir_fingerprints = args.dir_fingerprints or \
+                                    cfg.get('dir_fingerprints', False)
+    outbox_model.reconcile = args.reconcile or cfg.get('reconcile', False)
+    outbox_model.sweep_deleted = args.sweep_deleted or \
+                                 cfg.get('sweep_deleted', False)
+    
+    # Checksum settings
+    outbox_model.checksum_blocksize = args.checksum_blocksize or \
+                        cfg.get('checksum_blocksize', CHECKSUM_BLOCKSIZE)
+    outbox_model.checksum_blocksize = int(outbox_model.checksum_blocksize)
+    outbox_model.checksum_mmap = args.checksum_mmap or \
+                                 cfg.get('checksum_mmap', False)
+    outbox_model.prefetch_files = int(args.prefetch_files or 
+                                      cfg.get('prefetch_files', 0))
+    outbox_model.drop_behind = args.drop_behind or cfg.get('drop_behind', False)
+    outbox_model.lazy_checksums = args.lazy_checksums or \
+                                  cfg.get('lazy_checksums', False)
+    outbox_model.checksum_providers = args.checksum_providers or \
+                                      cfg.get('checksum_providers', [])
+    outbox_model.xattr_writeback = args.xattr_writeback or \
+                                   cfg.get('xattr_writeback', False)
+    try:
+        files.ChecksumProviders(outbox_model.checksum_providers)
+    except ValueError as e:
+        parser.error(str(e))
+    outbox_model.checksum_workers = args.checksum_workers or \
+                        cfg.get('checksum_workers', __CHECKSUM_WORKERS)
+    outbox_model.checksum_workers = int(outbox_model.checksum_workers)
+    if args.device_workers:
+        for arg in args.device_workers:
+            (path, sep, n) = arg.rpartition('=')
+            if not sep or not path or not n.isdigit():
+                parser.error("Malformed device workers: %s" % arg)
+            outbox_model.device_workers[path] = int(n)
+    else:
+        outbox_model.device_workers = cfg.get('device_workers', {})
+    schedule_order = args.schedule_order or cfg.get('schedule_order')
+    schedule_window = args.schedule_window or cfg.get('schedule_window')
+    if schedule_order or schedule_window:
+        outbox_model.schedule_order = schedule_order or 'inode'
+        if outbox_model.schedule_order not in ORDERS:
+            parser.error("Unsupported schedule order: %s" % outbox_model.schedule_order)
+        outbox_model.schedule_window = int(schedule_window or __SCHEDULE_WINDOW)
+    digests = args.digests or cfg.get('digests', [])
+    for digest in digests:
+        try:
+            new_digest(digest)
+        except ValueError as e:
+            parser.error(str(e))
+        outbox_model.digests.append(digest)
+    outbox_model.tree_chunksize = args.tree_chunksize or \
+                                  cfg.get('tree_chunksize')
+    if outbox_model.tree_chunksize:
+        outbox_model.tree_chunksize = int(outbox_model.tree_chunksize)
+    outbox_model.tree_threads = args.tree_threads or \
+                                cfg.get('tree_threads', __TREE_THREADS)
+    outbox_model.tree_threads = int(outbox_model.tree_threads)
+    outbox_model.change_policy = args.change_policy or \
+                                 cfg.get('change_policy', 'mtime')
+    if outbox_model.change_policy not in POLICIES:
+        parser.error("Unsupported change policy: %s" % outbox_model.change_policy)
+    
     # Add the default 'name' tag path rule
     name_rule = create_default_name_path_rule(outbox_model.endpoint)
     outbox_model.path_rules.append(name_rule)
@@ -221,6 +384,9 @@ def main(args=None):
         print >> sys.stderr, ('ERROR: %s' % err)
         return __EXIT_FAILURE
     
+    if outbox_model.preload_names:
+        files.preload_names()
+    
     # Now, create the outbox manager and let it run to completion
     outbox_manager = outbox.Outbox(outbox_model, client)
     outbox_manager.start()
@@ -231,9 +397,41 @@ def main(args=None):
     # Print final message unless '--quiet'
     if not args.quiet:
         # Print concluding message to stdout
-        print "Done. Found=%s Skipped=%s Registered=%s (Errors=%s)" % \
-            (outbox_manager.found, outbox_manager.skipped, 
+        print "Done. Found=%s Skipped=%s Moved=%s Registered=%s (Errors=%s)" % \
+            (outbox_manager.found, outbox_manager.skipped, outbox_manager.moved,
              outbox_manager.registered, len(outbox_manager.errors))
+        for (name, nfiles, nbytes, elapsed) in outbox_manager.checksum_stats:
+            print "Checksum %s: Files=%d MB=%.1f Time=%.1fs Rate=%.1f MB/s" % \
+                (name, nfiles, nbytes / 1048576.0, elapsed, 
+                 nbytes / 1048576.0 / elapsed if elapsed else 0.0)
+        for (label, nworkers, nfiles, nbytes, elapsed) in outbox_manager.device_stats:
+            print "Device %s: Workers=%d Files=%d MB=%.1f Time=%.1fs Rate=%.1f MB/s" % \
+                (label, nworkers, nfiles, nbytes / 1048576.0, elapsed, 
+                 nbytes / 1048576.0 / elapsed if elapsed else 0.0)
+        if outbox_model.prefetch_files or outbox_model.drop_behind:
+            (prefetched, dropped) = outbox_manager.io_hints
+            print "I/O hints: Prefetched=%d files Dropped=%.1f MB" % \
+                (prefetched, dropped / 1048576.0)
+        if outbox_manager.index_stats:
+            (complete, nfiles, nbytes, fallbacks) = outbox_manager.index_stats
+            print "State index: %s Files=%d MB=%.1f Fallbacks=%d" % \
+                ('Preloaded' if complete else 'Over limit,', nfiles, 
+                 nbytes / 1048576.0, fallbacks)
+        if outbox_manager.reconcile_stats:
+            print "Reconcile: Deleted=%d Fallbacks=%d" % outbox_manager.reconcile_stats
+        if outbox_manager.providers_stats:
+            (provided, written) = outbox_manager.providers_stats
+            print "Checksum providers: %s Written=%d" % \
+                (' '.join([ '%s=%d' % (n, c) for (n, c) in provided ]), written)
+        if outbox_model.lazy_checksums:
+            print "Lazy checksums: Deferred=%d Backfilled=%d Missing=%d" % \
+                (outbox_manager.deferred, outbox_manager.backfilled, 
+                 outbox_manager.missing)
+        if outbox_model.sweep_deleted:
+            print "Sweep: Unregistered=%d Pruned=%d" % \
+                (outbox_manager.unregistered, outbox_manager.pruned)
+        if outbox_manager.changes:
+            print outbox_manager.changes.summary()
             
         # Print errors to stderr
         errors = outbox_manager.errors
@@ -241,6 +439,9 @@ def main(args=None):
             print >> sys.stderr, "The following errors were encountered:"
             for error in errors:
                 print >> sys.stderr, error
+    logger.info("Name cache: users hits=%d misses=%d, groups hits=%d misses=%d" % 
+                (files.user_names.hits, files.user_names.misses, 
+                 files.group_names.hits, files.group_names.misses))
     
     # Wait for outbox to terminate
     while not outbox_manager.is_alive():
@@ -0,0 +1,135 @@
+# 
+# Copyright 2010 University of Southern California
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Implements the optional per-device routing of the checksum stage of the 
+Outbox, so that a slow device does not hold up the files of the others.
+"""
+
+from worker import Worker, WorkQueue
+from tagfiler.iobox.models import File
+import outbox
+
+import os
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+def device_label(dev):
+    """Returns 'major:minor' for device number 'dev', or '?' if unknown."""
+    if dev is None:
+        return '?'
+    return '%d:%d' % (os.major(dev), os.minor(dev))
+
+
+class Router(Worker):
+    """The per-device routing pipeline worker.
+    
+    Each file is put on the queue of its device, identified by its 'dev'. 
+    Each device queue gets its own pool of Checksum workers, created by the
+    'new_worker(tasks)' function when the device is first seen. The number
+    of workers of a device is given by 'device_workers', a dictionary keyed
+    by the path of any file on the device, and defaults to 
+    'default_workers'. On SUM_DONE, the router waits until all device 
+    queues are done before passing the marker on.
+    """
+    
+    def __init__(self, tasks, results, new_worker, device_workers={}, 
+                 default_workers=1):
+        super(Router, self).__init__(tasks, results)
+        self._new_worker = new_worker
+        self._default_workers = max(1, default_workers)
+        self._limits = {}
+        self._labels = {}
+        for path, n in device_workers.items():
+            try:
+                dev = os.stat(path).st_dev
+            except OSError as e:
+                logger.warning("Ignoring workers of device of %s: %s" % (path, e))
+                continue
+            self._limits[dev] = max(1, int(n))
+            self._labels[dev] = path
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._workers = {}
+    
+    def workers(self):
+        """Returns the Checksum workers created so far."""
+        with self._lock:
+            return [ w for ws in self._workers.values() for w in ws ]
+    
+    def device_stats(self):
+        """Returns (label, workers, files, bytes, elapsed) for each device.
+        
+        The elapsed time runs from the first file started to the last file
+        finished by the device's workers.
+        """
+        stats = []
+        with self._lock:
+            for dev, ws in sorted(self._workers.items()):
+                label = self._labels.get(dev, device_label(dev))
+                started = [ w.started for w in ws if w.started is not None ]
+                finished = [ w.finished for w in ws if w.finished is not None ]
+                elapsed = 0.0
+                if started and finished:
+                    elapsed = max(finished) - min(started)
+                stats.append((label, len(ws), sum([ w.files for w in ws ]),
+                              sum([ w.bytes for w in ws ]), elapsed))
+        return stats
+    
+    def backlog(self):
+        """Returns the number of files waiting on the router and device queues."""
+        with self._lock:
+            queues = self._queues.values()
+        return self._tasks.qsize() + sum([ q.qsize() for q in queues ])
+    
+    def _queue(self, dev):
+        """Returns the queue of device 'dev', starting its workers if new."""
+        q = self._queues.get(dev)
+        if q is None:
+            q = WorkQueue()
+            n = self._limits.get(dev, self._default_workers)
+            logger.debug("Router: device %s, %d workers" % (device_label(dev), n))
+            ws = [ self._new_worker(q) for i in range(n) ]
+            with self._lock:
+                self._queues[dev] = q
+                self._workers[dev] = ws
+            for w in ws:
+                w.start()
+        return q
+    
+    def _wait_done(self):
+        """Waits until the tasks of all device queues are done."""
+        for q in self._queues.values():
+            q.all_tasks_done.acquire()
+            try:
+                while q.unfinished_tasks and not self._terminate:
+                    q.all_tasks_done.wait(0.1)
+            finally:
+                q.all_tasks_done.release()
+    
+    def do_work(self, task, work_done):
+        logger.debug('Router:do_work: %s' % task)
+        
+        if task is outbox.Outbox._SUM_DONE:
+            self._wait_done()
+            work_done(task)
+            return
+        
+        assert isinstance(task, File)
+        self._queue(task.dev).put(task)
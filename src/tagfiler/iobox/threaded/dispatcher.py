@@ -21,24 +21,37 @@ to the next workers task queue.
 """
 
 from worker import Worker
-from tagfiler.iobox.dao import OutboxStateDAO
-from tagfiler.iobox.models import File
+from tagfiler.iobox.dao import OutboxStateDAO, FileIndex, MergeJoin, PRELOAD_LIMIT, COMMIT_SECONDS
+from tagfiler.iobox.models import File, Directory
+from tagfiler.iobox import policy
+from tagfiler.util import files
 import outbox
 
 import logging
+import os
 
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of registered files whose update is batched
+REGISTERED_BATCH = 1000
+
 
 class Dispatcher(Worker):
     """The worker thread for the 'Dispatcher' for the Tagfiler Outbox."""
     
-    def __init__(self, state_db, tasks, sumq, tagq, registerq, donecb=None, a=None):
+    # Writes still pending when no task arrives are due by then
+    idle_timeout = COMMIT_SECONDS
+    
+    def __init__(self, state_db, tasks, sumq, tagq, registerq, donecb=None, a=None,
+                 change_policy='mtime', lazy_checksums=False, state_profile='safe',
+                 preload=None, preload_limit=PRELOAD_LIMIT, reconcile=None,
+                 sweep=None):
         """Initializes the dispatcher object.
         
         The 'state_db' parameter is the filename for the state database. Thus
-        in sqlite3 terms, the file is the database.
+        in sqlite3 terms, the file is the database. It is opened with the 
+        dao.PROFILES entry 'state_profile'.
         
         The 'tasks' parameter is a threading.Queue object used as the input
         queue for this Worker. The 'sumq', 'tagq', and 'registerq' paremeters
@@ -50,12 +63,50 @@ class Dispatcher(Worker):
         processes the various DONE markers that trace through the pipeline. 
         The callback will be invoked passing the option 'a' parameter as such, 
         '...done(a)'. The nondescript name 'a' is typically used by convention.
+        
+        The 'change_policy' parameter names the policy.POLICIES entry used to
+        decide whether a file seen before has changed.
+        
+        When 'lazy_checksums' lists the root directories, new files are 
+        registered without their checksum. Once all files are registered, 
+        the files under them registered without a checksum, including those
+        left by an interrupted run, are hashed in a backfill pass and 
+        registered again with only their name and checksum tags. Those no 
+        longer found are counted in 'missing' and left to the sweep or, 
+        without one, their entries are deleted.
+        
+        When 'preload' lists directories, the state of the files under them 
+        is read into a dao.FileIndex when the Dispatcher starts, and files 
+        are looked up there, unless it would need more than 'preload_limit'
+        bytes of memory.
+        
+        When 'reconcile' lists the root directories, scanned in path order,
+        the files under them are looked up through a dao.MergeJoin instead.
+        The files of the state database under them that are no longer found
+        are counted in 'deleted' once the Find stage is done.
+        
+        When 'sweep' lists the root directories, the entries of the files 
+        found are stamped with a new generation. Once all files are 
+        registered, the entries under them of an earlier generation, those
+        of files no longer found, are swept: the registered files are
+        unregistered in bulk by the Register worker, and all of the entries
+        are deleted. Nothing is swept after errors, nor under a root that is
+        not a directory or a directory that could not be listed, see 
+        find.Find.
         """
         super(Dispatcher, self).__init__(tasks, None)
         self._donecb = donecb
         self._a = a
         self._state = None
         self._state_db = state_db
+        self._state_profile = state_profile
+        self._preload = preload
+        self._preload_limit = preload_limit
+        self._reconcile = reconcile
+        self._sweep_dirnames = sweep
+        self._lookup = None
+        self.index = None
+        self.merge = None
         self._sumq = sumq
         self._tagq = tagq
         self._regq = registerq
@@ -63,16 +114,128 @@ class Dispatcher(Worker):
         self.found = 0
         self.registered = 0
         self.skipped = 0
+        self.moved = 0
+        self.changes = policy.ChangeDetector(change_policy)
+        self.deferred = 0
+        self.backfilled = 0
+        self.deleted = 0
+        self.unregistered = 0
+        self.pruned = 0
+        self.missing = 0
+        self._lazy = lazy_checksums
+        self._backfilling = False
+        self._sweeping = False
+        # Ids of the entries of files found, not yet stamped
+        self._stamped = []
+        # Registered files, not yet updated in the state database
+        self._registered = []
+        # Files found since the last Directory and not skipped
+        self._dir_pending = 0
+        # Directories that could not be listed, with a trailing '/'
+        self._failed = []
         
     def on_start(self):
         """Initializes the Outbox state persistence object."""
-        self._state = OutboxStateDAO(self._state_db)
+        self._state = OutboxStateDAO(self._state_db, 
+                                     profile=self._state_profile)
+        self._lookup = self._state
+        if self._sweep_dirnames:
+            self._state.start_generation()
+        if self._reconcile:
+            self.merge = MergeJoin(self._state, self._reconcile)
+            self._lookup = self.merge
+        elif self._preload:
+            self.index = FileIndex(self._state, self._preload, self._preload_limit)
+            if self.index.complete:
+                self._lookup = self.index
     
     def on_terminate(self, work_done):
         """Closes the outbox state persistence object."""
+        self._flush(True)
         self._state.close()
 
+    def on_idle(self, work_done):
+        """Writes the files waiting and commits them, once no task arrives."""
+        self._flush(False, True)
+
+    def _flush(self, force, idle=False):
+        """Updates the registered files and commits the state database.
+        
+        Unless 'force' is set, the registered files are only updated once 
+        REGISTERED_BATCH of them are waiting or the Dispatcher is 'idle', 
+        and the state database only commits its batched writes when due.
+        """
+        write = force or idle
+        if self._registered and (write or len(self._registered) >= REGISTERED_BATCH):
+            self._state.update_files(self._registered)
+            self._registered = []
+        if self._stamped and (write or len(self._stamped) >= REGISTERED_BATCH):
+            self._state.stamp_files(self._stamped)
+            self._stamped = []
+        self._state.commit(force)
+
+    def _backfill(self):
+        """Starts the backfill pass over the files registered without a 
+        checksum, followed by another round of DONE markers."""
+        self._backfilling = True
+        deferred = self._state.find_deferred_files(self._lazy)
+        logger.debug("Backfilling the checksums of %d files" % len(deferred))
+        for f in deferred:
+            if not os.path.isfile(f.filename):
+                logger.debug("Not found, checksum deferred: %s" % f.filename)
+                self.missing += 1
+                if not self._sweep_dirnames:
+                    self._state.delete_files([f])
+                continue
+            f.status = File.BACKFILL
+            self._sumq.put(f)
+        self._sumq.put(outbox.Outbox._SUM_DONE)
+
+    def _sweep(self):
+        """Starts the sweep of the files no longer found, followed by another
+        round of DONE markers.
+        
+        The registered files go through the Tag worker, for their names, and 
+        the Register worker; the entries of the others are deleted at once.
+        """
+        self._sweeping = True
+        if self.errors:
+            # files the scan failed to find would be taken for deleted
+            logger.warning("Not sweeping deleted files after %d errors" % len(self.errors))
+        else:
+            failed = tuple(self._failed)
+            for dirname in self._sweep_dirnames:
+                if not os.path.isdir(dirname):
+                    logger.warning("Not sweeping %s, not a directory" % dirname)
+                    continue
+                # the files under directories not listed were not looked for
+                for f in self._state.find_swept_files(dirname):
+                    if f.filename.startswith(failed):
+                        continue
+                    logger.debug("Deleted: %s" % f.filename)
+                    if f.rtime:
+                        f.status = File.DELETE
+                        self._tagq.put(f)
+                    else:
+                        self.pruned += 1
+                        self._state.delete_files([f])
+        self._tagq.put(outbox.Outbox._TAG_DONE)
+
     def do_work(self, task, work_done):
+        """Dispatches 'task', then commits the state database in batches.
+        
+        The writes are committed once COMMIT_ROWS of them are pending or the
+        oldest of them is COMMIT_SECONDS old, see OutboxStateDAO.commit, and
+        at the latest 'idle_timeout' seconds after the last task, so that 
+        other connections to the state database are not kept waiting. They
+        are forced at the FIND_DONE and REG_DONE markers and on termination.
+        Files are only marked registered after the Register worker passes
+        them on, once the server has accepted them.
+        """
+        self._dispatch(task)
+        self._flush(False)
+
+    def _dispatch(self, task):
         logger.debug("do_work: %s" % task)
         
         #
@@ -86,6 +249,11 @@ class Dispatcher(Worker):
         # Process control flow flags
         #
         if task is outbox.Outbox._FIND_DONE:
+            self._flush(True)
+            if self.merge:
+                # Count the files of the roots no longer found
+                self.merge.finish()
+                self.deleted = self.merge.deleted
             self._sumq.put(outbox.Outbox._SUM_DONE)
             return
         elif task is outbox.Outbox._SUM_DONE:
@@ -95,32 +263,100 @@ class Dispatcher(Worker):
             self._regq.put(outbox.Outbox._REG_DONE)
             return
         elif task is outbox.Outbox._REG_DONE:
+            self._flush(True)
+            if self._lazy and not self._backfilling:
+                self._backfill()
+                return
+            if self._sweep_dirnames and not self._sweeping:
+                self._sweep()
+                return
             if self._donecb:
                 self._donecb(self._a)
             return
         
+        #
+        # Process directory fingerprints
+        #
+        if isinstance(task, Directory):
+            if task.failed:
+                # Case: Directory not listed, its files are not swept
+                self._failed.append(task.dirname.rstrip('/') + '/')
+                return
+            if task.skipped:
+                # Case: Directory unchanged, its files were not output
+                self.found += task.count
+                self.skipped += task.count
+                if self._sweep_dirnames:
+                    self._state.stamp_filenames(task.filenames)
+            elif task.fingerprint and not self._dir_pending:
+                # Case: All its files were skipped, record its fingerprint
+                self._state.save_fingerprint(task.dirname, task.fingerprint)
+            self._dir_pending = 0
+            return
+        
         #
         # Process persistent checkpointing
         #
         if task.status is None:
             # Case: we are in the FIND stage
             self.found += 1
-            exists = self._state.find_file(task.filename)
-            if exists: task.id = exists.id
+            self._dir_pending += 1
+            exists = self._lookup.find_file(task.filename)
+            if exists: 
+                task.id = exists.id
+                if self._sweep_dirnames:
+                    self._stamped.append(exists.id)
+                if exists.superseded_by:
+                    # The file is back under its old name
+                    self._state.supersede_file(exists, None)
                 
+            moved = None
+            change = None
             if not exists:
+                moved = self._state.find_moved_file(task)
+            else:
+                change = self.changes.check(task, exists)
+                
+            if moved:
+                # Case: File moved or linked from a file seen before
+                logger.debug("Moved: %s -> %s" % (moved.filename, task.filename))
+                self.moved += 1
+                task.checksum = moved.checksum
+                task.tree_chunksize = moved.tree_chunksize
+                task.digests = moved.digests
+                task.status = File.REGISTER
+                self._state.add_files([task])
+                identity = files.path_identity(moved.filename)
+                if not identity or identity[:2] != (moved.dev, moved.inode):
+                    self._state.supersede_file(moved, task.filename)
+                self._tagq.put(task)
+            elif not exists and self._lazy and task.size:
+                # Case: New file, its checksum is deferred
+                logger.debug("New, checksum deferred: %s" % task.filename)
+                self.deferred += 1
+                task.status = File.REGISTER
+                self._state.add_files([task])
+                self._tagq.put(task)
+            elif not exists:
                 # Case: New file, not seen before
                 logger.debug("New: %s" % task.filename)
                 task.status = File.COMPUTE
                 self._sumq.put(task)
-            elif task.mtime > exists.mtime:
+            elif change == policy.HASH:
                 # Case: File has changed since last seen
                 logger.debug("Modified: %s" % task.filename)
                 task.checksum = exists.checksum
                 task.rtime = exists.rtime
                 task.status = File.COMPARE
                 self._sumq.put(task)
-            elif task.size and not exists.checksum:
+            elif change == policy.REGISTER:
+                # Case: File has changed, its checksum is deferred
+                logger.debug("Modified, checksum deferred: %s" % task.filename)
+                task.rtime = None
+                task.status = File.REGISTER
+                self._state.update_files([task])
+                self._tagq.put(task)
+            elif task.size and not exists.checksum and not self._lazy:
                 # Case: Missing checksum, on regular file
                 logger.debug("Missing checksum: %s" % task.filename)
                 task.checksum = exists.checksum
@@ -130,26 +366,39 @@ class Dispatcher(Worker):
             elif not exists.rtime:
                 # Case: File has not been registered
                 logger.debug("Not registered: %s" % task.filename)
+                task.checksum = exists.checksum
+                task.tree_chunksize = exists.tree_chunksize
+                task.digests = exists.digests
                 task.status = File.REGISTER
                 self._tagq.put(task)
+            elif task.size and not exists.checksum:
+                # Case: Missing checksum, left to the backfill pass
+                logger.debug("Checksum deferred: %s" % task.filename)
+                self.deferred += 1
             else:
                 # Case: File does not meet any criteria for processing
                 logger.debug("Skipping: %s" % task.filename)
                 self.skipped += 1
+                self._dir_pending -= 1
+                if (exists.dev, exists.inode, exists.mtime_ns, exists.ctime_ns) != \
+                        (task.dev, task.inode, task.mtime_ns, task.ctime_ns):
+                    self._state.update_identity(task)
         
         elif task.status == File.COMPUTE:
             # Case: we are in the post Checksum COMPUTE stage
             task.status = File.REGISTER
-            self._state.add_file(task)
+            self._state.add_files([task])
             self._tagq.put(task)
             
         elif task.status == File.COMPARE:
             # Case: we are in the post Checksum COMPARE stage
             if task.checksum != task.compare:
-                # Case: checksums differ, need to re-tag and register
+                # Case: checksums differ, need to re-tag and register,
+                # marked unregistered until the server accepts it
                 task.status = File.REGISTER
                 task.checksum = task.compare
-                self._state.update_file(task)
+                task.rtime = None
+                self._state.update_files([task])
                 self._tagq.put(task)
             elif not task.rtime:
                 # Case: File has not been registered
@@ -161,10 +410,30 @@ class Dispatcher(Worker):
                 logger.debug("Unchanged: %s" % task.filename)
                 self.skipped += 1
                 # Update its mtime so that it won't be cksummed next time
-                self._state.update_file(task)
+                self._state.update_files([task])
+            
+        elif task.status == File.BACKFILL:
+            # Case: we are in the post Checksum BACKFILL stage
+            if task.checksum is None:
+                logger.debug("Checksum failed, still deferred: %s" % task.filename)
+                return
+            # the checksum is written once the server accepted it
+            task.status = File.REGISTER
+            task.checksum_only = True
+            self._tagq.put(task)
+            
+        elif task.status == File.DELETE:
+            # Case: we are in the post DELETE stage, the file is unregistered
+            logger.debug("Unregistered: %s" % task.filename)
+            self.unregistered += 1
+            self.pruned += 1
+            self._state.delete_files([task])
             
         elif task.status == File.REGISTER:
             # Case: we are in the post REGISTER stage
             logger.debug("Update file: %s" % task.filename)
-            self.registered += 1
-            self._state.update_file(task)
+            if task.checksum_only:
+                self.backfilled += 1
+            else:
+                self.registered += 1
+            self._registered.append(task)
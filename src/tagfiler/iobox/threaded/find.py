@@ -15,15 +15,17 @@
 #
 """
 This module implements the 'Find' stage of the Tagfiler Outbox. It works on a 
-queue of root directories. Each root directory is walked and file entries 
-are filtered according to inclusion and exclusion patterns. It also gets the 
+queue of root directories and listings. Each root directory is walked, or 
+each listing read, and file entries are filtered according to inclusion and 
+exclusion patterns. It also gets the 
 stats for each file entrye. The 'Find' stage then fills a queue with File 
 model objects.
 """
 
 import worker
-from tagfiler.util.files import tree_scan_stats, create_uri_friendly_file_path
-from tagfiler.iobox.models import File
+from tagfiler.util.files import tree_scan_dirs, tree_scan_sorted, listing_scan_dirs, create_uri_friendly_file_path
+from tagfiler.iobox.models import File, Directory, Listing
+from tagfiler.iobox.dao import OutboxStateDAO
 import outbox
 
 import logging
@@ -33,21 +35,61 @@ logger = logging.getLogger(__name__)
 class Find(worker.Worker):
     """The worker thread for the 'Find' stage of the Tagfiler Outbox."""
     
-    def __init__(self, tasks, results, excludes=[], includes=[]):
+    def __init__(self, tasks, results, excludes=[], includes=[], prune=False,
+                 scan_threads=1, state_db=None, state_profile='safe',
+                 sorted_scan=False):
         """Initializes the Find object.
         
         The 'tasks' parameter is a WorkQueue of pending tasks for the Find
-        worker to process.
+        worker to process, root directories or Listing objects.
         
         The 'results' parameter is a WorkQueue of completed tasks output by
         the Find worker.
         
         The 'includes' and 'excludes' parameters are lists of re objects or 
         other objects that provide similar search(...) functions.
+        
+        The 'prune' parameter indicates that excluded directories should not
+        be descended.
+        
+        The 'scan_threads' parameter is the number of threads used to list
+        directories concurrently while walking each root directory.
+        
+        When the 'state_db' parameter is given, a Directory follows the 
+        File objects of each directory. The files of a directory whose 
+        fingerprint matches the one recorded in the state database are not
+        output at all; a skipped Directory stands for them. It is opened
+        with the dao.PROFILES entry 'state_profile'.
+        
+        When 'sorted_scan' is set, the files of each root directory are 
+        output in path order, as by files.tree_scan_sorted, without 
+        fingerprints.
+        
+        A failed Directory is output for each directory of a root that 
+        cannot be listed, the root itself included.
         """
         super(Find, self).__init__(tasks, results)
         self._includes = includes
         self._excludes = excludes
+        self._prune = prune
+        self._scan_threads = scan_threads
+        self._state_db = state_db
+        self._state_profile = state_profile
+        self._state = None
+        self._sorted = sorted_scan
+    
+    def on_start(self):
+        if self._state_db:
+            try:
+                self._state = OutboxStateDAO(self._state_db, 
+                                             profile=self._state_profile)
+            except Exception as e:
+                return e
+    
+    def on_terminate(self, work_done):
+        if self._state is not None:
+            self._state.close()
+            self._state = None
         
     def do_work(self, task, work_done):
         logger.debug('Find:do_work: %s' % task)
@@ -56,16 +98,49 @@ class Find(worker.Worker):
             work_done(task)
             return
         
+        failures = []
         try:
-            path = task
-            for (rfpath, size, mtime, user, group) in \
-                    tree_scan_stats(path, self._excludes, self._includes):
-                logger.debug('Find:do_work: scan: %s, %s, %s, %s, %s' % 
-                             (rfpath, size, mtime, user, group))
-                filename = create_uri_friendly_file_path(path, rfpath)
-                args = {'filename': filename, 'mtime': mtime, 'size': size, \
-                        'username': user, 'groupname': group}
-                f = File(**args)
-                work_done(f)
+            if isinstance(task, Listing):
+                path = task.root
+                scan = listing_scan_dirs(path, task.filename, self._excludes,
+                                         self._includes, self._prune)
+            elif self._sorted:
+                path = task
+                scan = tree_scan_sorted(path, self._excludes, self._includes,
+                                        self._prune, failures=failures)
+            else:
+                path = task
+                scan = tree_scan_dirs(path, self._excludes, self._includes, 
+                                      self._prune, self._scan_threads,
+                                      failures=failures)
+            for (rdpath, fingerprint, stats) in scan:
+                dirname = create_uri_friendly_file_path(path, rdpath)
+                d = Directory(dirname=dirname, fingerprint=fingerprint, 
+                              count=len(stats))
+                if self._state and fingerprint and \
+                        self._state.find_fingerprint(dirname) == fingerprint:
+                    logger.debug('Find:do_work: unchanged: %s' % dirname)
+                    d.skipped = True
+                    d.filenames = [create_uri_friendly_file_path(path, s[0]) 
+                                   for s in stats]
+                    work_done(d)
+                    continue
+                
+                for (rfpath, size, mtime, user, group, identity) in stats:
+                    logger.debug('Find:do_work: scan: %s, %s, %s, %s, %s' % 
+                                 (rfpath, size, mtime, user, group))
+                    filename = create_uri_friendly_file_path(path, rfpath)
+                    (dev, inode, st_size, mtime_ns, ctime_ns) = identity
+                    args = {'filename': filename, 'mtime': mtime, 'size': size, \
+                            'username': user, 'groupname': group, 'dev': dev, \
+                            'inode': inode, 'mtime_ns': mtime_ns, 'ctime_ns': ctime_ns}
+                    f = File(**args)
+                    work_done(f)
+                if self._state:
+                    work_done(d)
         except Exception as e:
             work_done(e)
+        for dirpath in failures:
+            logger.warning("Cannot list %s" % dirpath)
+            work_done(Directory(dirname=create_uri_friendly_file_path(dirpath, ''),
+                                failed=True))
@@ -17,9 +17,9 @@
 Outbox management.
 """
 
-import worker, find, cksum, tag, register, dispatcher
+import worker, find, schedule, cksum, device, tag, register, dispatcher
 from tagfiler.iobox import models
-from tagfiler.util import rules
+from tagfiler.util import rules, files
 
 import logging
 import threading
@@ -55,6 +55,19 @@ class Outbox():
         self.found = 0
         self.skipped = 0
         self.registered = 0
+        self.moved = 0
+        self.deferred = 0
+        self.backfilled = 0
+        self.unregistered = 0
+        self.pruned = 0
+        self.missing = 0
+        self.changes = None
+        self.checksum_stats = []
+        self.device_stats = []
+        self.io_hints = (0, 0)
+        self.providers_stats = None
+        self.index_stats = None
+        self.reconcile_stats = None
         
         self._find_q = worker.WorkQueue()
         self._sum_q = worker.WorkQueue()
@@ -62,17 +75,82 @@ class Outbox():
         self._register_q = worker.WorkQueue()
         self._dispatch_q = worker.WorkQueue()
         
-        # Populate Find's queue with the root directories.
-        for root in self._model.roots:
+        # Populate Find's queue with the root directories and listings. A 
+        # root under another one is walked as part of it.
+        roots = files.outermost_dirs(self._model.roots)
+        for root in roots:
             self._find_q.put(root)
+        for listing in self._model.listings:
+            self._find_q.put(listing)
 
+        # The Dispatcher may merge the sorted roots with their state, or 
+        # preload the state of the roots and listings, backfill the checksums
+        # of the roots and listings, and sweep the roots
+        reconcile = None
+        preload = None
+        sweep = None
+        lazy = None
+        if self._model.lazy_checksums:
+            lazy = [files.create_uri_friendly_file_path(d, '') for d in 
+                    roots + [l.root for l in self._model.listings]]
+        if self._model.sweep_deleted:
+            sweep = [files.create_uri_friendly_file_path(d, '') for d in roots]
+        if self._model.reconcile:
+            reconcile = [files.create_uri_friendly_file_path(d, '') for d in roots]
+        elif self._model.preload_state:
+            preload = [files.create_uri_friendly_file_path(d, '') for d in 
+                       roots + [l.root for l in self._model.listings]]
+        
+        # Directory fingerprints would defeat the 'paranoid' change policy
+        fingerprint_db = None
+        if self._model.dir_fingerprints and self._model.change_policy != 'paranoid':
+            fingerprint_db = self._model.state_db
+        
         # The pipeline consists of the Find, Tag, and Register workers with their
         # associated WorkQueues.
         self._find = find.Find(self._find_q, self._dispatch_q, 
                                excludes=self._model.excludes,
-                               includes=self._model.includes)
+                               includes=self._model.includes,
+                               prune=self._model.prune,
+                               scan_threads=self._model.scan_threads,
+                               state_db=fingerprint_db,
+                               state_profile=self._model.state_profile,
+                               sorted_scan=self._model.reconcile)
+        
+        # The Checksum workers share one queue, their page cache hints and
+        # checksum providers. With per-device workers, the Router gives each
+        # device its own queue.
+        self._hints = files.IOHints(self._model.drop_behind)
+        self._providers = None
+        if self._model.checksum_providers or self._model.xattr_writeback:
+            self._providers = files.ChecksumProviders(
+                                    self._model.checksum_providers,
+                                    self._model.xattr_writeback)
+        self._router = None
+        if self._model.device_workers:
+            self._sums = []
+            self._router = device.Router(self._sum_q, self._dispatch_q,
+                                         self._new_checksum,
+                                         self._model.device_workers,
+                                         self._model.checksum_workers)
+        else:
+            self._sums = [self._new_checksum(self._sum_q)
+                          for i in range(max(1, self._model.checksum_workers))]
         
-        self._sum = cksum.Checksum(self._sum_q, self._dispatch_q)
+        # The optional Schedule worker reorders files for the Checksum workers.
+        # The Router drains its queue at once, so the Checksum workers have 
+        # run out of work only when the device queues are empty as well.
+        self._schedule = None
+        sum_q = self._sum_q
+        if self._model.schedule_window:
+            sum_q = worker.WorkQueue()
+            backlog = None
+            if self._router:
+                backlog = self._router.backlog
+            self._schedule = schedule.Schedule(sum_q, self._sum_q,
+                                               self._model.schedule_window,
+                                               self._model.schedule_order,
+                                               backlog)
         
         self._tag = tag.Tag(self._tag_q, self._register_q, 
                             self._model.path_rules,
@@ -80,16 +158,44 @@ class Outbox():
         
         self._register = register.Register(
                                     self._register_q, self._dispatch_q,
-                                    client, self._model.bulk_ops_max)
+                                    client, self._model.bulk_ops_max,
+                                    self._model.digests)
         
         self._dispatcher = dispatcher.Dispatcher(self._model.state_db,
                                                  self._dispatch_q, 
-                                                 self._sum_q,
+                                                 sum_q,
                                                  self._tag_q,
                                                  self._register_q,
-                                                 self._dispatcher_done)
+                                                 self._dispatcher_done,
+                                                 change_policy=self._model.change_policy,
+                                                 lazy_checksums=lazy,
+                                                 state_profile=self._model.state_profile,
+                                                 preload=preload,
+                                                 preload_limit=self._model.preload_limit * 1048576,
+                                                 reconcile=reconcile,
+                                                 sweep=sweep)
         
         
+    def _new_checksum(self, tasks):
+        """Returns a new Checksum worker for the 'tasks' queue."""
+        return cksum.Checksum(tasks, self._dispatch_q,
+                              self._model.checksum_blocksize,
+                              self._model.checksum_mmap,
+                              self._model.digests,
+                              self._model.tree_chunksize,
+                              self._model.tree_threads,
+                              self._model.state_db,
+                              self._model.prefetch_files,
+                              self._hints,
+                              self._providers,
+                              self._model.state_profile)
+    
+    def _checksums(self):
+        """Returns all Checksum workers, including those of the Router."""
+        if self._router:
+            return self._sums + self._router.workers()
+        return self._sums
+    
     def start(self):
         """Starts the Outbox."""
         logger.debug("Outbox:start")
@@ -98,7 +204,12 @@ class Outbox():
         self._dispatcher.start()
         self._register.start()
         self._tag.start()
-        self._sum.start()
+        for w in self._sums:
+            w.start()
+        if self._router:
+            self._router.start()
+        if self._schedule:
+            self._schedule.start()
         self._find.start()
         self._lock_terminate.release()
 
@@ -113,7 +224,12 @@ class Outbox():
         self._lock_terminate.acquire()
         assert self._terminated != True
         self._find.terminate()
-        self._sum.terminate()
+        if self._schedule:
+            self._schedule.terminate()
+        if self._router:
+            self._router.terminate()
+        for w in self._checksums():
+            w.terminate()
         self._tag.terminate()
         self._register.terminate()
         self._dispatcher.terminate()
@@ -134,7 +250,9 @@ class Outbox():
         alive.
         """
         return not (self._find.is_alive() or 
-                    self._sum.is_alive() or
+                    (self._schedule and self._schedule.is_alive()) or
+                    (self._router and self._router.is_alive()) or
+                    any([w.is_alive() for w in self._checksums()]) or
                     self._tag.is_alive() or 
                     self._register.is_alive() or
                     self._dispatcher.is_alive())
@@ -168,6 +286,28 @@ class Outbox():
         self.found = self._dispatcher.found
         self.skipped = self._dispatcher.skipped
         self.registered = self._dispatcher.registered
+        self.moved = self._dispatcher.moved
+        self.deferred = self._dispatcher.deferred
+        self.backfilled = self._dispatcher.backfilled
+        self.unregistered = self._dispatcher.unregistered
+        self.pruned = self._dispatcher.pruned
+        self.missing = self._dispatcher.missing
+        self.changes = self._dispatcher.changes
+        self.checksum_stats = [(w.getName(), w.files, w.bytes, w.elapsed)
+                               for w in self._checksums()]
+        if self._router:
+            self.device_stats = self._router.device_stats()
+        self.io_hints = (self._hints.prefetched, self._hints.dropped)
+        index = self._dispatcher.index
+        if index is not None:
+            self.index_stats = (index.complete, len(index), index.bytes, index.fallbacks)
+        merge = self._dispatcher.merge
+        if merge is not None:
+            self.reconcile_stats = (merge.deleted, merge.fallbacks)
+        if self._providers:
+            self.providers_stats = ([(n, self._providers.provided[n])
+                                     for n in self._providers.names],
+                                    self._providers.written)
         self._cv_done.notify_all()
         self._cv_done.release()
         
@@ -31,22 +31,36 @@ logger = logging.getLogger(__name__)
 class Register(Worker):
     """The registration pipeline worker."""
     
-    def __init__(self, tasks, results, client, bulk_ops_max=0):
+    def __init__(self, tasks, results, client, bulk_ops_max=0, digests=[]):
         super(Register, self).__init__(tasks, results)
         self._client = client
         self._bulk_ops_max = bulk_ops_max
+        self._digests = digests
         
         # _pending is implemented as a list, rather than a deque, because
         # we do not need to popfirst. Instead, when it is full we simply
         # iterator over it and then re-initialize.
         self._pending = []
+        # Files to unregister, by status File.DELETE
+        self._deleting = []
+    
+    def _flush_deleting(self, work_done):
+        logger.debug("Register:_flush_deleting")
+        tasks = self._deleting
+        self._deleting = []
+        try:
+            self._client.delete_subjects(tasks)
+            for task in tasks:
+                work_done(task)
+        except Exception as e:
+            work_done(e)
     
     def _flush_pending(self, work_done):
         logger.debug("Register:_flush_pending")
         tasks = self._pending
         self._pending = []
         try:
-            self._client.add_subjects(tasks)
+            self._client.add_subjects(tasks, self._digests)
             for task in tasks:
                 task.rtime = time.time()
                 work_done(task)
@@ -60,10 +74,17 @@ class Register(Worker):
         if task is outbox.Outbox._REG_DONE:
             if len(self._pending) > 0:
                 self._flush_pending(work_done)
+            if len(self._deleting) > 0:
+                self._flush_deleting(work_done)
             work_done(task)
             return
     
         assert isinstance(task, File)
+        if task.status == File.DELETE:
+            self._deleting.append(task)
+            if len(self._deleting) >= self._bulk_ops_max:
+                self._flush_deleting(work_done)
+            return
         self._pending.append(task)
         if len(self._pending) >= self._bulk_ops_max:
             self._flush_pending(work_done)
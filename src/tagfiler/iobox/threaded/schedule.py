@@ -0,0 +1,97 @@
+# 
+# Copyright 2010 University of Southern California
+# 
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+#    http://www.apache.org/licenses/LICENSE-2.0
+# 
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Implements the optional scheduling stage of the Outbox, which reorders files
+before the checksum stage so that they are read in on-disk order.
+"""
+
+from worker import Worker
+from tagfiler.iobox.models import File
+from tagfiler.util import files
+import outbox
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Orders in which files may be scheduled
+ORDERS = ['inode', 'extent']
+
+
+class Schedule(Worker):
+    """The scheduling pipeline worker.
+    
+    On disks where seeks are expensive, reading files in the order they were
+    found costs much of the sequential bandwidth. This worker holds up to 
+    'window' files and passes them on to the checksum stage sorted by 
+    (dev, inode), or with the 'extent' order by the physical offset of their
+    first extent where files.first_extent can find it. The held files are 
+    passed on when the window is full, when no more files are waiting and 
+    the checksum stage has run out of work, and before the SUM_DONE marker.
+    """
+    
+    def __init__(self, tasks, results, window=1000, order='inode', backlog=None):
+        """Initializes the Schedule worker.
+        
+        The checksum stage has run out of work when 'backlog()', the number
+        of files waiting for it, is zero. It defaults to the size of the 
+        'results' queue; a stage that drains that queue into queues of its
+        own, like the device.Router, must report their size as well.
+        Raises ValueError if 'order' is not one of ORDERS.
+        """
+        super(Schedule, self).__init__(tasks, results)
+        if order not in ORDERS:
+            raise ValueError("Unsupported schedule order: %s" % order)
+        self._window = max(1, window)
+        self._order = order
+        self._backlog = backlog or results.qsize
+        self._pending = []
+        self.batches = 0
+    
+    def _key(self, task):
+        if self._order == 'extent':
+            extent = files.first_extent(task.filename)
+            return (task.dev, extent is None, extent, task.inode)
+        return (task.dev, task.inode)
+    
+    def _flush(self, work_done):
+        """Passes on the held files, in schedule order."""
+        if not self._pending:
+            return
+        self._pending.sort()
+        for key, seq, task in self._pending:
+            work_done(task)
+        self._pending = []
+        self.batches += 1
+    
+    def on_terminate(self, work_done):
+        self._pending = []
+    
+    def do_work(self, task, work_done):
+        logger.debug('Schedule:do_work: %s' % task)
+        
+        if task is outbox.Outbox._SUM_DONE:
+            self._flush(work_done)
+            work_done(task)
+            return
+        
+        assert isinstance(task, File)
+        # the sequence number keeps the sort stable and off the File objects
+        self._pending.append((self._key(task), len(self._pending), task))
+        if len(self._pending) >= self._window or \
+                (self._tasks.empty() and self._backlog() == 0):
+            self._flush(work_done)
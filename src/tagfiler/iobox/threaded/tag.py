@@ -47,6 +47,11 @@ class Tag(worker.Worker):
         try:
             assert isinstance(task, models.File)
             self._tag_director.tag_registered_file(self._rules, task)
+            if task.checksum_only or task.status == models.File.DELETE:
+                # the other tags were registered with the file before, or
+                # only its name is needed to unregister it
+                task.tags = task.filter_tags('name')
+                task.content_tags = []
             work_done(task)
         except Exception as e:
             work_done(e)
@@ -49,6 +49,10 @@ class Worker(threading.Thread):
 
     # Internal marker added to the input queue to unblock a waiting worker.
     __TERMINATE = 'TERMINATE'
+    
+    # Seconds to wait for a task before calling on_idle, or None to wait 
+    # for as long as it takes.
+    idle_timeout = None
         
     def __init__(self, tasks, results):
         """Initializes the Worker class.
@@ -107,6 +111,14 @@ class Worker(threading.Thread):
         """
         pass
     
+    def on_idle(self, work_done):
+        """Called when no task is available for 'idle_timeout' seconds.
+        
+        This method may be overriden by subclasses that hold on to work,
+        to complete it while they would otherwise be waiting.
+        """
+        pass
+    
     def on_terminate(self, work_done):
         """Called during termination.
         
@@ -138,7 +150,11 @@ class Worker(threading.Thread):
             return
 
         while not self._terminate:
-            task = self._tasks.get()
+            try:
+                task = self._tasks.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                self.on_idle(self._work_done)
+                continue
             if task is Worker.__TERMINATE:
                 break
             self.do_work(task, self._work_done)
@@ -2,17 +2,449 @@
 File utilities for the tagfiler project.
 """
 
+import io
 import os
+import sys
+import json
+import re
+import stat
+import mmap
+import array
+import struct
+import zlib
 import hashlib
 import logging
+import time
+import threading
+import collections
+import Queue
+
+# Directory-entry iteration is native in Python 3.5+ and available from the
+# 'scandir' package for older interpreters. Without it, the scanner falls back
+# to os.listdir plus a single lstat per entry, and the names of a directory
+# are read all at once rather than streamed.
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir     #@UnresolvedImport
+    except ImportError:
+        _scandir = None
+
+# The FIEMAP ioctl, used to find where files are stored on disk, is only
+# available on Linux.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 logger = logging.getLogger(__name__)
 
+def _stat_follow(path):
+    """Stat 'path' following symlinks, or the link itself when dangling."""
+    try:
+        return os.stat(path)
+    except OSError:
+        return os.lstat(path)
+
+def _list_dir(dirpath):
+    """Generate (name, descend, s) for each entry of directory 'dirpath'.
+
+       The 'descend' flag is true for real (non-symlinked) directories.
+       The 's' stat result follows symlinks, or describes the link
+       itself when it is dangling. Type hints from the directory
+       listing are reused so that at most one stat is issued per entry,
+       except for dangling symlinks which take two. Entries that vanish
+       while being listed are skipped.
+    """
+    if _scandir is not None:
+        for entry in _scandir(dirpath):
+            try:
+                try:
+                    s = entry.stat()
+                except OSError:
+                    s = entry.stat(follow_symlinks=False)
+                yield (entry.name, entry.is_dir(follow_symlinks=False), s)
+            except OSError as err:
+                logger.debug("Skipping %s: %s" % (entry.path, err))
+    else:
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            try:
+                s = os.lstat(path)
+                descend = stat.S_ISDIR(s.st_mode)
+                if stat.S_ISLNK(s.st_mode):
+                    try:
+                        s = os.stat(path)
+                    except OSError:
+                        pass
+                yield (name, descend, s)
+            except OSError as err:
+                logger.debug("Skipping %s: %s" % (path, err))
+
+# Characters with special meaning in regular expression source
+_RE_SPECIAL = '.^$*+?{}[]\\|()'
+
+# Flags that do not change the meaning of a literal pattern
+_RE_LITERAL_FLAGS = re.UNICODE | re.DOTALL
+
+def _re_literal(source):
+    """Returns the text matched literally by regular expression 'source'.
+
+       Returns None when the source uses any regular expression syntax
+       other than escaped punctuation.
+    """
+    chars = []
+    escaped = False
+    for c in source:
+        if escaped:
+            if c.isalnum() or c == '_':
+                # character classes, backreferences, etc.
+                return None
+            chars.append(c)
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c in _RE_SPECIAL:
+            return None
+        else:
+            chars.append(c)
+    if escaped:
+        return None
+    return ''.join(chars)
+
+class _PatternSet(object):
+    """A list of patterns compiled for a single-pass search.
+
+       Patterns that are literal text, optionally anchored by '^' or
+       '$', are tested with string operations. The remaining regular
+       expressions are merged into one alternation per set of flags.
+       Patterns that cannot be merged, and objects that only provide a
+       search(string) method, are searched one at a time.
+    """
+    
+    def __init__(self, patterns):
+        prefixes = []
+        suffixes = []
+        exacts = set()
+        self._substrings = []
+        self._others = []
+        merge = {}
+        for p in patterns:
+            source = getattr(p, 'pattern', None)
+            flags = getattr(p, 'flags', None)
+            if not isinstance(source, basestring) or flags is None:
+                self._others.append(p)
+                continue
+            
+            if not flags & ~_RE_LITERAL_FLAGS:
+                body = source
+                start = body.startswith('^')
+                if start:
+                    body = body[1:]
+                end = body.endswith('$') and \
+                    (len(body) - len(body[:-1].rstrip('\\')) - 1) % 2 == 0
+                if end:
+                    body = body[:-1]
+                literal = _re_literal(body)
+                if literal:
+                    # '$' also matches before a trailing newline
+                    if start and end:
+                        exacts.update([literal, literal + '\n'])
+                    elif start:
+                        prefixes.append(literal)
+                    elif end:
+                        suffixes.extend([literal, literal + '\n'])
+                    else:
+                        self._substrings.append(literal)
+                    continue
+            
+            if re.search(r'\\[1-9]|\(\?P=|\(\?\(', source):
+                # group references cannot be renumbered by merging
+                self._others.append(p)
+            else:
+                merge.setdefault(flags, []).append(p)
+        
+        self._prefixes = tuple(prefixes)
+        self._suffixes = tuple(suffixes)
+        self._exacts = exacts
+        regexes = []
+        for flags, group in merge.items():
+            if len(group) == 1:
+                regexes.append(group[0])
+                continue
+            try:
+                regexes.append(re.compile(
+                    '|'.join([ '(?:%s)' % p.pattern for p in group ]), flags))
+            except re.error:
+                self._others.extend(group)
+        self._others = regexes + self._others
+        self._empty = not (self._prefixes or self._suffixes or self._exacts or
+                           self._substrings or self._others)
+    
+    def __nonzero__(self):
+        return not self._empty
+    
+    def search(self, name, qualified):
+        """Returns True if any pattern matches 'name' or 'qualified'.
+        
+           The 'qualified' string always ends with 'name', so suffix
+           and substring tests need only search it.
+        """
+        if self._prefixes and (name.startswith(self._prefixes) or 
+                               qualified.startswith(self._prefixes)):
+            return True
+        if self._suffixes and qualified.endswith(self._suffixes):
+            return True
+        if self._exacts and (name in self._exacts or qualified in self._exacts):
+            return True
+        for literal in self._substrings:
+            if literal in qualified:
+                return True
+        for p in self._others:
+            if p.search(name) or p.search(qualified):
+                return True
+        return False
+
+class PathMatcher(object):
+    """Compiled exclusion and inclusion patterns for tree_scan.
+
+       Built once from the 'excludes' and 'includes' pattern lists, a
+       matcher applies the tree_scan filtering logic with a single pass
+       over each set of patterns. The qualified name is built once per
+       member and inclusion patterns are only searched for members that
+       matched an exclusion pattern.
+    """
+    
+    def __init__(self, excludes=[], includes=[]):
+        self._excludes = _PatternSet(excludes)
+        self._includes = _PatternSet(includes)
+    
+    def excluded(self, name, relpath):
+        """Returns True if member 'name' of 'relpath' should be excluded."""
+        if not self._excludes:
+            return False
+        qualified = '%s%s%s' % (relpath, os.path.sep, name)
+        return self._excludes.search(name, qualified) and \
+            not self._includes.search(name, qualified)
+
+# Maximum number of members of a directory generated together by a tree walk
+SCAN_BATCH = 10000
+
+def _scan_dir(dirpath, relpath, matcher, prune, batch=SCAN_BATCH, failures=None):
+    """List one directory of a tree walk, 'batch' members at a time.
+
+       Generates (members, subdirs, whole) where 'members' is a list of
+       non-excluded (dirpath, relpath, name, s) tuples and 'subdirs'
+       is a list of directory paths still to be walked. Batches are
+       generated while the directory is still being read, so memory
+       stays bounded for huge flat directories. 'whole' is true when
+       the batch holds all members of the directory. Unreadable
+       directories are skipped, as os.walk would do, and appended to
+       the 'failures' list if given; members read before the error
+       are generated without the 'whole' flag.
+    """
+    members = []
+    subdirs = []
+    split = False
+    try:
+        for name, descend, s in _list_dir(dirpath):
+            excluded = matcher.excluded(name, relpath)
+            if descend and not (prune and excluded):
+                subdirs.append(os.path.join(dirpath, name))
+            if not excluded:
+                members.append((dirpath, relpath, name, s))
+                if len(members) >= batch:
+                    yield (members, subdirs, False)
+                    members = []
+                    subdirs = []
+                    split = True
+    except OSError as err:
+        logger.debug("Cannot list %s: %s" % (dirpath, err))
+        if failures is not None:
+            failures.append(dirpath)
+        split = True
+    if members or subdirs or not split:
+        yield (members, subdirs, not split)
+
+def _tree_walk_dirs(top, excludes, includes, prune=False, threads=1, batch=SCAN_BATCH,
+                    failures=None):
+    """Generate (relpath, members, whole) for each directory of the tree at 'top'.
+
+       'members' is the list of (dirpath, relpath, name, s) tuples of
+       the directory's non-excluded entries, and 'relpath' is the
+       directory's path relative to 'top', '' for 'top' itself. A
+       directory with more than 'batch' members is generated in several
+       parts, each with a false 'whole' flag. See tree_scan for the 
+       filtering semantics. Each directory is listed once and each 
+       entry is stat'd at most once, see _list_dir. When 'prune' is 
+       true, excluded directories are never listed. When 'threads' is
+       greater than one, directories are listed concurrently by a 
+       ParallelWalk. The paths of the directories that cannot be listed,
+       'top' included, are appended to the 'failures' list if given.
+    """
+    if threads > 1:
+        for item in ParallelWalk(top, excludes, includes, prune, threads, batch,
+                                 failures).dirs():
+            yield item
+        return
+    
+    matcher = PathMatcher(excludes, includes)
+    pending = [top]
+    while pending:
+        dirpath = pending.pop()
+        relpath = dirpath[len(top):]
+        for members, subdirs, whole in _scan_dir(dirpath, relpath, matcher, prune, batch,
+                                                 failures):
+            pending.extend(subdirs)
+            yield (relpath, members, whole)
+
+def _tree_walk(top, excludes, includes, prune=False, threads=1):
+    """Generate (dirpath, relpath, name, s) for members of the tree at 'top'.
+
+       See _tree_walk_dirs.
+    """
+    for relpath, members, whole in _tree_walk_dirs(top, excludes, includes, prune, threads):
+        for member in members:
+            yield member
+
+class ParallelWalk(object):
+    """A tree walk that lists and stats directories on a pool of threads.
+
+       High-latency filesystems spend nearly all of a walk waiting on
+       metadata operations, which release the GIL. Each thread keeps
+       its own deque of directories still to be walked, working
+       depth-first from one end and stealing from the other end of
+       another thread's deque when its own is empty. Listed directories
+       are handed to the consumer through a bounded queue, in parts of
+       at most 'batch' members, so threads block rather than buffer when
+       the consumer falls behind.
+
+       The dirs() method generates the same (relpath, members, whole) 
+       tuples as _tree_walk_dirs and iterating the object generates the same
+       (dirpath, relpath, name, s) tuples as _tree_walk, in no 
+       particular order. Exceptions raised by a thread are re-raised to
+       the consumer. If the consumer stops early, the threads are 
+       aborted. Directories that cannot be listed are appended to the
+       'failures' list if given.
+    """
+    
+    # Number of listed directories, or parts of them, queued for the consumer
+    QUEUE_BATCHES = 64
+    
+    # Marker put on the results queue by each exiting thread
+    _EXITED = 'EXITED'
+    
+    def __init__(self, top, excludes=[], includes=[], prune=False, threads=4,
+                 batch=SCAN_BATCH, failures=None):
+        self._top = top
+        self._failures = failures
+        self._matcher = PathMatcher(excludes, includes)
+        self._prune = prune
+        self._batch = batch
+        self._nthreads = max(1, threads)
+        self._deques = [ collections.deque() for i in range(self._nthreads) ]
+        self._cv = threading.Condition()
+        self._pending = 0
+        self._aborted = False
+        self._results = Queue.Queue(ParallelWalk.QUEUE_BATCHES)
+        
+    def __iter__(self):
+        for relpath, members, whole in self.dirs():
+            for member in members:
+                yield member
+    
+    def dirs(self):
+        self._deques[0].append(self._top)
+        self._pending = 1
+        threads = [ threading.Thread(target=self._run, args=(i,))
+                    for i in range(self._nthreads) ]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        
+        try:
+            exited = 0
+            while exited < self._nthreads:
+                item = self._results.get()
+                if item is ParallelWalk._EXITED:
+                    exited += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            self.abort()
+    
+    def abort(self):
+        """Stops the walk, releasing any threads still running."""
+        self._cv.acquire()
+        self._aborted = True
+        self._cv.notify_all()
+        self._cv.release()
+    
+    def _take(self, i):
+        """Returns the next directory for thread 'i' or None when done."""
+        self._cv.acquire()
+        try:
+            while not self._aborted:
+                if self._deques[i]:
+                    return self._deques[i].pop()
+                for victim in self._deques:
+                    if victim:
+                        return victim.popleft()
+                if self._pending == 0:
+                    return None
+                self._cv.wait()
+            return None
+        finally:
+            self._cv.release()
+    
+    def _put(self, item):
+        """Puts 'item' on the results queue unless the walk is aborted."""
+        while not self._aborted:
+            try:
+                self._results.put(item, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+    
+    def _run(self, i):
+        try:
+            dirpath = self._take(i)
+            while dirpath is not None:
+                try:
+                    relpath = dirpath[len(self._top):]
+                    for members, subdirs, whole in \
+                            _scan_dir(dirpath, relpath, self._matcher, 
+                                      self._prune, self._batch, self._failures):
+                        if self._aborted:
+                            break
+                        self._cv.acquire()
+                        self._deques[i].extend(subdirs)
+                        self._pending += len(subdirs)
+                        self._cv.notify_all()
+                        self._cv.release()
+                        self._put((relpath, members, whole))
+                finally:
+                    self._cv.acquire()
+                    self._pending -= 1
+                    if self._pending == 0:
+                        self._cv.notify_all()
+                    self._cv.release()
+                dirpath = self._take(i)
+        except Exception as e:
+            self._put(e)
+            self.abort()
+        self._put(ParallelWalk._EXITED)
+
 def tree_scan(top, 
               expand_dir=lambda dirpath, relpath, dname: '%s%s%s' % (relpath, os.path.sep, dname), 
               expand_file=lambda dirpath, relpath, fname: '%s%s%s' % (relpath, os.path.sep, fname), 
               excludes=[],
-              includes=[]):
+              includes=[],
+              prune=False,
+              threads=1):
     """Generate a sequence of file-tree members with optional filtering and transformation.
 
        Required 'top' parameter is string path to root directory; a
@@ -50,66 +482,224 @@ def tree_scan(top,
        Filtering logic is to exclude members matching at least one
        exclusion pattern unless that member also matches at least one
        inclusion pattern. Default for no exclusion pattern matches is
-       to include the member. When a directory member is excluded, its
-       descendents are also excluded implicitly.
+       to include the member.
+
+       Optional 'prune' controls descendents of an excluded directory
+       member. When true, they are excluded implicitly and the
+       directory is never listed. When false (the default), the
+       directory is still walked and each descendent is filtered on
+       its own, so that an inclusion pattern may select it.
+
+       Optional 'threads' is the number of threads listing directories
+       concurrently. With more than one thread, members are generated
+       in no particular order.
        
     """
+    for dirpath, relpath, name, s in _tree_walk(top, excludes, includes, prune, threads):
+        if stat.S_ISDIR(s.st_mode):
+            yield expand_dir(dirpath, relpath, name)
+        else:
+            yield expand_file(dirpath, relpath, name)
+
+class NameCache(object):
+    """A cache of numeric ID to name lookups.
     
-    def exclude_name(name, relpath):
-        drop = False
-        for p in excludes:
-            if p.search(name) or p.search('%s%s%s' % (relpath, os.path.sep, name)):
-                drop = True
-        for p in includes:
-            if p.search(name) or p.search('%s%s%s' % (relpath, os.path.sep, name)):
-                drop = False
-        return drop
+       Under LDAP or SSSD every passwd or group lookup may be a network
+       round-trip, so names are cached for 'ttl' seconds. Failed lookups
+       are cached too, as the numeric ID itself. At most 'maxsize'
+       entries are kept, evicting the oldest first. The 'hits' and
+       'misses' counters record the effectiveness of the cache.
+       
+       The 'lookup' function takes an ID and returns its name, raising
+       an exception if there is none. The optional 'enumerate' function
+       returns (id, name) pairs for the whole database and is used by
+       preload().
+    """
+    
+    def __init__(self, lookup, enumerate=None, ttl=3600, maxsize=65536):
+        self._lookup = lookup
+        self._enumerate = enumerate
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _store(self, id, name, now):
+        self._lock.acquire()
+        try:
+            self._entries.pop(id, None)
+            while len(self._entries) >= self.maxsize:
+                self._entries.popitem(last=False)
+            self._entries[id] = (name, now + self.ttl)
+        finally:
+            self._lock.release()
+    
+    def lookup(self, id):
+        """Returns the name for 'id' or 'id' itself if it has no name."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(id)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        finally:
+            self._lock.release()
+        
+        try:
+            name = self._lookup(id)
+        except ImportError as err:
+            logger.warn("Cannot look up names: %s" % err)
+            name = id
+        except Exception:
+            name = id
+        self._store(id, name, now)
+        return name
+    
+    def preload(self):
+        """Loads the whole database in one pass.
+        
+           Returns the number of entries loaded. Entries beyond 'maxsize'
+           are not kept.
+        """
+        if self._enumerate is None:
+            return 0
+        now = time.time()
+        count = 0
+        seen = set()
+        try:
+            for id, name in self._enumerate():
+                # like the single lookups, the first name for an ID wins
+                if id in seen:
+                    continue
+                seen.add(id)
+                self._store(id, name, now)
+                count += 1
+        except ImportError as err:
+            logger.warn("Cannot look up names: %s" % err)
+        return count
+    
+    def clear(self):
+        """Discards all cached entries and resets the counters."""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
 
-    def filter_list_inplace(l, dirpath=None):
-        for i in [ len(l) - 1 - x for x in range(0, len(l)) ]:
-            if exclude_name(l[i], dirpath):
-                del l[i]
+def _getpwuid_name(uid):
+    import pwd
+    return pwd.getpwuid(uid)[0]
 
-    for dirpath, dirnames, filenames in os.walk(top, topdown=False):
-        relpath = dirpath[len(top):]
-            
-        #if not exclude_name(dirpath, relpath):
-        #yield expand_dir(dirpath, relpath or os.path.sep)
+def _getpwall_names():
+    import pwd
+    return [ (p[2], p[0]) for p in pwd.getpwall() ]
 
-        # filter out excluded children
-        filter_list_inplace(dirnames, relpath)
-        filter_list_inplace(filenames, relpath)
+def _getgrgid_name(gid):
+    import grp
+    return grp.getgrgid(gid)[0]
 
-        for fname in filenames:
-            # non-excluded child files are not visited again
-            yield expand_file(dirpath, relpath, fname)
-        
-        for dname in dirnames:
-            # non-excluded child dirs are not visited again
-            yield expand_dir(dirpath, relpath, dname)
+def _getgrall_names():
+    import grp
+    return [ (g[2], g[0]) for g in grp.getgrall() ]
+
+# Process-wide caches used by uid2uname and gid2gname
+user_names = NameCache(_getpwuid_name, _getpwall_names)
+group_names = NameCache(_getgrgid_name, _getgrall_names)
+
+def preload_names():
+    """Load the whole passwd and group databases into the name caches."""
+    users = user_names.preload()
+    groups = group_names.preload()
+    logger.info("Preloaded %d user and %d group names." % (users, groups))
 
 def uid2uname(uid):
     """Convert numerid UID to username if possible or leave as number."""
-    try:
-        import pwd
-        return pwd.getpwuid(uid)[0]
-    except ImportError:
-        logger.warn("Python module pwd cannot be found.")
-    except:
-        pass
-    return uid
+    return user_names.lookup(uid)
 
 def gid2gname(gid):
     """Convert numeric GID to groupname if possible or leave as number."""
+    return group_names.lookup(gid)
+
+def _stats_tuple(rpath, s):
+    """Returns tuple (path, size, mtime, user, group) for stat result 's'.
+
+       size is None for directories and for dangling symlinks.
+    """
+    if stat.S_ISDIR(s.st_mode) or stat.S_ISLNK(s.st_mode):
+        size = None
+    else:
+        size = s.st_size
+    return (rpath, size, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid))
+
+def _time_ns(s, name):
+    """Returns time 'name' of stat result 's' in integer nanoseconds."""
+    ns = getattr(s, name + '_ns', None)
+    if ns is None:
+        ns = int(round(getattr(s, name) * 1e9))
+    return ns
+
+def stat_identity(s):
+    """Returns tuple (dev, inode, size, mtime_ns, ctime_ns) for stat result 's'.
+
+       The device and inode numbers identify a file on its host across
+       renames and moves within a filesystem, and the size and times 
+       identify its content. Where the interpreter provides no st_mtime_ns,
+       the times are derived from the float times, with a lower resolution.
+    """
+    return (s.st_dev, s.st_ino, s.st_size, 
+            _time_ns(s, 'st_mtime'), _time_ns(s, 'st_ctime'))
+
+def path_identity(path):
+    """Returns the stat_identity of 'path', or None if it does not exist."""
     try:
-        import grp
-        return grp.getgrgid(gid)[0]
-    except ImportError:
-        logger.warn("Python module grp not found.")
-    except:
-        pass
-    
-    return gid
+        return stat_identity(_stat_follow(path))
+    except OSError:
+        return None
+
+# FIEMAP ioctl request and flags, see linux/fiemap.h
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_EXTENT_UNKNOWN = 0x2
+_FIEMAP_EXTENT_DELALLOC = 0x4
+_FIEMAP_HEADER = '=QQLLLL'
+_FIEMAP_EXTENT = '=QQQQQLLLL'
+
+def first_extent(fpath):
+    """Returns the physical byte offset of the first extent of 'fpath', or None.
+
+       The offset is found with the FIEMAP ioctl, where the platform and
+       filesystem support it. None is also returned for empty files and 
+       for extents whose location is not yet known.
+    """
+    if fcntl is None:
+        return None
+    header = struct.calcsize(_FIEMAP_HEADER)
+    buf = array.array('B', struct.pack(_FIEMAP_HEADER, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) +
+                      '\0' * struct.calcsize(_FIEMAP_EXTENT))
+    try:
+        fd = os.open(fpath, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        try:
+            fcntl.ioctl(fd, _FS_IOC_FIEMAP, buf, True)
+        except (IOError, OSError):
+            return None
+    finally:
+        os.close(fd)
+    s = buf.tostring()
+    if not struct.unpack_from('=L', s, 20)[0]:
+        return None
+    # fe_logical, fe_physical, fe_length, 2 reserved, fe_flags, 3 reserved
+    extent = struct.unpack_from(_FIEMAP_EXTENT, s, header)
+    if extent[5] & (_FIEMAP_EXTENT_UNKNOWN | _FIEMAP_EXTENT_DELALLOC):
+        return None
+    return extent[1]
 
 def expand_dir_stats(dirpath, relpath, dname):
     """Expand directory stats as a helper function useful with tree_scan expand_dir argument.
@@ -118,11 +708,7 @@ def expand_dir_stats(dirpath, relpath, dname):
     """
     dpath = '%s%s%s' % (dirpath, os.path.sep, dname)
     rdpath = '%s%s%s' % (relpath, os.path.sep, dname)
-    try:
-        s = os.stat(dpath)
-    except:
-        s = os.lstat(dpath)
-    return (rdpath, None, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid))
+    return _stats_tuple(rdpath, _stat_follow(dpath))
 
 def expand_file_stats(dirpath, relpath, fname):
     """Expand file stats as a helper function useful with tree_scan expand_file argument.
@@ -132,41 +718,578 @@ def expand_file_stats(dirpath, relpath, fname):
     """
     fpath = '%s%s%s' % (dirpath, os.path.sep, fname)
     rfpath = '%s%s%s' % (relpath, os.path.sep, fname)
+    return _stats_tuple(rfpath, _stat_follow(fpath))
+
+# Default number of bytes hashed per read
+CHECKSUM_BLOCKSIZE = 4 * 1024 * 1024
+
+# Per-thread read buffers, reused across checksums
+_buffers = threading.local()
+
+def _read_buffer(blocksize):
+    """Returns this thread's read buffer of 'blocksize' bytes."""
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != blocksize:
+        buf = bytearray(blocksize)
+        _buffers.buf = buf
+    return buf
+
+# Advice values of posix_fadvise, as defined on Linux
+FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+def _libc_fadvise():
+    """Returns posix_fadvise from the C library, or None where it is missing."""
     try:
-        s = os.stat(fpath)
-        return (rfpath, s.st_size, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid))
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        func = getattr(libc, 'posix_fadvise64', None) or libc.posix_fadvise
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    func.restype = ctypes.c_int
+    def fadvise(fd, offset, length, advice):
+        return func(fd, offset, length, advice) == 0
+    return fadvise
+
+# posix_fadvise is in the os module from Python 3.3, and is otherwise called
+# through the C library. It returns true if the advice was accepted.
+if hasattr(os, 'posix_fadvise'):
+    def _fadvise(fd, offset, length, advice):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+            return True
+        except OSError:
+            return False
+else:
+    _fadvise = _libc_fadvise()
+
+# Bytes at the start of an upcoming file read ahead by IOHints.prefetch
+PREFETCH_BYTES = 16 * 1024 * 1024
+
+class IOHints(object):
+    """Page cache hints for checksum reads, see posix_fadvise(2).
+
+       The prefetch method asks the kernel to start reading the first
+       'prefetch_bytes' of a file that will be hashed next, so that its
+       read is not cold. When 'drop_behind' is true, the hashed method 
+       asks the kernel to drop the bytes just hashed from the page cache,
+       so that hashing does not evict the data of other applications. 
+       The 'prefetched' and 'dropped' counters record the hints accepted,
+       in files and bytes. Where the platform has no posix_fadvise, no
+       hints are given. One IOHints object may be shared by threads.
+    """
+    
+    # Number of recently prefetched files that are not prefetched again
+    RECENT = 256
+    
+    def __init__(self, drop_behind=False, prefetch_bytes=PREFETCH_BYTES):
+        self.drop_behind = drop_behind
+        self.prefetch_bytes = prefetch_bytes
+        self.prefetched = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._recent = collections.deque(maxlen=IOHints.RECENT)
+    
+    def prefetch(self, fpath):
+        """Reads ahead the start of file 'fpath', unless done recently."""
+        if _fadvise is None:
+            return
+        with self._lock:
+            if fpath in self._recent:
+                return
+            self._recent.append(fpath)
+        try:
+            fd = os.open(fpath, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            if _fadvise(fd, 0, self.prefetch_bytes, FADV_WILLNEED):
+                with self._lock:
+                    self.prefetched += 1
+        finally:
+            os.close(fd)
+    
+    def hashed(self, fd, offset, length):
+        """Drops 'length' bytes at 'offset' of open file 'fd', if dropping behind."""
+        if not self.drop_behind or _fadvise is None:
+            return
+        if _fadvise(fd, offset, length, FADV_DONTNEED):
+            with self._lock:
+                self.dropped += length
+
+class Interrupted(Exception):
+    """Raised when a checksum is interrupted before it is complete."""
+    pass
+
+def _check_interrupted(interrupted):
+    if interrupted is not None and interrupted():
+        raise Interrupted()
+
+def hash_file(h, fpath, blocksize=CHECKSUM_BLOCKSIZE, use_mmap=False, interrupted=None,
+              hints=None):
+    """Update hash object 'h' with the contents of file 'fpath'.
+
+       The hash object needs only an update(data) method, see 
+       new_digest. Reads 'blocksize' bytes at a time into a preallocated 
+       buffer that is reused by later calls on the same thread, so no 
+       data is copied per block. When 'use_mmap' is true, regular files
+       larger than one block are mapped into memory and hashed in place
+       instead. Note that a mapped file truncated by another process
+       while it is hashed will crash the interpreter, so only use mmap
+       for files that are not being written.
+
+       If given, the 'interrupted' function is called before each block 
+       and Interrupted is raised as soon as it returns true, and the 
+       IOHints 'hints' are told of each block hashed.
+
+       Raises IOError or OSError if the file cannot be read.
+    """
+    f = io.open(fpath, 'rb', buffering=0)
+    try:
+        if use_mmap:
+            s = os.fstat(f.fileno())
+            if stat.S_ISREG(s.st_mode) and s.st_size > blocksize:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    for offset in xrange(0, len(m), blocksize):
+                        _check_interrupted(interrupted)
+                        h.update(buffer(m, offset, blocksize))
+                        if hints is not None:
+                            hints.hashed(f.fileno(), offset, min(blocksize, len(m) - offset))
+                finally:
+                    m.close()
+                return
+        buf = _read_buffer(blocksize)
+        _check_interrupted(interrupted)
+        offset = 0
+        n = f.readinto(buf)
+        while n:
+            h.update(buffer(buf, 0, n))
+            if hints is not None:
+                hints.hashed(f.fileno(), offset, n)
+            offset += n
+            _check_interrupted(interrupted)
+            n = f.readinto(buf)
+    finally:
+        f.close()
+
+# Digest algorithms supported by new_digest
+DIGESTS = ['sha256', 'md5', 'sha1', 'blake2b', 'crc32', 'adler32']
+
+class _Checksum32(object):
+    """A hash object for the zlib crc32 and adler32 checksums."""
+    
+    def __init__(self, func, value):
+        self._func = func
+        self._value = value
+    
+    def update(self, data):
+        self._value = self._func(data, self._value)
+    
+    def hexdigest(self):
+        return '%08x' % (self._value & 0xffffffff)
+
+class _MultiHash(object):
+    """A hash object updating several named hash objects at once."""
+    
+    def __init__(self, names):
+        self._hashes = [ (name, new_digest(name)) for name in names ]
+    
+    def update(self, data):
+        for name, h in self._hashes:
+            h.update(data)
+    
+    def hexdigests(self):
+        return dict([ (name, h.hexdigest()) for name, h in self._hashes ])
+
+def new_digest(name):
+    """Returns a new hash object for digest algorithm 'name'.
+    
+       Raises ValueError if 'name' is not one of DIGESTS or is not
+       available in this Python installation.
+    """
+    if name == 'crc32':
+        return _Checksum32(zlib.crc32, 0)
+    if name == 'adler32':
+        return _Checksum32(zlib.adler32, 1)
+    if name not in DIGESTS:
+        raise ValueError("Unsupported digest: %s" % name)
+    if name == 'blake2b' and not hasattr(hashlib, 'blake2b'):
+        # older interpreters may get it from OpenSSL
+        name = 'blake2b512'
+    try:
+        return hashlib.new(name)
+    except ValueError:
+        raise ValueError("Digest not available: %s" % name)
+
+def file_digests(fpath, names, blocksize=CHECKSUM_BLOCKSIZE, use_mmap=False, 
+                 interrupted=None, hints=None):
+    """Return a dictionary of hex digest strings, keyed by algorithm name.
+
+       All digests named in 'names' are computed from a single read of
+       the file. Returns None if the file cannot be read. See hash_file
+       for the 'blocksize', 'use_mmap', 'interrupted' and 'hints' 
+       parameters.
+    """
+    h = _MultiHash(names)
+    try:
+        hash_file(h, fpath, blocksize, use_mmap, interrupted, hints)
+        return h.hexdigests()
+    except Interrupted:
+        raise
     except:
-        s = os.lstat(fpath)
-        return (rfpath, None, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid))
+        return None
+
+def sha256sum(fpath, blocksize=CHECKSUM_BLOCKSIZE, use_mmap=False):
+    """Return hex digest string like sha256sum utility would compute.
 
-def sha256sum(fpath):
-    """Return hex digest string like sha256sum utility would compute."""
+       Returns None if the file cannot be read. See hash_file for the
+       'blocksize' and 'use_mmap' parameters.
+    """
     h = hashlib.sha256()
     try:
-        f = open(fpath, 'rb')
+        hash_file(h, fpath, blocksize, use_mmap)
+        return h.hexdigest()
+    except:
+        return None
+
+# Name of the chunked SHA-256 digest computed by tree_digest
+TREE_DIGEST = 'sha256tree'
+
+# Default chunk size of tree_digest
+TREE_CHUNKSIZE = 64 * 1024 * 1024
+
+def _hash_chunk(f, offset, length, blocksize, interrupted, hints=None, also=None):
+    """Return the binary SHA-256 digest of 'length' bytes of open file 'f' at 'offset'.
+
+       The bytes read also update the hash object 'also', if given.
+    """
+    h = hashlib.sha256()
+    buf = _read_buffer(blocksize)
+    f.seek(offset)
+    while length > 0:
+        _check_interrupted(interrupted)
+        n = f.readinto(buf if length >= blocksize else memoryview(buf)[:length])
+        if not n:
+            break
+        h.update(buffer(buf, 0, n))
+        if also is not None:
+            also.update(buffer(buf, 0, n))
+        if hints is not None:
+            hints.hashed(f.fileno(), offset, n)
+        offset += n
+        length -= n
+    return h.digest()
+
+def tree_digest(fpath, chunksize=TREE_CHUNKSIZE, threads=1, blocksize=CHECKSUM_BLOCKSIZE,
+                checkpoint=None, interrupted=None, hints=None, also=None):
+    """Return the hex SHA-256 tree digest of file 'fpath'.
+
+       The file is split into chunks of 'chunksize' bytes, the last one 
+       possibly shorter, and each chunk is hashed with SHA-256. The tree 
+       digest is the SHA-256 of the binary chunk digests concatenated in 
+       file order. An empty file has a single empty chunk.
+
+       Chunks are hashed concurrently by up to 'threads' threads, each 
+       reading 'blocksize' bytes at a time through its own file handle. 
+       hashlib releases the interpreter lock while hashing large blocks, 
+       so a large file is hashed at the speed of several cores.
+
+       The progress of a tree digest can be kept and resumed through the 
+       optional 'checkpoint' object. Its 'leaves' attribute is a dictionary
+       of the binary digests of chunks hashed before, by chunk index, which
+       are not hashed again. Its 'save(leaves, final)' method is called 
+       with a dictionary of all chunk digests known so far, from the 
+       calling thread after each chunk it hashes, and with 'final' true 
+       when the digest stops on an error or interruption.
+
+       If given, the 'interrupted' function is called before each block
+       and Interrupted is raised as soon as it returns true, and the 
+       IOHints 'hints' are told of each block hashed.
+
+       The optional hash object 'also', such as the _MultiHash of other
+       digests, is updated with the whole file from the same reads. The
+       chunks are then hashed in file order by the calling thread alone,
+       and the chunks of the checkpoint are read again.
+
+       Raises IOError or OSError if the file cannot be read.
+    """
+    size = os.stat(fpath).st_size
+    count = max(1, (size + chunksize - 1) // chunksize)
+    leaves = [None] * count
+    if also is not None:
+        threads = 1
+    elif checkpoint is not None:
+        for i, digest in checkpoint.leaves.items():
+            if i < count:
+                leaves[i] = digest
+    chunks = iter([ i for i in xrange(count) if leaves[i] is None ])
+    lock = threading.Lock()
+    errors = []
+    
+    def stopped():
+        return errors or (interrupted is not None and interrupted())
+    
+    def known():
+        return dict([ (i, digest) for i, digest in enumerate(leaves) if digest is not None ])
+    
+    def hash_chunks(save=None):
         try:
-            b = f.read(4096)
-            while b:
-                h.update(b)
-                b = f.read(4096)
-            return h.hexdigest()
-        finally:
-            f.close()
+            f = io.open(fpath, 'rb', buffering=0)
+            try:
+                while not errors:
+                    with lock:
+                        i = next(chunks, None)
+                    if i is None:
+                        break
+                    leaves[i] = _hash_chunk(f, i * chunksize, chunksize, blocksize, 
+                                            stopped, hints, also)
+                    if save is not None:
+                        save(known(), False)
+            finally:
+                f.close()
+        except Exception as e:
+            errors.append(e)
+    
+    workers = [ threading.Thread(target=hash_chunks) 
+                for i in range(max(1, min(threads, count)) - 1) ]
+    for w in workers:
+        w.setDaemon(True)
+        w.start()
+    hash_chunks(checkpoint and checkpoint.save)
+    for w in workers:
+        w.join()
+    if errors:
+        if checkpoint is not None:
+            checkpoint.save(known(), True)
+        raise errors[0]
+    return hashlib.sha256(''.join(leaves)).hexdigest()
+
+def _libc_xattr():
+    """Returns (getxattr, setxattr) from the Linux C library, or (None, None)."""
+    if not sys.platform.startswith('linux'):
+        return (None, None)
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc_get = libc.getxattr
+        libc_set = libc.setxattr
+    except (ImportError, OSError, AttributeError):
+        return (None, None)
+    libc_get.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t]
+    libc_get.restype = ctypes.c_ssize_t
+    libc_set.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t,
+                         ctypes.c_int]
+    libc_set.restype = ctypes.c_int
+    def error(path):
+        e = ctypes.get_errno()
+        return OSError(e, os.strerror(e), path)
+    def encoded(path):
+        if isinstance(path, unicode):
+            return path.encode('utf-8')
+        return path
+    def getxattr(path, name):
+        buf = ctypes.create_string_buffer(256)
+        n = libc_get(encoded(path), name, buf, len(buf))
+        if n < 0:
+            raise error(path)
+        return buf.raw[:n]
+    def setxattr(path, name, value):
+        if libc_set(encoded(path), name, value, len(value), 0) != 0:
+            raise error(path)
+    return (getxattr, setxattr)
+
+# Extended attributes are in the os module from Python 3.3, and are otherwise
+# accessed through the C library on Linux.
+if hasattr(os, 'getxattr'):
+    (_getxattr, _setxattr) = (os.getxattr, os.setxattr)
+else:
+    (_getxattr, _setxattr) = _libc_xattr()
+
+# Providers of stored SHA-256 checksums, see ChecksumProviders
+CHECKSUM_PROVIDERS = ['xattr', 'sidecar']
+
+# Extended attributes of the SHA-256 checksum of a file and its stamp
+XATTR_SHA256 = 'user.sha256'
+XATTR_SHA256_STAMP = 'user.sha256.stamp'
+
+# Suffix of sidecar files holding the SHA-256 checksum of a file
+SIDECAR_SUFFIX = '.sha256'
+
+_RE_SHA256 = re.compile('^[0-9a-fA-F]{64}$')
+
+class ChecksumProviders(object):
+    """A chain of providers of SHA-256 checksums stored with files.
+
+       The providers named in 'names' are asked in order, and the first
+       valid checksum is used instead of reading the file:
+
+         'xattr'   the XATTR_SHA256 extended attribute, valid when the
+                   XATTR_SHA256_STAMP attribute holds the file's current
+                   '<size> <mtime_ns>'. Without a stamp, as written by
+                   other tools, it is valid when the file's ctime is newer
+                   than its mtime, that is when the contents were not 
+                   written after the attribute was set.
+         'sidecar' the first word of the file named like the file plus
+                   SIDECAR_SUFFIX, as written by sha256sum, valid when 
+                   the file's ctime is not newer than the sidecar. Any 
+                   change of the file's size or mtime changes its ctime.
+
+       When 'writeback' is true, checksums computed by file_checksum are
+       stored in the extended attributes, so that other hosts mounting
+       the same filesystem can use them. The 'provided' dictionary counts
+       the checksums of each provider, and 'written' the checksums stored.
+       One ChecksumProviders object may be shared by threads.
+    """
+    
+    def __init__(self, names=[], writeback=False):
+        """Initializes the chain of providers 'names'.
+        
+           Raises ValueError if a name is not one of CHECKSUM_PROVIDERS.
+        """
+        for name in names:
+            if name not in CHECKSUM_PROVIDERS:
+                raise ValueError("Unsupported checksum provider: %s" % name)
+        self.names = list(names)
+        self.writeback = writeback
+        self.provided = dict([ (name, 0) for name in names ])
+        self.written = 0
+        self._lock = threading.Lock()
+    
+    def _xattr(self, fpath, s):
+        if _getxattr is None:
+            return None
+        try:
+            checksum = _getxattr(fpath, XATTR_SHA256)
+        except (IOError, OSError):
+            return None
+        try:
+            stamp = _getxattr(fpath, XATTR_SHA256_STAMP)
+        except (IOError, OSError):
+            stamp = None
+        if stamp is not None:
+            if stamp.strip() != _stamp(s):
+                return None
+        elif _time_ns(s, 'st_ctime') <= _time_ns(s, 'st_mtime'):
+            # the contents may have been written after the attribute
+            return None
+        return checksum.strip()
+    
+    def _sidecar(self, fpath, s):
+        sidecar = fpath + SIDECAR_SUFFIX
+        try:
+            if _time_ns(os.stat(sidecar), 'st_mtime') < _time_ns(s, 'st_ctime'):
+                return None
+            f = open(sidecar, 'r')
+            try:
+                words = f.readline().split()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+        return words and words[0]
+    
+    def checksum(self, fpath, s):
+        """Returns the provided hex checksum of 'fpath' with stat result 's', or None."""
+        for name in self.names:
+            checksum = getattr(self, '_' + name)(fpath, s)
+            if checksum and _RE_SHA256.match(checksum):
+                with self._lock:
+                    self.provided[name] += 1
+                return checksum.lower()
+        return None
+    
+    def store(self, fpath, s, checksum):
+        """Stores hex 'checksum' of 'fpath', computed after stat result 's'."""
+        if not self.writeback or _setxattr is None:
+            return
+        try:
+            # an empty stamp goes first and the stamp last, so a partial
+            # write is never valid, not even as an unstamped checksum
+            _setxattr(fpath, XATTR_SHA256_STAMP, '')
+            _setxattr(fpath, XATTR_SHA256, checksum)
+            _setxattr(fpath, XATTR_SHA256_STAMP, _stamp(s))
+        except (IOError, OSError) as err:
+            logger.debug("Cannot store checksum of %s: %s" % (fpath, err))
+            return
+        with self._lock:
+            self.written += 1
+
+def _stamp(s):
+    """Returns the '<size> <mtime_ns>' stamp of stat result 's'."""
+    return '%d %d' % (s.st_size, _time_ns(s, 'st_mtime'))
+
+def file_checksum(fpath, size, names=[], blocksize=CHECKSUM_BLOCKSIZE, use_mmap=False,
+                  tree_chunksize=None, tree_threads=1, checkpoint=None, interrupted=None,
+                  hints=None, providers=None):
+    """Return tuple (checksum, tree_chunksize, digests) for file 'fpath'.
+
+       The checksum is the sha256sum of the file and tree_chunksize is 
+       None, unless 'tree_chunksize' is given and the file's 'size' is
+       larger than one chunk. Then the checksum is the tree_digest of the
+       file, computed by 'tree_threads' threads, and tree_chunksize is
+       returned as given.
+
+       digests is a dictionary of the other digests named in 'names', see
+       file_digests. It includes the plain 'sha256', if named, only when 
+       the checksum is a tree digest. Returns None if the file cannot be 
+       read.
+
+       The 'checkpoint' is only used for a tree digest, see tree_digest for
+       it and for 'interrupted' and 'hints'. The digests named along with a
+       tree digest are computed from the same read of the file, by one 
+       thread.
+
+       When ChecksumProviders 'providers' are given, a stored sha256sum is
+       used instead of reading the file, if no other digests are named,
+       and the sha256sum computed otherwise is stored back.
+    """
+    s = None
+    if providers is not None:
+        try:
+            s = os.stat(fpath)
+        except OSError:
+            return None
+    if not tree_chunksize or size is None or size <= tree_chunksize:
+        others = [n for n in names if n != 'sha256']
+        if s is not None and not others:
+            checksum = providers.checksum(fpath, s)
+            if checksum:
+                return (checksum, None, {})
+        digests = file_digests(fpath, ['sha256'] + others, 
+                               blocksize, use_mmap, interrupted, hints)
+        if digests is None:
+            return None
+        checksum = digests.pop('sha256')
+        if s is not None:
+            providers.store(fpath, s, checksum)
+        return (checksum, None, digests)
+    h = None
+    if names:
+        h = _MultiHash(names)
+    try:
+        checksum = tree_digest(fpath, tree_chunksize, tree_threads, blocksize, 
+                               checkpoint, interrupted, hints, h)
+    except Interrupted:
+        raise
     except:
         return None
+    digests = {}
+    if h is not None:
+        digests = h.hexdigests()
+        if s is not None and 'sha256' in digests:
+            providers.store(fpath, s, digests['sha256'])
+    return (checksum, tree_chunksize, digests)
 
 def expand_dir_stats_sha256(dirpath, relpath, dname):
     """Expand directory stats as a helper function useful with tree_scan expand_dir argument.
 
        Returns tuple (dirpath, None, mtime, user, group, None)
     """
-    dpath = '%s%s%s' % (dirpath, os.path.sep, dname)
-    rdpath = '%s%s%s' % (relpath, os.path.sep, dname)
-    try:
-        s = os.stat(dpath)
-    except:
-        s = os.lstat(dpath)
-    return (rdpath, None, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid), None)
+    return expand_dir_stats(dirpath, relpath, dname) + (None,)
 
 def expand_file_stats_sha256(dirpath, relpath, fname):
     """Expand file stats as a helper function useful with tree_scan expand_file argument.
@@ -175,22 +1298,258 @@ def expand_file_stats_sha256(dirpath, relpath, fname):
        size may be None if fname does not link to a regular file
        sha256sum may be None if fname does not link to a readable regular file
     """
-    fpath = '%s%s%s' % (dirpath, os.path.sep, fname)
-    rfpath = '%s%s%s' % (relpath, os.path.sep, fname)
-    try:
-        s = os.stat(fpath)
-        return (rfpath, s.st_size, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid), sha256sum(fpath))
-    except:
-        s = os.lstat(fpath)
-        return (rfpath, None, s.st_mtime, uid2uname(s.st_uid), gid2gname(s.st_gid))
+    stats = expand_file_stats(dirpath, relpath, fname)
+    if stats[1] is None:
+        return stats + (None,)
+    return stats + (sha256sum('%s%s%s' % (dirpath, os.path.sep, fname)),)
+
+def tree_scan_stats(top, excludes=[], includes=[], prune=False, threads=1):
+    """Generate (path, size, mtime, user, group) for members of the tree at 'top'.
+
+       Equivalent to tree_scan with expand_dir_stats and expand_file_stats
+       but reuses the stat taken while listing each directory.
+    """
+    for dirpath, relpath, name, s in _tree_walk(top, excludes, includes, prune, threads):
+        yield _stats_tuple('%s%s%s' % (relpath, os.path.sep, name), s)
+
+def tree_scan_stats_identity(top, excludes=[], includes=[], prune=False, threads=1):
+    """Generate (path, size, mtime, user, group, identity) for members of the tree at 'top'.
+
+       Like tree_scan_stats, with the stat_identity of each member.
+    """
+    for dirpath, relpath, name, s in _tree_walk(top, excludes, includes, prune, threads):
+        yield _stats_tuple('%s%s%s' % (relpath, os.path.sep, name), s) + (stat_identity(s),)
+
+def dir_fingerprint(members):
+    """Return a hex fingerprint of directory 'members' from _tree_walk_dirs.
+
+       The fingerprint is a SHA-1 digest of the name, size, mtime_ns,
+       ctime_ns and inode of each member, in name order. It changes 
+       whenever a member is added, removed, renamed, replaced or 
+       modified, but not when files in subdirectories change.
+    """
+    h = hashlib.sha1()
+    for dirpath, relpath, name, s in sorted(members, key=lambda m: m[2]):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        h.update('%s\0%d\0%d\0%d\0%d\n' % (name, s.st_size, _time_ns(s, 'st_mtime'),
+                                           _time_ns(s, 'st_ctime'), s.st_ino))
+    return h.hexdigest()
+
+def tree_scan_dirs(top, excludes=[], includes=[], prune=False, threads=1, 
+                   batch=SCAN_BATCH, failures=None):
+    """Generate (relpath, fingerprint, stats) for each directory of the tree at 'top'.
+
+       'stats' is the list of (path, size, mtime, user, group, identity) 
+       tuples of the directory's members, as generated by 
+       tree_scan_stats_identity, and 'fingerprint' is their 
+       dir_fingerprint. 'relpath' is the directory's path relative to
+       'top', '' for 'top' itself. A directory with more than 'batch'
+       members is generated in several parts as it is read, each with
+       a None fingerprint, as is a directory that could not be read 
+       whole. The paths of the directories that cannot be listed, 'top'
+       included, are appended to the 'failures' list if given. See 
+       tree_scan for the other parameters; directories are generated in
+       no particular order.
+    """
+    for relpath, members, whole in _tree_walk_dirs(top, excludes, includes, prune, 
+                                                   threads, batch, failures):
+        stats = [ _stats_tuple('%s%s%s' % (relpath, os.path.sep, m[2]), m[3]) + (stat_identity(m[3]),)
+                  for m in members ]
+        if whole:
+            yield (relpath, dir_fingerprint(members), stats)
+        else:
+            yield (relpath, None, stats)
+
+def _sorted_members(dirpath, relpath, matcher, prune, failures=None):
+    """Returns the (key, member, subdir) entries of one directory in path order.
+
+       Each non-excluded member is keyed by its name, and each directory
+       to be walked by its name followed by a separator, which is where
+       the paths of its own members sort among the paths of its siblings.
+       See _scan_dir for 'failures'.
+    """
+    entries = []
+    for members, subdirs, whole in _scan_dir(dirpath, relpath, matcher, prune, sys.maxint,
+                                             failures):
+        for m in members:
+            name = m[2].encode('utf-8') if isinstance(m[2], unicode) else m[2]
+            entries.append((name, m, None))
+        for subdir in subdirs:
+            name = os.path.basename(subdir)
+            name = name.encode('utf-8') if isinstance(name, unicode) else name
+            entries.append((name + '/', None, subdir))
+    entries.sort(key=lambda e: e[0])
+    return entries
+
+def tree_scan_sorted(top, excludes=[], includes=[], prune=False, batch=SCAN_BATCH,
+                     failures=None):
+    """Generate (relpath, fingerprint, stats) for the tree at 'top' in path order.
+
+       Like tree_scan_dirs, but the stats of all members of the tree are
+       generated in the byte order of their paths, which is the order of
+       the filenames in the state database, 'batch' members at a time 
+       with an empty 'relpath' and a None 'fingerprint'. Directories are
+       listed one at a time, each of them whole. See tree_scan_dirs for
+       'failures'.
+    """
+    matcher = PathMatcher(excludes, includes)
+    stack = [iter(_sorted_members(top, '', matcher, prune, failures))]
+    stats = []
+    while stack:
+        try:
+            (key, m, subdir) = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            continue
+        if subdir is not None:
+            stack.append(iter(_sorted_members(subdir, subdir[len(top):], matcher, prune,
+                                              failures)))
+            continue
+        stats.append(_stats_tuple('%s%s%s' % (m[1], os.path.sep, m[2]), m[3]) + 
+                     (stat_identity(m[3]),))
+        if len(stats) >= batch:
+            yield ('', None, stats)
+            stats = []
+    if stats:
+        yield ('', None, stats)
+
+def tree_scan_stats_sha256(top, excludes=[], includes=[], prune=False, threads=1):
+    """Generate (path, size, mtime, user, group, sha256sum) for members of the tree at 'top'.
+
+       Equivalent to tree_scan with expand_dir_stats_sha256 and 
+       expand_file_stats_sha256 but reuses the stat taken while listing.
+    """
+    for dirpath, relpath, name, s in _tree_walk(top, excludes, includes, prune, threads):
+        stats = _stats_tuple('%s%s%s' % (relpath, os.path.sep, name), s)
+        if stats[1] is None:
+            yield stats + (None,)
+        else:
+            yield stats + (sha256sum(os.path.join(dirpath, name)),)
+
+# Maximum number of listing records generated together by listing_scan_dirs
+LISTING_BATCH = 1000
+
+def _listing_time_ns(t):
+    if t is None:
+        return None
+    return int(round(float(t) * 1e9))
+
+def _parse_listing_line(line):
+    """Returns (path, size, mtime, uid, gid, dev, ino, ctime) for one listing line.
 
-def tree_scan_stats(top, excludes=[], includes=[]):
-    """Convenience wrapper for tree_scan."""
-    return tree_scan(top, expand_dir=expand_dir_stats, expand_file=expand_file_stats, excludes=excludes, includes=includes)
+       A line starting with '{' is a JSON object with the keys "path",
+       "size", "mtime", "uid" and "gid", and optionally "type" ("d" for a
+       directory), "dev", "ino" and "ctime". Any other line has the tab
+       separated fields path, size, mtime, uid and gid, where an empty or
+       '-' size marks a directory. Raises ValueError for malformed lines.
+    """
+    if line.startswith('{'):
+        r = json.loads(line)
+        size = r.get('size')
+        if r.get('type') == 'd':
+            size = None
+        path = r['path']
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return (path, size, float(r['mtime']), int(r['uid']), int(r['gid']),
+                r.get('dev'), r.get('ino'), r.get('ctime'))
+    fields = line.rsplit('\t', 4)
+    if len(fields) != 5:
+        raise ValueError("expected 5 tab separated fields")
+    (path, size, mtime, uid, gid) = fields
+    size = None if size in ('', '-') else int(size)
+    return (path, size, float(mtime), int(uid), int(gid), None, None, None)
+
+def _listing_pruned(matcher, relpath):
+    """Returns True if a directory on 'relpath' is excluded, see PathMatcher."""
+    parts = relpath.split(os.path.sep)
+    for i in range(len(parts)):
+        if parts[i] and matcher.excluded(parts[i], os.path.sep.join(parts[:i])):
+            return True
+    return False
+
+def listing_scan_dirs(top, listing, excludes=[], includes=[], prune=False, 
+                      batch=LISTING_BATCH):
+    """Generate (relpath, fingerprint, stats) from the file 'listing' of the tree at 'top'.
+
+       The listing holds one record per line, in the formats read by 
+       _parse_listing_line, as produced by a policy-engine scan or 'lfs
+       find'. Paths are absolute, under 'top', or relative to 'top'; 
+       records outside 'top' and malformed lines are logged and skipped.
+       A record of 'top' itself is in the tree but, as in tree_scan_dirs,
+       not generated.
+       The listing is read as a stream. Consecutive records of the same 
+       directory are generated together, at most 'batch' at a time, in 
+       the form of tree_scan_dirs, with a None fingerprint. Identity 
+       fields missing from the listing are None. See tree_scan for the 
+       other parameters; the filesystem itself is not accessed.
+    """
+    matcher = PathMatcher(excludes, includes)
+    if not top.endswith(os.path.sep):
+        prefix = top + os.path.sep
+    else:
+        prefix = top
+    dirpath = None
+    pruned = False
+    stats = []
+    f = open(listing, 'r')
+    try:
+        for lineno, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            try:
+                (path, size, mtime, uid, gid, dev, ino, ctime) = _parse_listing_line(line)
+            except (ValueError, KeyError, TypeError) as err:
+                logger.warning("Skipping line %d of %s: %s" % (lineno, listing, err))
+                continue
+            if path.rstrip(os.path.sep) in ('.', top.rstrip(os.path.sep)):
+                continue
+            if not path.startswith(os.path.sep):
+                path = prefix + path
+            elif not path.startswith(prefix):
+                logger.warning("Skipping %s, not under %s" % (path, top))
+                continue
+            (relpath, name) = os.path.split(path[len(top):].rstrip(os.path.sep))
+            if relpath == os.path.sep:
+                relpath = ''
+            if relpath != dirpath or len(stats) >= batch:
+                if stats:
+                    yield (dirpath, None, stats)
+                    stats = []
+                if relpath != dirpath:
+                    dirpath = relpath
+                    pruned = prune and _listing_pruned(matcher, relpath)
+            if pruned or matcher.excluded(name, relpath):
+                continue
+            identity = (dev, ino, size, _listing_time_ns(mtime), _listing_time_ns(ctime))
+            stats.append(('%s%s%s' % (relpath, os.path.sep, name), size, mtime,
+                          uid2uname(uid), gid2gname(gid), identity))
+        if stats:
+            yield (dirpath, None, stats)
+    finally:
+        f.close()
 
-def tree_scan_stats_sha256(top, excludes=[], includes=[]):
-    """Convenience wrapper for tree_scan."""
-    return tree_scan(top, expand_dir=expand_dir_stats_sha256, expand_file=expand_file_stats_sha256, excludes=excludes, includes=includes)
+def outermost_dirs(dirnames):
+    """Returns the directories of 'dirnames' that are not under another.
+    
+    A directory repeated, or nested under another of 'dirnames', would be
+    walked again as part of the other; it is logged and left out. The 
+    others are returned in their order, as given.
+    """
+    normalized = [ os.path.normpath(os.path.abspath(d)) for d in dirnames ]
+    found = []
+    for i, d in enumerate(dirnames):
+        outer = [ dirnames[j] for j, n in enumerate(normalized) 
+                  if (n == normalized[i] and j < i) or
+                     (n != normalized[i] and 
+                      normalized[i].startswith(n.rstrip(os.path.sep) + os.path.sep)) ]
+        if outer:
+            logger.warning("Skipping %s, under %s" % (d, outer[0]))
+        else:
+            found.append(d)
+    return found
 
 def create_uri_friendly_file_path(dir_path, rfilename):
     """
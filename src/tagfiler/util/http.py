@@ -17,10 +17,11 @@
 Tagfiler client.
 """
 
-from tagfiler.iobox.models import File
+from tagfiler.iobox.models import File, Tag
+from tagfiler.util.files import TREE_DIGEST
 
 from httplib import HTTPConnection, HTTPSConnection
-from httplib import OK, CREATED, ACCEPTED, NO_CONTENT, SEE_OTHER
+from httplib import OK, CREATED, ACCEPTED, NO_CONTENT, SEE_OTHER, NOT_FOUND
 import urlparse
 import urllib
 import logging
@@ -36,6 +37,10 @@ except:
 
 logger = logging.getLogger(__name__)
 
+# Maximum length of the URLs of delete_subjects, over which it sends more 
+# requests
+BULK_URL_MAX = 4096
+
 
 class TagfilerException(Exception):
     def __init__(self, value, cause=None):
@@ -199,12 +204,20 @@ class TagfilerClient(object):
         return resp
 
 
-    def add_subjects(self, fileobjs):
+    def add_subjects(self, fileobjs, digests=[]):
         """Registers a list of files and tags in tagfiler using a single request.
         
         Keyword arguments:
         
         fileobjs -- the list of register files objects 
+        digests -- names of digests to register as tags of the same name; 
+                   'sha256' is the file's checksum and the others are taken
+                   from its digests
+        
+        A file whose checksum is a tree digest is also registered with 
+        the tags 'sha256tree', its checksum, and 'sha256tree_chunksize'.
+        A file registered for its checksum only, see File.checksum_only,
+        always has its checksum tag, even if 'sha256' is not in 'digests'.
         
         """
         parsed_table = []
@@ -212,7 +225,7 @@ class TagfilerClient(object):
         
         tag_sets = []
         for fileobj in fileobjs:
-            tag_sets.append(fileobj.tags)
+            tag_sets.append(fileobj.tags + self._digest_tags(fileobj, digests))
             tag_sets.extend(fileobj.content_tags)
         
         for tag_set in tag_sets:
@@ -240,6 +253,55 @@ class TagfilerClient(object):
         self._send_request("PUT", bulkurl, payload, headers)
 
 
+    def delete_subjects(self, fileobjs):
+        """Deletes the subjects of a list of files from tagfiler in bulk.
+        
+        Keyword arguments:
+        
+        fileobjs -- the list of file objects, with their 'name' tags
+        
+        The subjects are selected by their names, as many per request as fit
+        in a URL of BULK_URL_MAX bytes. Files without a 'name' tag are 
+        ignored, and subjects already deleted are not an error.
+        
+        """
+        names = [ self._safequote(tag.value) for fileobj in fileobjs 
+                  for tag in fileobj.filter_tags("name") ]
+        headers = {self.authn_header: self.authn_header_value}
+        prefix = '%s/subject/name=' % self.baseuri
+        while names:
+            count = 1
+            length = len(prefix) + len(names[0])
+            while count < len(names) and length + 1 + len(names[count]) <= BULK_URL_MAX:
+                length += 1 + len(names[count])
+                count += 1
+            bulkurl = prefix + ','.join(names[:count])
+            names = names[count:]
+            try:
+                self._send_request("DELETE", bulkurl, headers=headers)
+            except ProtocolError as e:
+                if e._errorno != NOT_FOUND:
+                    raise
+
+
+    def _digest_tags(self, fileobj, digests):
+        tags = []
+        if fileobj.tree_chunksize:
+            tags.append(Tag(name=TREE_DIGEST, value=fileobj.checksum))
+            tags.append(Tag(name='%s_chunksize' % TREE_DIGEST, 
+                            value=fileobj.tree_chunksize))
+        elif fileobj.checksum_only and 'sha256' not in digests:
+            tags.append(Tag(name='sha256', value=fileobj.checksum))
+        for name in digests:
+            if name == 'sha256' and not fileobj.tree_chunksize:
+                value = fileobj.checksum
+            else:
+                value = fileobj.digests.get(name)
+            if value:
+                tags.append(Tag(name=name, value=value))
+        return tags
+
+
     def find_subject_by_name(self, name):
         """Looks up a subject by its name tag in tagfiler and returns a dictionary if found, None otherwise
         